@@ -5,19 +5,25 @@ import json
 from datetime import datetime
 from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify  # type: ignore
 from init_db import init_database as init_db
-from db_logic import insert_user, clear_db, check_user_login, set_user_status, get_user_by_id, get_all_users, get_user_stats, delete_user_completely, migrate_database
+from db_logic import insert_user, clear_db, check_user_login, set_user_status, get_user_by_id, get_user_by_email, get_users_page, USERS_PAGE_SIZE, get_user_stats, get_daily_activity, set_user_quota, get_delete_jobs
 from logging_config import setup_logging, attach_request_logging # type: ignore
 from werkzeug.security import generate_password_hash  # type: ignore
 from uploads import (
     get_user_files, handle_file_upload, handle_file_download,  # type: ignore
-    delete_user_file, allowed_file, handle_public_download # type: ignore
+    delete_user_file, allowed_file, handle_public_download, # type: ignore
+    import_legacy_metadata, import_legacy_resumable_uploads # type: ignore
 )
 
-DB_PATH = '/app/db/database.db'  # ruta usada también en db_logic (mantener si se requiere en otro lugar)
+from db_pool import DB_PATH  # type: ignore  # noqa: F401 (compatibilidad; configurable con la variable DB_PATH)
 
-def main():
-    init_db()
-    migrate_database()  # Ejecutar migraciones pendientes
+def main(background_workers=True):
+    """Crear la app Flask. Con background_workers=False (transfer_server.py, que sólo necesita
+    la configuración y la sesión) no se importan datos legados ni se arrancan el barrido de
+    expirados y la cola de borrados: de eso se encargan los workers de gunicorn."""
+    init_db()  # Migraciones versionadas (sólo un worker las aplica; ver migrations.py)
+    if background_workers:
+        import_legacy_metadata()  # Importar sidecars .meta al catálogo (sólo la primera vez)
+        import_legacy_resumable_uploads()  # Subidas por chunks en curso guardadas en JSON por versiones anteriores
     app = Flask(__name__)
 
     # Seguridad de cookies de sesión
@@ -28,9 +34,24 @@ def main():
         'SESSION_COOKIE_SAMESITE': 'Lax'
     })
 
+    # Endpoints que leen el cuerpo en streaming: nadie debe acceder a request.form/files antes
+    app.config['STREAMING_ENDPOINTS'] = {'upload_stream', 'chunk_upload', 'chunk_upload_raw', 'tus_collection', 'tus_upload', 'upload_batch'}
+    # Endpoints que reciben archivos: admisión previa al cuerpo (413) y cierre si se rechazan a medias
+    app.config['UPLOAD_ENDPOINTS'] = {'upload_file', 'upload_progress', 'upload_stream', 'chunk_upload', 'chunk_upload_raw', 'upload_batch'}
+    # Endpoints que aceptan `Authorization: Bearer <token de API>` (clientes tus sin navegador)
+    app.config['TOKEN_AUTH_ENDPOINTS'] = {'tus_collection', 'tus_upload'}
+
     setup_logging(app)
     attach_request_logging(app)
 
+    if background_workers:
+        # Barrido de expirados en segundo plano (EXPIRY_SWEEP_INTERVAL=0 lo desactiva)
+        from sweeper import start_expiry_sweeper # type: ignore
+        start_expiry_sweeper()
+        # Borrados grandes (eliminar usuarios) en cola; DELETE_JOBS_POLL_SECONDS=0 lo desactiva
+        from delete_jobs import start_delete_worker # type: ignore
+        start_delete_worker()
+
     # Determine SECRET_KEY with priority:
     # 1. environment variable SECRET_KEY
     # 2. .env file at repo root (simple parser)
@@ -64,7 +85,9 @@ def main():
             try:
                 # ensure directory exists (should be project root)
                 os.makedirs(os.path.dirname(secret_file), exist_ok=True)
-                with open(secret_file, 'w') as f:
+                # sólo legible por el propietario: quien la tenga puede firmar sesiones
+                fd = os.open(secret_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
                     f.write(secret_key)
             except Exception:
                 # if saving fails, fall back to in-memory key (dev only)
@@ -131,10 +154,67 @@ def main():
             session['_csrf'] = token
         return token
 
+    # ---------------- Tokens de API (Bearer) -----------------
+    import hashlib as _hashlib
+    from datetime import timedelta as _timedelta
+
+    def _token_hash(token):
+        return _hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _bearer_token():
+        scheme, _, token = (request.headers.get('Authorization') or '').partition(' ')
+        return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+    def _api_user_id():
+        """Usuario de una ruta de TOKEN_AUTH_ENDPOINTS: el del token Bearer si se envía (uno
+        inválido no recurre a la cookie, que exige CSRF) o, si no, el de la sesión."""
+        token = _bearer_token()
+        if token is None:
+            return session.get('user_id')
+        from db_logic import get_api_token_user  # type: ignore
+        now = datetime.now()
+        return get_api_token_user(_token_hash(token), now.isoformat(), (now - _timedelta(minutes=1)).isoformat())
+
     @app.context_processor  # type: ignore[misc]
     def inject_csrf():
         return {'csrf_token': _get_csrf_token()}
 
+    @app.template_filter('filesize')  # type: ignore[misc]
+    def filesize(num_bytes):
+        size = float(num_bytes or 0)
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if size < 1024:
+                return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+            size /= 1024
+        return f"{size:.1f} TB"
+
+    @app.before_request  # type: ignore[misc]
+    def upload_admission_check():
+        # Debe ir antes de csrf_protect: request.form leería el cuerpo completo
+        if request.method not in ('POST', 'PUT') or request.endpoint not in app.config['UPLOAD_ENDPOINTS']:
+            return
+        from uploads import upload_admission  # type: ignore
+        rejected = upload_admission(session.get('user_id'), chunked=request.endpoint.startswith('chunk_'),
+                                    batch=request.endpoint == 'upload_batch')
+        if not rejected:
+            return
+        result, status_code = rejected
+        app.logger.warning(f"Subida rechazada antes del cuerpo: {request.endpoint} user={session.get('user_id')} {result.get('error_code')}")
+        if request.endpoint == 'upload_file':
+            # Página con el aviso y el código de error (no una redirección): con status >= 400
+            # close_rejected_upload cierra la conexión en lugar de leer el cuerpo rechazado
+            flash(result['error'], 'error')
+            return render_template("upload.html"), status_code
+        return jsonify(result), status_code
+
+    @app.after_request  # type: ignore[misc]
+    def close_rejected_upload(response):
+        receives_body = request.endpoint in app.config['UPLOAD_ENDPOINTS'] or request.endpoint in app.config['STREAMING_ENDPOINTS']
+        if receives_body and request.method in ('POST', 'PUT', 'PATCH'):
+            from uploads import close_unread_body  # type: ignore
+            return close_unread_body(response)
+        return response
+
     @app.before_request  # type: ignore[misc]
     def csrf_protect():
         # Métodos que cambian estado
@@ -143,7 +223,16 @@ def main():
             exempt = set([])
             if request.endpoint in exempt:
                 return
+            # Con token Bearer no hay cookie implicada: el navegador nunca lo envía por su cuenta
+            if request.endpoint in app.config['TOKEN_AUTH_ENDPOINTS'] and _bearer_token() is not None:
+                return
             session_token = session.get('_csrf')
+            if request.endpoint in app.config['STREAMING_ENDPOINTS']:
+                # Sólo cabecera: leer request.form consumiría el cuerpo antes de la vista
+                supplied = request.headers.get('X-CSRF-Token')
+                if not session_token or not supplied or supplied != session_token:
+                    return ("CSRF token inválido", 400)
+                return
             supplied = (
                 request.headers.get('X-CSRF-Token')
                 or request.form.get('_csrf')
@@ -232,15 +321,10 @@ def main():
         admin_mail = os.environ.get('ADMIN_EMAIL')
         if not admin_mail:
             return
-        from sqlite3 import connect
-        conn = connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute('SELECT id FROM usuarios WHERE email=?', (email,))
-        row = cur.fetchone()
-        conn.close()
-        if not row:
+        user = get_user_by_email(email)
+        if not user:
             return
-        uid = row[0]
+        uid = user['id']
         approve_t = generate_action_token('approve', uid)
         reject_t = generate_action_token('reject', uid)
         base_url = os.environ.get('PUBLIC_BASE_URL', 'http://localhost:3000')
@@ -322,15 +406,10 @@ def main():
             flash('¡Bienvenido al Dashboard!\nHas iniciado sesión exitosamente en la aplicación.\nDesde aquí puedes subir archivos.', 'success')
             return redirect(url_for('dashboard'))
         # Diferenciar mensajes: usuario existe pero pendiente / rechazado
-        from sqlite3 import connect
         try:
-            conn = connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute('SELECT estado FROM usuarios WHERE email=?', (email,))
-            r = cur.fetchone()
-            conn.close()
-            if r:
-                estado = r[0]
+            existing = get_user_by_email(email)
+            if existing:
+                estado = existing['estado']
                 if estado == 'pendiente':
                     flash('Tu cuenta aún está pendiente de aprobación.', 'error')
                 elif estado == 'rechazado':
@@ -367,20 +446,26 @@ def main():
         if not is_admin_session():
             return redirect(url_for('admin_login'))
         
-        # Obtener parámetros de filtro
+        # Obtener parámetros de filtro y paginación (cursor = id del último usuario visto)
         search = request.args.get('search', '').strip()
         estado_filter = request.args.get('estado', '').strip()
+        cursor = request.args.get('cursor', type=int)
+        back = request.args.get('back', type=int)
+        limit = request.args.get('limit', USERS_PAGE_SIZE, type=int)
         
-        # Obtener todos los usuarios (con filtros si los hay)
-        users = get_all_users(search=search, estado_filter=estado_filter)
+        page = get_users_page(search=search, estado_filter=estado_filter, cursor=cursor, back=back, limit=limit)
         
-        # Obtener estadísticas
+        # Obtener estadísticas (contadores mantenidos por triggers, sin recorrer tablas)
         stats = get_user_stats()
+        activity = get_daily_activity()
+        delete_jobs = get_delete_jobs()
         
         # Log para depuración
-        app.logger.info(f"Admin panel - Usuarios encontrados: {len(users)}, Stats: {stats}")
+        app.logger.info(f"Admin panel - Usuarios en página: {len(page['users'])}, Stats: {stats}")
         
-        return render_template('admin.html', users=users, stats=stats)
+        return render_template('admin.html', users=page['users'], stats=stats, activity=activity, delete_jobs=delete_jobs,
+                               next_cursor=page['next_cursor'], prev_cursor=page['prev_cursor'],
+                               limit=page['limit'])
 
     @app.route('/admin/change-status', methods=['POST'])
     def admin_change_user_status():
@@ -453,14 +538,55 @@ def main():
             flash('Usuario no encontrado', 'error')
             return redirect(url_for('admin_panel'))
         
-        # Eliminar usuario
-        if delete_user_completely(user_id):
+        # Eliminar usuario; sus archivos pasan a la papelera y se borran en segundo plano
+        from delete_jobs import delete_user_in_background # type: ignore
+        success, job_id = delete_user_in_background(user_id)
+        if success and job_id:
+            flash(f"Usuario {user['nombre']} eliminado permanentemente; sus archivos se borran en segundo plano (trabajo #{job_id})", 'success')
+        elif success:
             flash(f"Usuario {user['nombre']} eliminado permanentemente", 'success')
         else:
             flash(f"Error al eliminar a {user['nombre']}", 'error')
         
         return redirect(url_for('admin_panel'))
 
+    @app.route('/admin/delete-jobs')
+    def admin_delete_jobs():
+        # Progreso de los borrados en segundo plano (el panel lo consulta periódicamente)
+        if not is_admin_session():
+            return jsonify({'error': 'No autorizado'}), 401
+        return jsonify({'jobs': get_delete_jobs(request.args.get('limit', 20, type=int))})
+
+    @app.route('/admin/quota', methods=['POST'])
+    def admin_set_quota():
+        if not is_admin_session():
+            return redirect(url_for('admin_login'))
+
+        # Campos vacíos = cuota por defecto; 0 = sin límite
+        try:
+            user_id = int(request.form.get('user_id', ''))
+            quota_mb = request.form.get('quota_mb', '').strip()
+            quota_files = request.form.get('quota_files', '').strip()
+            max_bytes = int(float(quota_mb) * 1024 * 1024) if quota_mb else None
+            max_files = int(quota_files) if quota_files else None
+        except ValueError:
+            flash('Valores de cuota inválidos', 'error')
+            return redirect(url_for('admin_panel'))
+        if (max_bytes is not None and max_bytes < 0) or (max_files is not None and max_files < 0):
+            flash('Valores de cuota inválidos', 'error')
+            return redirect(url_for('admin_panel'))
+
+        user = get_user_by_id(user_id)
+        if not user:
+            flash('Usuario no encontrado', 'error')
+            return redirect(url_for('admin_panel'))
+
+        if set_user_quota(user_id, max_bytes, max_files):
+            flash(f"Cuota de {user['nombre']} actualizada", 'success')
+        else:
+            flash(f"Error al actualizar la cuota de {user['nombre']}", 'error')
+        return redirect(url_for('admin_panel'))
+
     # Mantener rutas de aprobación por email (para compatibilidad)
     @app.route('/admin/approve/<int:user_id>/<token>')
     def admin_approve(user_id, token):
@@ -533,6 +659,28 @@ def main():
                 return "Archivo no encontrado o expirado", 404
             return public_result
 
+    @app.route("/bundle", methods=["GET", "POST"])
+    def download_bundle():
+        """Varios archivos propios en un ZIP64 o tar generado al vuelo (?f=<archivo>&f=...&format=zip|tar)"""
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from bundles import handle_bundle_download # type: ignore
+        values = request.form if request.method == 'POST' else request.args
+        result = handle_bundle_download(session['user_id'], values.getlist('f'),
+                                        values.get('format', 'zip'), values.get('name'))
+        if isinstance(result, tuple):
+            return jsonify(result[0]), result[1]
+        return result
+
+    @app.route("/s/<token>")
+    def shared_download(token):
+        """Descarga pública mediante token opaco (no expone el nombre almacenado)"""
+        from uploads import handle_token_download # type: ignore
+        result = handle_token_download(token)
+        if result is None:
+            return "Archivo no encontrado o expirado", 404
+        return result
+
     @app.route("/api/upload_progress", methods=["POST"])
     def upload_progress():
         """Endpoint para subida con progreso vía AJAX"""
@@ -547,39 +695,57 @@ def main():
         
         return jsonify(result), status_code
 
+    @app.route("/api/upload_stream", methods=["POST", "PUT"])
+    def upload_stream():
+        """Subida en streaming: multipart o cuerpo crudo escritos directamente a disco"""
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from uploads import handle_stream_upload  # type: ignore
+        result, status_code = handle_stream_upload(session['user_id'])
+        return jsonify(result), status_code
+
+    @app.route("/api/upload_batch", methods=["POST"])
+    def upload_batch():
+        """Lote de archivos (carpeta) en un solo multipart, registrado en una transacción"""
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from uploads import handle_batch_upload  # type: ignore
+        result, status_code = handle_batch_upload(session['user_id'])
+        return jsonify(result), status_code
+
     # -------------------- Subidas resumibles (chunked) --------------------
     @app.route('/api/chunk/init', methods=['POST'])
     def chunk_init():
         if 'user_id' not in session:
             return jsonify({'error': 'No autorizado'}), 401
-        data = request.get_json(silent=True) or {}
-        original_name = data.get('filename')
-        total_size = data.get('total_size')
-        if not original_name or not isinstance(total_size, int):
-            return jsonify({'error': 'Datos inválidos'}), 400
-        from uploads import init_resumable_upload  # type: ignore
-        meta = init_resumable_upload(session['user_id'], original_name, total_size)
-        return jsonify({
-            'success': True,
-            'upload_id': meta['upload_id'],
-            'chunk_size': meta['chunk_size']
-        }), 200
+        from uploads import start_chunked_upload  # type: ignore
+        result, code = start_chunked_upload(session['user_id'], request.get_json(silent=True) or {})
+        return jsonify(result), code
 
     @app.route('/api/chunk/upload', methods=['POST'])
     def chunk_upload():
         if 'user_id' not in session:
             return jsonify({'error': 'No autorizado'}), 401
-        upload_id = request.form.get('upload_id')
-        try:
-            chunk_index = int(request.form.get('chunk_index', -1))
-        except ValueError:
-            return jsonify({'error': 'chunk_index inválido'}), 400
-        chunk = request.files.get('chunk')
-        if not upload_id or chunk_index < 0 or not chunk:
-            return jsonify({'error': 'Parámetros incompletos'}), 400
-        from uploads import append_chunk  # type: ignore
-        data = chunk.read()
-        result, code = append_chunk(session['user_id'], upload_id, chunk_index, data)
+        from uploads import handle_chunk_stream  # type: ignore
+        result, code = handle_chunk_stream(session['user_id'])
+        return jsonify(result), code
+
+    @app.route('/api/chunk/upload/<upload_id>/<int:chunk_index>', methods=['PUT'])
+    def chunk_upload_raw(upload_id, chunk_index):
+        """Chunk como cuerpo crudo (application/octet-stream)"""
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from uploads import handle_chunk_stream  # type: ignore
+        result, code = handle_chunk_stream(session['user_id'], upload_id, chunk_index)
+        return jsonify(result), code
+
+    @app.route('/api/chunk/status/<upload_id>', methods=['GET'])
+    def chunk_status(upload_id):
+        """Rangos ya recibidos de una subida por chunks (para reanudarla)"""
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from uploads import upload_status  # type: ignore
+        result, code = upload_status(session['user_id'], upload_id)
         return jsonify(result), code
 
     @app.route('/api/chunk/finalize', methods=['POST'])
@@ -594,6 +760,43 @@ def main():
         result, code = finalize_resumable_upload(session['user_id'], upload_id)
         return jsonify(result), code
 
+    # -------------------- Protocolo tus 1.0 (clientes estándar) --------------------
+    @app.route('/api/tus/', methods=['OPTIONS', 'POST'])
+    def tus_collection():
+        from tus import dispatch  # type: ignore
+        return dispatch(_api_user_id())
+
+    @app.route('/api/tus/<upload_id>', methods=['OPTIONS', 'HEAD', 'PATCH', 'DELETE', 'POST'])
+    def tus_upload(upload_id):
+        from tus import dispatch  # type: ignore
+        return dispatch(_api_user_id(), upload_id)
+
+    # -------------------- Tokens de API del usuario --------------------
+    @app.route('/api/tokens', methods=['GET', 'POST'])
+    def api_tokens():
+        """Listar o crear tokens personales (el token sólo se muestra al crearlo)"""
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from db_logic import create_api_token, get_user_api_tokens  # type: ignore
+        if request.method == 'GET':
+            return jsonify({'tokens': get_user_api_tokens(session['user_id'])})
+        data = request.get_json(silent=True) or {}
+        name = str(data.get('name') or '').strip()[:100] or None
+        token = 'ft_' + secrets.token_urlsafe(32)
+        token_id = create_api_token(session['user_id'], _token_hash(token), name, datetime.now().isoformat())
+        if token_id is None:
+            return jsonify({'error': 'No se pudo crear el token'}), 500
+        return jsonify({'id': token_id, 'name': name, 'token': token}), 201
+
+    @app.route('/api/tokens/<int:token_id>', methods=['DELETE'])
+    def api_token_revoke(token_id):
+        if 'user_id' not in session:
+            return jsonify({'error': 'No autorizado'}), 401
+        from db_logic import delete_api_token  # type: ignore
+        if not delete_api_token(session['user_id'], token_id):
+            return jsonify({'error': 'Token no encontrado'}), 404
+        return jsonify({'success': True})
+
     @app.route("/api/delete_file", methods=["POST"])
     def delete_file():
         """Endpoint para eliminar archivos vía AJAX"""
@@ -609,14 +812,24 @@ def main():
 
     @app.route("/api/cleanup_expired", methods=["POST"])
     def api_cleanup_expired():
-        """Endpoint para limpiar archivos expirados manualmente"""
+        """Endpoint para adelantar el barrido de archivos expirados.
+
+        El barrido global corre en segundo plano (sweeper.py); la petición sólo lo despierta.
+        Sin barrido en segundo plano se limpian únicamente los archivos del propio usuario.
+        """
         if 'user_id' not in session:
             return jsonify({'error': 'No autorizado'}), 401
         
         try:
+            from sweeper import request_sweep # type: ignore
+            if request_sweep():
+                return jsonify({
+                    'success': True,
+                    'message': 'Limpieza de archivos expirados programada'
+                }), 202
+
             from uploads import cleanup_expired_files # type: ignore
             cleaned_files = cleanup_expired_files(session['user_id'])
-            
             if cleaned_files:
                 return jsonify({
                     'success': True, 
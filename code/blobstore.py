@@ -0,0 +1,132 @@
+"""
+Almacén de contenido direccionado por hash (deduplicación).
+
+Cada contenido distinto se guarda una sola vez en `.blobs/<aa>/<bb>/<sha256>`; las entradas
+del catálogo (`archivos`) lo referencian por content_hash y la tabla `blobs` lleva el
+recuento de referencias. Registrar un duplicado cuesta un INSERT y borrar un archivo sólo
+elimina el blob cuando desaparece su última referencia. Las variantes comprimidas para
+descargas (`<sha256>.gz`, `.br`, `.zst`, ver variants.py) viven junto al blob y se van con él.
+
+Los archivos nunca se crean ni se borran dentro de la transacción que cambia el catálogo: el
+blob se coloca antes (place_blob) y los que quedan sin referencias se borran después del
+commit (db_logic.reap_blobs), así un rollback no deja filas sin archivo.
+"""
+import os
+import uuid
+import errno
+import shutil
+import diskio  # type: ignore
+
+BLOB_FOLDER = os.environ.get('BLOB_FOLDER', os.path.join(os.environ.get('UPLOAD_FOLDER', '/app/uploads'), '.blobs'))
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+# Content-Encoding -> sufijo de la variante cacheada
+VARIANT_SUFFIXES = {'zstd': '.zst', 'br': '.br', 'gzip': '.gz'}
+
+
+def blob_path(content_hash):
+    return os.path.join(BLOB_FOLDER, content_hash[:2], content_hash[2:4], content_hash)
+
+
+def variant_path(path, coding):
+    return path + VARIANT_SUFFIXES[coding]
+
+
+def existing_blob_path(content_hash):
+    """Ruta del blob si existe en disco (None para archivos anteriores al almacén)."""
+    if not content_hash:
+        return None
+    path = blob_path(content_hash)
+    return path if os.path.isfile(path) else None
+
+
+def _copy_into_place(source_path, target):
+    # Otro volumen: copia completa y fsync en un temporal junto al destino, luego se enlaza
+    if os.path.exists(target):
+        return False
+    tmp = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(source_path, 'rb') as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.link(tmp, target)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        _remove_if_exists(tmp)
+
+
+def _link_into_place(source_path, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source_path, target)
+    except FileExistsError:
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return _copy_into_place(source_path, target)
+    return True
+
+
+def place_blob(source_path, content_hash):
+    """Colocar `source_path` como blob antes de registrarlo en el catálogo.
+
+    Se enlaza (hard link; copia + fsync si el almacén está en otro volumen), de modo que
+    `source_path` sigue intacto hasta que el llamador confirma el registro y lo borra.
+    Retorna True si creó el blob y False si ya existía.
+    """
+    target = blob_path(content_hash)
+    return diskio.run(target, _link_into_place, source_path, target)
+
+
+def blob_placer(source_path):
+    """Callback store_blob para db_logic.insert_blob_file_record.
+
+    Se llama bajo el lock de escritura cuando el blob no tiene fila: si entretanto un
+    borrado (db_logic.reap_blobs) se llevó el archivo, se vuelve a colocar desde `source_path`.
+    """
+    def store(content_hash):
+        if not os.path.isfile(blob_path(content_hash)):
+            place_blob(source_path, content_hash)
+    return store
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_with_variants(path):
+    _remove_if_exists(path)
+    for suffix in VARIANT_SUFFIXES.values():
+        _remove_if_exists(path + suffix)
+
+
+def remove_blob(content_hash):
+    """Callback de borrado para blobs que se quedan sin referencias (y sus variantes)."""
+    path = blob_path(content_hash)
+    diskio.run(path, _remove_with_variants, path)
+
+
+def blob_trasher(trash_dir):
+    """Callback de borrado que aparta el blob a `trash_dir` (un rename) para borrarlo después.
+
+    Si la papelera está en otro volumen se borra directamente.
+    """
+    def trash(content_hash):
+        path = blob_path(content_hash)
+        for suffix in ('',) + tuple(VARIANT_SUFFIXES.values()):
+            try:
+                diskio.run(path, os.rename, path + suffix, os.path.join(trash_dir, content_hash + suffix))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                remove_blob(content_hash)
+                return
+    return trash
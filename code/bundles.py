@@ -0,0 +1,247 @@
+"""
+Descarga de varios archivos del usuario en un solo paquete generado al vuelo.
+
+- ZIP64 sin compresión (stored) o tar (PAX), construidos pieza a pieza mientras se envían:
+  nunca se escriben en disco y la memoria no depende del tamaño total.
+- Ambos formatos tienen Content-Length exacto (se conoce el tamaño de cada archivo).
+- tar es determinista byte a byte (las cabeceras salen del catálogo), así que admite ETag,
+  If-Range y Range de un tramo para reanudar. En ZIP los CRC-32 se calculan durante el
+  envío (data descriptor), por lo que se anuncia `Accept-Ranges: none`.
+"""
+import os
+import re
+import struct
+import tarfile
+import zlib
+import hashlib
+from datetime import datetime
+from flask import request, Response  # type: ignore
+import diskio  # type: ignore
+from downloads import parse_ranges, content_disposition, READ_CHUNK_SIZE  # type: ignore
+from uploads import load_file_metadata, _download_target, _is_record_expired, count_download  # type: ignore
+
+BUNDLE_FORMATS = ('zip', 'tar')
+BUNDLE_MAX_FILES = int(os.environ.get('BUNDLE_MAX_FILES', '1000'))
+
+_TAR_BLOCK = 512
+_ZIP_FLAGS = 0x08 | 0x800  # data descriptor + nombres UTF-8
+_ZIP_VERSION = 45          # ZIP64
+_ZIP_MADE_BY = (3 << 8) | _ZIP_VERSION  # Unix
+_ZIP_LOCAL_SIZE = 30 + 20       # cabecera local + extra ZIP64 (sin el nombre)
+_ZIP_DESCRIPTOR_SIZE = 24
+_ZIP_CENTRAL_SIZE = 46 + 28     # entrada del directorio central + extra ZIP64 (sin el nombre)
+_ZIP_END_SIZE = 56 + 20 + 22    # registro ZIP64, localizador y EOCD clásico
+
+
+class BundleEntry:
+    def __init__(self, name, path, size, mtime, content_hash):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.content_hash = content_hash
+
+
+def _archive_name(display_name, used):
+    """Ruta relativa segura dentro del paquete; los duplicados reciben ` (2)`, ` (3)`..."""
+    parts = [p for p in re.split(r'[\\/]+', display_name) if p not in ('', '.', '..')]
+    name = '/'.join(parts) or 'archivo'
+    base, dot, ext = name.rpartition('.')
+    if not dot or '/' in ext:
+        base, ext = name, ''
+    candidate, n = name, 1
+    while candidate.lower() in used:
+        n += 1
+        candidate = f'{base} ({n}).{ext}' if ext else f'{base} ({n})'
+    used.add(candidate.lower())
+    return candidate
+
+
+def plan_bundle(user_id, filenames):
+    """Resolver los archivos pedidos. Retorna (entradas, nombres no encontrados)."""
+    entries, missing, used = [], [], set()
+    now = datetime.now()
+    seen = set()
+    for filename in filenames:
+        if filename in seen:
+            continue
+        seen.add(filename)
+        record = load_file_metadata(user_id, filename)
+        target = _download_target(user_id, filename, record) if record and not _is_record_expired(record, now) else None
+        if not target:
+            missing.append(filename)
+            continue
+        path, display_name, content_hash = target
+        try:
+            mtime = datetime.fromisoformat(record['upload_date'])
+        except (TypeError, ValueError):
+            mtime = datetime.fromtimestamp(os.path.getmtime(path))
+        entries.append(BundleEntry(_archive_name(display_name, used), path, os.path.getsize(path), mtime, content_hash))
+    return entries, missing
+
+
+def _read_file(path, offset, length):
+    fd = diskio.run(path, os.open, path, os.O_RDONLY)
+    try:
+        while length > 0:
+            data = diskio.run(path, os.pread, fd, min(READ_CHUNK_SIZE, length), offset)
+            if not data:
+                raise IOError(f'Archivo más corto de lo esperado: {path}')
+            offset += len(data)
+            length -= len(data)
+            yield data
+    finally:
+        os.close(fd)
+
+
+# ------------------------------------ tar ------------------------------------
+def _tar_header(entry):
+    info = tarfile.TarInfo(entry.name)
+    info.size = entry.size
+    info.mtime = int(entry.mtime.timestamp())
+    info.mode = 0o644
+    info.type = tarfile.REGTYPE
+    info.uname = info.gname = ''
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+
+
+def tar_segments(entries):
+    """Lista de tramos (bytes o (ruta, tamaño)) que forman el tar, en orden."""
+    segments = []
+    for entry in entries:
+        segments.append(_tar_header(entry))
+        segments.append((entry.path, entry.size))
+        if entry.size % _TAR_BLOCK:
+            segments.append(b'\0' * (_TAR_BLOCK - entry.size % _TAR_BLOCK))
+    segments.append(b'\0' * (2 * _TAR_BLOCK))
+    return segments
+
+
+def _segment_size(segment):
+    return segment[1] if isinstance(segment, tuple) else len(segment)
+
+
+def _tar_etag(segments, entries):
+    h = hashlib.sha256()
+    for segment in segments:
+        if isinstance(segment, bytes):
+            h.update(segment)
+    for entry in entries:
+        h.update((entry.content_hash or f'{entry.path}:{os.path.getmtime(entry.path)}').encode('utf-8'))
+    return f'"tar-{h.hexdigest()[:40]}"'
+
+
+def iter_segments(segments, start, length):
+    """Entregar [start, start+length) del paquete leyendo sólo los tramos necesarios."""
+    pos = 0
+    for segment in segments:
+        size = _segment_size(segment)
+        if length <= 0:
+            return
+        if pos + size <= start:
+            pos += size
+            continue
+        skip = max(0, start - pos)
+        take = min(size - skip, length)
+        if isinstance(segment, tuple):
+            yield from _read_file(segment[0], skip, take)
+        else:
+            yield segment[skip:skip + take]
+        start += take
+        length -= take
+        pos += size
+
+
+# ------------------------------------ ZIP64 ------------------------------------
+def _dos_datetime(dt):
+    dt = max(dt, datetime(1980, 1, 1))
+    return (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2), ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+
+
+def zip_size(entries):
+    names = sum(len(e.name.encode('utf-8')) for e in entries)
+    return (sum(_ZIP_LOCAL_SIZE + _ZIP_DESCRIPTOR_SIZE + _ZIP_CENTRAL_SIZE + e.size for e in entries)
+            + 2 * names + _ZIP_END_SIZE)
+
+
+def iter_zip(entries):
+    """ZIP64 stored en streaming: cabecera local, datos y data descriptor con el CRC-32."""
+    offset = 0
+    central = []
+    for entry in entries:
+        name = entry.name.encode('utf-8')
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        local = struct.pack('<IHHHHHIIIHH', 0x04034b50, _ZIP_VERSION, _ZIP_FLAGS, 0, dos_time, dos_date,
+                            0, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 20)
+        yield local + name + struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        crc = 0
+        for piece in _read_file(entry.path, 0, entry.size):
+            crc = zlib.crc32(piece, crc)
+            yield piece
+        yield struct.pack('<IIQQ', 0x08074b50, crc, entry.size, entry.size)
+        central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, _ZIP_MADE_BY, _ZIP_VERSION, _ZIP_FLAGS, 0,
+                                   dos_time, dos_date, crc, 0xFFFFFFFF, 0xFFFFFFFF, len(name), 28, 0, 0, 0,
+                                   0o100644 << 16, 0xFFFFFFFF)
+                       + name + struct.pack('<HHQQQ', 0x0001, 24, entry.size, entry.size, offset))
+        offset += _ZIP_LOCAL_SIZE + len(name) + entry.size + _ZIP_DESCRIPTOR_SIZE
+    directory = b''.join(central)
+    yield directory
+    count = len(entries)
+    end_offset = offset + len(directory)
+    yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, _ZIP_MADE_BY, _ZIP_VERSION, 0, 0,
+                      count, count, len(directory), offset)
+    yield struct.pack('<IIQI', 0x07064b50, 0, end_offset, 1)
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                      min(len(directory), 0xFFFFFFFF), min(offset, 0xFFFFFFFF), 0)
+
+
+# ------------------------------------ Respuesta ------------------------------------
+def bundle_response(entries, fmt, archive_name):
+    """Respuesta completa o parcial (Range, sólo tar) con el paquete generado al vuelo."""
+    headers = {'Content-Disposition': content_disposition(f'{archive_name}.{fmt}')}
+    if fmt == 'zip':
+        headers['Accept-Ranges'] = 'none'
+        headers['Content-Length'] = str(zip_size(entries))
+        return Response(iter_zip(entries), status=200, mimetype='application/zip',
+                        headers=headers, direct_passthrough=True)
+
+    segments = tar_segments(entries)
+    total = sum(_segment_size(s) for s in segments)
+    etag = _tar_etag(segments, entries)
+    headers['Accept-Ranges'] = 'bytes'
+    headers['ETag'] = etag
+    ranges = parse_ranges(request.headers.get('Range'), total)
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range and if_range.strip() != etag:
+        ranges = None
+    if ranges == []:
+        return Response(status=416, headers={'Content-Range': f'bytes */{total}'})
+    # Varios rangos sobre un paquete generado: se responde completo (permitido por RFC 9110)
+    if not ranges or len(ranges) > 1:
+        headers['Content-Length'] = str(total)
+        return Response(iter_segments(segments, 0, total), status=200, mimetype='application/x-tar',
+                        headers=headers, direct_passthrough=True)
+    start, end = ranges[0]
+    headers['Content-Range'] = f'bytes {start}-{end}/{total}'
+    headers['Content-Length'] = str(end - start + 1)
+    return Response(iter_segments(segments, start, end - start + 1), status=206, mimetype='application/x-tar',
+                    headers=headers, direct_passthrough=True)
+
+
+def handle_bundle_download(user_id, filenames, fmt='zip', archive_name=None):
+    """Paquete con archivos del usuario. Retorna una Response o (dict, status) si no procede."""
+    fmt = (fmt or 'zip').lower()
+    if fmt not in BUNDLE_FORMATS:
+        return {'error': f'Formato no soportado (usa {" o ".join(BUNDLE_FORMATS)})'}, 400
+    filenames = [f for f in filenames if f]
+    if not filenames:
+        return {'error': 'No se indicaron archivos'}, 400
+    if len(filenames) > BUNDLE_MAX_FILES:
+        return {'error': f'Demasiados archivos (máximo {BUNDLE_MAX_FILES})'}, 400
+    entries, missing = plan_bundle(user_id, filenames)
+    if missing:
+        return {'error': 'Archivos no encontrados', 'missing': missing}, 404
+    archive_name = re.sub(r'[\\/"\r\n]+', '_', archive_name or '') or f"archivos-{datetime.now().strftime('%Y%m%d')}"
+    resp = bundle_response(entries, fmt, archive_name)
+    count_download(resp.status_code, request.headers.get('Range'))
+    return resp
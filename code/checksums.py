@@ -0,0 +1,51 @@
+"""
+Utilidades de integridad: SHA-256 calculado durante la escritura y cabeceras asociadas.
+"""
+import re
+import base64
+import hashlib
+import binascii
+
+HASH_ALGORITHM = 'sha256'
+
+_HEX_SHA256 = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+def parse_sha256(value):
+    """Normalizar un checksum SHA-256 recibido del cliente a hex en minúsculas.
+
+    Acepta hex plano, `sha256=<hex>`, `sha-256=<base64>` y `sha-256=:<base64>:` (Content-Digest).
+    Retorna None si no hay valor y lanza ValueError si el formato no es válido.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    algo, sep, encoded = value.partition('=')
+    if sep and encoded.strip('='):
+        # Formato `<algoritmo>=<valor>` (un base64 plano sólo lleva '=' de relleno al final)
+        if algo.strip().lower() not in ('sha256', 'sha-256'):
+            raise ValueError(f'Algoritmo de checksum no soportado: {algo}')
+        value = encoded.strip().strip(':')
+    if _HEX_SHA256.match(value):
+        return value.lower()
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError('Checksum SHA-256 inválido')
+    if len(raw) != 32:
+        raise ValueError('Checksum SHA-256 inválido')
+    return raw.hex()
+
+
+def digest_headers(hex_digest):
+    """Cabeceras de descarga para un contenido con SHA-256 conocido (ETag fuerte + Digest)."""
+    b64 = base64.b64encode(bytes.fromhex(hex_digest)).decode('ascii')
+    return {
+        'ETag': f'"sha256-{hex_digest}"',
+        'Digest': f'sha-256={b64}',
+        'Repr-Digest': f'sha-256=:{b64}:',
+    }
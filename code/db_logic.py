@@ -1,21 +1,19 @@
+import json
 import sqlite3
 from typing import Optional, Dict, List
 from werkzeug.security import check_password_hash  # type: ignore
-
-DB_PATH = '/app/db/database.db'
+import db_pool  # type: ignore
+from db_pool import DB_PATH  # type: ignore  # noqa: F401 (compatibilidad)
+from migrations import run_migrations, has_column, has_table  # type: ignore
 
 
 def insert_user(username, email, password):
     """Inserta un nuevo usuario estado pendiente por defecto."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+        db_pool.execute(
             'INSERT INTO usuarios (nombre, email, password, estado) VALUES (?, ?, ?, ?)',
             (username, email, password, 'pendiente'),
         )
-        conn.commit()
-        conn.close()
         return True
     except sqlite3.IntegrityError:
         return False  # Email ya existe
@@ -27,11 +25,7 @@ def insert_user(username, email, password):
 def clear_db():
     """Elimina todos los usuarios de la base de datos."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM usuarios')
-        conn.commit()
-        conn.close()
+        db_pool.execute('DELETE FROM usuarios')
         return True
     except Exception as e:
         print(f"Error al limpiar la base de datos: {e}")
@@ -44,11 +38,7 @@ def check_user_login(email: str, password_plain: str) -> Optional[Dict[str, str]
     Busca por email, recupera hash y verifica con check_password_hash.
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, nombre, password, estado FROM usuarios WHERE email = ?', (email,))
-        row = cursor.fetchone()
-        conn.close()
+        row = db_pool.fetchone('SELECT id, nombre, password, estado FROM usuarios WHERE email = ?', (email,))
         if not row:
             return None
         user_id, nombre, stored_hash, estado = row
@@ -66,13 +56,7 @@ def set_user_status(user_id: int, status: str) -> bool:
     if status not in {'activo', 'rechazado', 'pendiente', 'suspendido'}:
         return False
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE usuarios SET estado=? WHERE id=?', (status, user_id))
-        conn.commit()
-        ok = cursor.rowcount > 0
-        conn.close()
-        return ok
+        return db_pool.execute('UPDATE usuarios SET estado=? WHERE id=?', (status, user_id)) > 0
     except Exception as e:
         print(f"Error actualizando estado: {e}")
         return False
@@ -80,11 +64,7 @@ def set_user_status(user_id: int, status: str) -> bool:
 
 def get_user_by_id(user_id: int) -> Optional[Dict[str, str]]:
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, nombre, email, estado FROM usuarios WHERE id=?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        row = db_pool.fetchone('SELECT id, nombre, email, estado FROM usuarios WHERE id=?', (user_id,))
         if not row:
             return None
         return {"id": row[0], "nombre": row[1], "email": row[2], "estado": row[3]}
@@ -93,163 +73,256 @@ def get_user_by_id(user_id: int) -> Optional[Dict[str, str]]:
         return None
 
 
+def get_user_by_email(email: str) -> Optional[Dict[str, str]]:
+    try:
+        row = db_pool.fetchone('SELECT id, nombre, email, estado FROM usuarios WHERE email=?', (email,))
+        if not row:
+            return None
+        return {"id": row[0], "nombre": row[1], "email": row[2], "estado": row[3]}
+    except Exception as e:
+        print(f"Error get_user_by_email: {e}")
+        return None
+
+
 def migrate_database():
-    """Ejecuta migraciones pendientes de la base de datos."""
+    """Ejecuta migraciones pendientes de la base de datos (ver migrations.py)."""
     try:
-        print("[MIGRATION] Iniciando migraciones de base de datos...")
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Verificar columnas existentes
-        cursor.execute("PRAGMA table_info(usuarios)")
-        columns = [row[1] for row in cursor.fetchall()]
-        print(f"[MIGRATION] Columnas actuales: {columns}")
-        
-        # Añadir fecha_registro si no existe
-        if 'fecha_registro' not in columns:
-            print("[MIGRATION] Añadiendo columna fecha_registro...")
-            cursor.execute("ALTER TABLE usuarios ADD COLUMN fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            # Actualizar registros existentes con fecha actual
-            cursor.execute("UPDATE usuarios SET fecha_registro = CURRENT_TIMESTAMP WHERE fecha_registro IS NULL")
-            print("[MIGRATION] Columna fecha_registro añadida")
-        else:
-            print("[MIGRATION] Columna fecha_registro ya existe")
-        
-        conn.commit()
-        conn.close()
-        print("[MIGRATION] Migraciones completadas exitosamente")
+        run_migrations()
         return True
-        
     except Exception as e:
         print(f"[MIGRATION] Error en migración: {e}")
         return False
 
 
-def get_all_users(search: str = "", estado_filter: str = "") -> List[Dict]:
-    """Obtiene todos los usuarios con filtros opcionales."""
+USERS_PAGE_SIZE = 50
+USERS_PAGE_MAX = 500
+
+
+def _fts_phrase(search: str) -> str:
+    # Frase entre comillas: coincide como subcadena en nombre o email (tokenizador trigram)
+    return '"' + search.replace('"', '""') + '"'
+
+
+def get_users_page(search: str = "", estado_filter: str = "", cursor: Optional[int] = None,
+                   back: Optional[int] = None, limit: int = USERS_PAGE_SIZE) -> Dict:
+    """Página de usuarios, más recientes primero, con paginación por clave (id).
+
+    `cursor` pide la página siguiente (ids menores); `back`, la anterior (ids mayores).
+    La búsqueda usa el índice FTS5 (trigram) cuando existe y el texto tiene al menos
+    3 caracteres; si no, LIKE. Retorna {'users', 'next_cursor', 'prev_cursor', 'limit'}.
+    """
+    limit = max(1, min(int(limit or USERS_PAGE_SIZE), USERS_PAGE_MAX))
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Primero verificar qué columnas existen
-        cursor.execute("PRAGMA table_info(usuarios)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        # Construir query basado en columnas disponibles
-        base_columns = "id, nombre, email, estado"
-        if 'fecha_registro' in columns:
-            query_columns = base_columns + ", fecha_registro"
-            has_fecha = True
-        else:
-            query_columns = base_columns
-            has_fecha = False
-            print("[DEBUG] Columna fecha_registro no encontrada, usando N/A")
-        
-        # Query base
-        query = f"SELECT {query_columns} FROM usuarios"
-        params = []
+        columns = "id, nombre, email, estado"
+        has_fecha = has_column('usuarios', 'fecha_registro')
+        if has_fecha:
+            columns += ", fecha_registro"
         conditions = []
-        
-        # Aplicar filtros
+        params: list = []
         if search:
-            conditions.append("(nombre LIKE ? OR email LIKE ?)")
-            search_param = f"%{search}%"
-            params.extend([search_param, search_param])
-            
+            if has_table('usuarios_fts') and len(search) >= 3:
+                conditions.append("id IN (SELECT rowid FROM usuarios_fts WHERE usuarios_fts MATCH ?)")
+                params.append(_fts_phrase(search))
+            else:
+                conditions.append("(nombre LIKE ? OR email LIKE ?)")
+                search_param = f"%{search}%"
+                params.extend([search_param, search_param])
         if estado_filter:
             conditions.append("estado = ?")
             params.append(estado_filter)
-        
-        # Agregar WHERE si hay condiciones
+        going_back = back is not None and cursor is None
+        if going_back:
+            conditions.append("id > ?")
+            params.append(back)
+        elif cursor is not None:
+            conditions.append("id < ?")
+            params.append(cursor)
+
+        # Cuota y uso por usuario (mantenido por triggers) al final de cada fila
+        usage = ("(SELECT max_bytes FROM cuotas c WHERE c.user_id = usuarios.id), "
+                 "(SELECT max_archivos FROM cuotas c WHERE c.user_id = usuarios.id), "
+                 "(SELECT archivos FROM uso_usuario u WHERE u.user_id = usuarios.id), "
+                 "(SELECT bytes FROM uso_usuario u WHERE u.user_id = usuarios.id)")
+        query = f"SELECT {columns}, {usage} FROM usuarios"
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
-            
-        query += " ORDER BY id DESC"  # Los más recientes primero
-        
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        
-        print(f"[DEBUG] get_all_users - Encontrados {len(rows)} usuarios")
-        
-        users = []
-        for row in rows:
-            user_data = {
-                "id": row[0],
-                "nombre": row[1],
-                "email": row[2],
-                "estado": row[3],
-                "fecha_registro": row[4] if has_fecha and len(row) > 4 and row[4] else 'N/A'
-            }
-            users.append(user_data)
-        
-        conn.close()
-        return users
-        
+        query += " ORDER BY id ASC" if going_back else " ORDER BY id DESC"
+        query += " LIMIT ?"
+        params.append(limit + 1)
+        rows = db_pool.fetchall(query, params)
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if going_back:
+            rows.reverse()
+        users = [{
+            "id": row[0],
+            "nombre": row[1],
+            "email": row[2],
+            "estado": row[3],
+            "fecha_registro": row[4] if has_fecha and row[4] else 'N/A',
+            "cuota_bytes": row[-4],
+            "cuota_archivos": row[-3],
+            "archivos": row[-2] or 0,
+            "bytes": row[-1] or 0
+        } for row in rows]
+        if going_back:
+            next_cursor = users[-1]["id"] if users else None
+            prev_cursor = users[0]["id"] if users and more else None
+        else:
+            next_cursor = users[-1]["id"] if users and more else None
+            prev_cursor = users[0]["id"] if users and cursor is not None else None
+        return {"users": users, "next_cursor": next_cursor, "prev_cursor": prev_cursor, "limit": limit}
+
     except Exception as e:
-        print(f"Error get_all_users: {e}")
-        return []
+        print(f"Error get_users_page: {e}")
+        return {"users": [], "next_cursor": None, "prev_cursor": None, "limit": limit}
 
 
 def get_user_stats() -> Dict[str, int]:
-    """Obtiene estadísticas de usuarios y archivos."""
+    """Obtiene estadísticas de usuarios y archivos.
+
+    Lee la tabla `contadores`, que los triggers mantienen al día en cada alta, cambio de
+    estado o borrado, en lugar de recorrer usuarios y archivos en cada visita al panel.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Conteo por estado
-        cursor.execute("SELECT estado, COUNT(*) FROM usuarios GROUP BY estado")
-        estado_counts = dict(cursor.fetchall())
-        
-        # Total de archivos (si la tabla existe)
-        try:
-            cursor.execute("SELECT COUNT(*) FROM archivos WHERE deleted_at IS NULL OR deleted_at = ''")
-            total_archivos = cursor.fetchone()[0]
-        except:
-            total_archivos = 0
-        
-        conn.close()
-        
+        counters = dict(db_pool.fetchall("SELECT clave, valor FROM contadores"))
+        activos = counters.get("usuarios:activo", 0)
+        pendientes = counters.get("usuarios:pendiente", 0)
+        rechazados = counters.get("usuarios:rechazado", 0)
+        total_usuarios = sum(v for k, v in counters.items() if k.startswith("usuarios:"))
         return {
-            "activos": estado_counts.get("activo", 0),
-            "pendientes": estado_counts.get("pendiente", 0), 
-            "rechazados": estado_counts.get("rechazado", 0),
-            "total_archivos": total_archivos
+            "activos": activos,
+            "pendientes": pendientes,
+            "rechazados": rechazados,
+            "total_usuarios": total_usuarios,
+            "total_archivos": counters.get("archivos", 0),
+            "total_bytes": counters.get("bytes", 0),
+            "blob_bytes": counters.get("blob_bytes", 0)
         }
     except Exception as e:
         print(f"Error get_user_stats: {e}")
-        return {"activos": 0, "pendientes": 0, "rechazados": 0, "total_archivos": 0}
+        return {"activos": 0, "pendientes": 0, "rechazados": 0, "total_usuarios": 0,
+                "total_archivos": 0, "total_bytes": 0, "blob_bytes": 0}
 
 
-def delete_user_completely(user_id: int) -> bool:
-    """Elimina un usuario y todos sus archivos asociados."""
+def get_user_quota(user_id: int) -> Dict[str, Optional[int]]:
+    """Cuota propia del usuario (None = usar la de por defecto) y su uso actual según el catálogo."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Verificar si existe tabla de archivos antes de eliminar
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='archivos'")
-        table_exists = cursor.fetchone() is not None
-        
-        if table_exists:
-            # Eliminar archivos de la tabla si existe
-            cursor.execute('DELETE FROM archivos WHERE user_id = ?', (user_id,))
-            print(f"[DEBUG] Eliminados archivos de BD para usuario {user_id}")
-        
-        # Eliminar el usuario
-        cursor.execute('DELETE FROM usuarios WHERE id = ?', (user_id,))
-        
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
+        row = db_pool.fetchone(
+            "SELECT c.max_bytes, c.max_archivos, COALESCE(u.bytes, 0), COALESCE(u.archivos, 0) "
+            "FROM (SELECT ? AS id) AS k "
+            "LEFT JOIN cuotas c ON c.user_id = k.id LEFT JOIN uso_usuario u ON u.user_id = k.id",
+            (user_id,)
+        )
+        return {"max_bytes": row[0], "max_archivos": row[1], "bytes": row[2], "archivos": row[3]}
+    except Exception as e:
+        print(f"Error get_user_quota: {e}")
+        return {"max_bytes": None, "max_archivos": None, "bytes": 0, "archivos": 0}
+
+
+def get_reserved_upload_bytes(user_id: int, exclude: Optional[List[str]] = None) -> int:
+    """Bytes reservados (prealocados) por las subidas en curso del usuario, salvo `exclude`.
+
+    Las subidas tus ya registradas en el catálogo (final_filename) no cuentan: sus bytes
+    están en uso_usuario.
+    """
+    exclude = list(exclude or [])
+    try:
+        row = db_pool.fetchone(
+            'SELECT COALESCE(SUM(total_size), 0) FROM uploads_in_progress '
+            'WHERE user_id=? AND final_filename IS NULL'
+            + (f' AND upload_id NOT IN ({",".join("?" * len(exclude))})' if exclude else ''),
+            [user_id] + exclude
+        )
+        return row[0]
+    except Exception as e:
+        print(f"Error get_reserved_upload_bytes: {e}")
+        return 0
+
+
+def set_user_quota(user_id: int, max_bytes: Optional[int], max_archivos: Optional[int]) -> bool:
+    """Fijar la cuota de un usuario (None = valor por defecto, 0 = sin límite)."""
+    try:
+        if max_bytes is None and max_archivos is None:
+            db_pool.execute("DELETE FROM cuotas WHERE user_id = ?", (user_id,))
+        else:
+            db_pool.execute(
+                "INSERT INTO cuotas (user_id, max_bytes, max_archivos) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET max_bytes = excluded.max_bytes, max_archivos = excluded.max_archivos",
+                (user_id, max_bytes, max_archivos)
+            )
+        return True
+    except Exception as e:
+        print(f"Error set_user_quota: {e}")
+        return False
+
+
+def record_download(day: str) -> None:
+    """Sumar una descarga a la actividad del día (YYYY-MM-DD)."""
+    try:
+        db_pool.execute(
+            "INSERT INTO actividad_diaria (dia, descargas) VALUES (?, 1) "
+            "ON CONFLICT(dia) DO UPDATE SET descargas = descargas + 1",
+            (day,)
+        )
+    except Exception as e:
+        print(f"Error record_download: {e}")
+
+
+def get_daily_activity(days: int = 14) -> List[Dict]:
+    """Actividad de los últimos `days` días con movimiento, más reciente primero."""
+    try:
+        rows = db_pool.fetchall(
+            "SELECT dia, subidas, bytes_subidos, descargas FROM actividad_diaria ORDER BY dia DESC LIMIT ?",
+            (days,)
+        )
+        return [{"dia": r[0], "subidas": r[1], "bytes_subidos": r[2], "descargas": r[3]} for r in rows]
+    except Exception as e:
+        print(f"Error get_daily_activity: {e}")
+        return []
+
+
+def delete_user_completely(user_id: int, remove_blob=None, remove_dir=None) -> bool:
+    """Elimina un usuario y todos sus archivos asociados.
+
+    Los blobs compartidos sólo se borran (vía `remove_blob`) si este usuario tenía la última referencia.
+    `remove_dir` recibe el directorio del usuario; por defecto se borra aquí mismo con rmtree
+    (el panel de admin lo pasa a la papelera y lo borra en segundo plano, ver delete_jobs.py).
+    """
+    orphans = []
+    try:
+        with db_pool.transaction() as cursor:
+            # Verificar si existe tabla de archivos antes de eliminar
+            if has_table('archivos'):
+                # Eliminar archivos de la tabla si existe
+                cursor.execute('SELECT content_hash FROM archivos WHERE user_id = ? AND content_hash IS NOT NULL', (user_id,))
+                hashes = [r[0] for r in cursor.fetchall()]
+                cursor.execute('DELETE FROM archivos WHERE user_id = ?', (user_id,))
+                print(f"[DEBUG] Eliminados archivos de BD para usuario {user_id}")
+                _release_blob_refs(cursor, hashes, orphans)
+                print(f"[DEBUG] Liberadas {len(hashes)} referencias a blobs ({len(orphans)} sin referencias)")
+            
+            if has_table('api_tokens'):
+                cursor.execute('DELETE FROM api_tokens WHERE user_id = ?', (user_id,))
+
+            # Eliminar el usuario
+            cursor.execute('DELETE FROM usuarios WHERE id = ?', (user_id,))
+            success = cursor.rowcount > 0
         
-        # También eliminar archivos físicos del disco
+        # También eliminar archivos físicos del disco (blobs sin referencias tras el commit)
+        reap_blobs(orphans, remove_blob)
         if success:
             import os
             import shutil
-            user_dir = f"/app/uploads/user_{user_id}"
+            from uploads import UPLOAD_FOLDER  # type: ignore
+            user_dir = os.path.join(UPLOAD_FOLDER, f"user_{user_id}")
             if os.path.exists(user_dir):
                 try:
-                    shutil.rmtree(user_dir)
+                    if remove_dir:
+                        remove_dir(user_dir)
+                    else:
+                        shutil.rmtree(user_dir)
                     print(f"[DEBUG] Directorio {user_dir} eliminado")
                 except Exception as e:
                     print(f"Error eliminando directorio {user_dir}: {e}")
@@ -260,3 +333,654 @@ def delete_user_completely(user_id: int) -> bool:
     except Exception as e:
         print(f"Error delete_user_completely: {e}")
         return False
+
+
+# ------------------------- Catálogo de archivos -------------------------
+FILE_COLUMNS = 'user_id, filename, original_name, size, upload_date, expires_date, share_token, content_hash'
+
+
+def _file_row_to_dict(row) -> Dict:
+    return {
+        "user_id": row[0],
+        "filename": row[1],
+        "original_name": row[2],
+        "size": row[3],
+        "upload_date": row[4],
+        "expires_date": row[5],
+        "share_token": row[6],
+        "content_hash": row[7],
+    }
+
+
+def insert_file_record(user_id: int, filename: str, original_name: str, size: int,
+                       upload_date: str, expires_date: Optional[str], share_token: Optional[str] = None,
+                       content_hash: Optional[str] = None) -> bool:
+    """Registra un archivo subido en el catálogo."""
+    try:
+        db_pool.execute(
+            f'INSERT OR REPLACE INTO archivos ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_id, filename, original_name, size, upload_date, expires_date, share_token, content_hash),
+        )
+        return True
+    except Exception as e:
+        print(f"Error insert_file_record: {e}")
+        return False
+
+
+def import_file_records(records: List[tuple]) -> int:
+    """Inserta en bloque (una transacción) registros ya existentes; ignora duplicados."""
+    try:
+        return db_pool.executemany(
+            f'INSERT OR IGNORE INTO archivos ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            records,
+        )
+    except Exception as e:
+        print(f"Error import_file_records: {e}")
+        return 0
+
+
+def get_file_record(user_id: int, filename: str) -> Optional[Dict]:
+    try:
+        row = db_pool.fetchone(
+            f'SELECT {FILE_COLUMNS} FROM archivos WHERE user_id=? AND filename=?',
+            (user_id, filename),
+        )
+        return _file_row_to_dict(row) if row else None
+    except Exception as e:
+        print(f"Error get_file_record: {e}")
+        return None
+
+
+def find_file_record_by_name(filename: str, now: str) -> Optional[Dict]:
+    """Resuelve un nombre almacenado a su dueño con una sola consulta (idx_archivos_filename).
+
+    Ignora registros expirados; si hubiera colisión entre usuarios gana el más reciente.
+    """
+    try:
+        row = db_pool.fetchone(
+            f'SELECT {FILE_COLUMNS} FROM archivos WHERE filename=? '
+            'AND (expires_date IS NULL OR expires_date > ?) ORDER BY upload_date DESC LIMIT 1',
+            (filename, now),
+        )
+        return _file_row_to_dict(row) if row else None
+    except Exception as e:
+        print(f"Error find_file_record_by_name: {e}")
+        return None
+
+
+def find_file_record_by_token(share_token: str, now: str) -> Optional[Dict]:
+    try:
+        row = db_pool.fetchone(
+            f'SELECT {FILE_COLUMNS} FROM archivos WHERE share_token=? '
+            'AND (expires_date IS NULL OR expires_date > ?)',
+            (share_token, now),
+        )
+        return _file_row_to_dict(row) if row else None
+    except Exception as e:
+        print(f"Error find_file_record_by_token: {e}")
+        return None
+
+
+def user_references_blob(user_id: int, content_hash: str) -> bool:
+    """¿Tiene el usuario algún archivo (aunque haya expirado) con este contenido?"""
+    try:
+        return db_pool.fetchone('SELECT 1 FROM archivos WHERE content_hash=? AND user_id=? LIMIT 1',
+                                (content_hash, user_id)) is not None
+    except Exception as e:
+        print(f"Error user_references_blob: {e}")
+        return False
+
+
+def get_user_file_records(user_id: int) -> List[Dict]:
+    """Archivos del usuario, más recientes primero (usa idx_archivos_user_fecha)."""
+    try:
+        rows = db_pool.fetchall(
+            f'SELECT {FILE_COLUMNS} FROM archivos WHERE user_id=? ORDER BY upload_date DESC',
+            (user_id,),
+        )
+        return [_file_row_to_dict(r) for r in rows]
+    except Exception as e:
+        print(f"Error get_user_file_records: {e}")
+        return []
+
+
+def get_expired_file_records(now: str, user_id: Optional[int] = None, limit: Optional[int] = None) -> List[Dict]:
+    """Archivos con expires_date anterior a `now`, los que antes expiran primero (usa idx_archivos_expira)."""
+    try:
+        query = f'SELECT {FILE_COLUMNS} FROM archivos WHERE expires_date IS NOT NULL AND expires_date < ?'
+        params: list = [now]
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        query += ' ORDER BY expires_date'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        rows = db_pool.fetchall(query, params)
+        return [_file_row_to_dict(r) for r in rows]
+    except Exception as e:
+        print(f"Error get_expired_file_records: {e}")
+        return []
+
+
+def _release_blob_refs(cursor, hashes, orphans) -> None:
+    """Resta una referencia por hash; las filas de `blobs` que quedan a cero se eliminan y su
+    hash se añade a `orphans` para borrar el archivo tras el commit (reap_blobs)."""
+    for content_hash in hashes:
+        if not content_hash:
+            continue
+        cursor.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash=?', (content_hash,))
+        if cursor.rowcount == 0:
+            continue
+        cursor.execute('SELECT refcount FROM blobs WHERE hash=?', (content_hash,))
+        row = cursor.fetchone()
+        if row and row[0] <= 0:
+            cursor.execute('DELETE FROM blobs WHERE hash=?', (content_hash,))
+            orphans.append(content_hash)
+
+
+def reap_blobs(hashes: List[str], remove_blob=None) -> List[str]:
+    """Borrar del disco (vía `remove_blob`) los blobs de `hashes` que siguen sin fila en `blobs`.
+
+    Se llama después del commit que soltó sus referencias. La comprobación se hace bajo
+    BEGIN IMMEDIATE: si otra subida volvió a registrar el mismo contenido entretanto, la
+    fila existe y el archivo se conserva; si se registra después, esa subida vuelve a colocar
+    el blob (blobstore.blob_placer). La transacción no escribe nada, así que un fallo no deja
+    el catálogo apuntando a un archivo borrado. Retorna los hashes borrados.
+    """
+    removed = []
+    if not hashes or not remove_blob:
+        return removed
+    try:
+        with db_pool.transaction() as cursor:
+            for content_hash in dict.fromkeys(hashes):
+                cursor.execute('SELECT 1 FROM blobs WHERE hash=?', (content_hash,))
+                if cursor.fetchone() is None:
+                    remove_blob(content_hash)
+                    removed.append(content_hash)
+    except Exception as e:
+        print(f"Error reap_blobs: {e}")
+    return removed
+
+
+def _insert_blob_file(cursor, orphans, user_id: int, filename: str, original_name: str, size: int,
+                      upload_date: str, expires_date: Optional[str], share_token: Optional[str],
+                      content_hash: str, store_blob) -> bool:
+    # Un registro reemplazado (mismo nombre) suelta su referencia
+    cursor.execute('SELECT content_hash FROM archivos WHERE user_id=? AND filename=?', (user_id, filename))
+    previous = cursor.fetchone()
+    cursor.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash=?', (content_hash,))
+    created = cursor.rowcount == 0
+    if created:
+        store_blob(content_hash)
+        cursor.execute(
+            'INSERT INTO blobs (hash, size, refcount, created_at) VALUES (?, ?, 1, ?)',
+            (content_hash, size, upload_date),
+        )
+    cursor.execute(
+        f'INSERT OR REPLACE INTO archivos ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (user_id, filename, original_name, size, upload_date, expires_date, share_token, content_hash),
+    )
+    if previous:
+        _release_blob_refs(cursor, [previous[0]], orphans)
+    return created
+
+
+def insert_blob_file_record(user_id: int, filename: str, original_name: str, size: int,
+                            upload_date: str, expires_date: Optional[str], share_token: Optional[str],
+                            content_hash: str, store_blob, remove_blob=None) -> Optional[bool]:
+    """Registra un archivo cuyo contenido vive en el almacén de blobs.
+
+    El blob ya debe estar colocado (blobstore.place_blob). Si no tenía fila se crea con
+    refcount 1 y se llama a `store_blob(content_hash)` bajo el lock (ver blob_placer); si la
+    tenía sólo se suma una referencia. Retorna True si el contenido era nuevo, False si se
+    deduplicó y None si hubo error.
+    """
+    orphans = []
+    try:
+        with db_pool.transaction() as cursor:
+            created = _insert_blob_file(cursor, orphans, user_id, filename, original_name, size, upload_date,
+                                        expires_date, share_token, content_hash, store_blob)
+    except Exception as e:
+        print(f"Error insert_blob_file_record: {e}")
+        return None
+    reap_blobs(orphans, remove_blob)
+    return created
+
+
+def insert_blob_file_records(user_id: int, records: List[tuple], remove_blob=None) -> Optional[List[bool]]:
+    """Varios insert_blob_file_record en una sola transacción (subidas por lotes).
+
+    `records` son tuplas (filename, original_name, size, upload_date, expires_date,
+    share_token, content_hash, store_blob). Retorna la lista de `created` o None si hubo
+    error (en ese caso no se registra ninguno).
+    """
+    orphans = []
+    try:
+        with db_pool.transaction() as cursor:
+            created = [_insert_blob_file(cursor, orphans, user_id, *record) for record in records]
+    except Exception as e:
+        print(f"Error insert_blob_file_records: {e}")
+        return None
+    reap_blobs(orphans, remove_blob)
+    return created
+
+
+def delete_file_record(user_id: int, filename: str, remove_blob=None) -> bool:
+    orphans = []
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute('SELECT content_hash FROM archivos WHERE user_id=? AND filename=?', (user_id, filename))
+            row = cursor.fetchone()
+            cursor.execute('DELETE FROM archivos WHERE user_id=? AND filename=?', (user_id, filename))
+            ok = cursor.rowcount > 0
+            if row:
+                _release_blob_refs(cursor, [row[0]], orphans)
+    except Exception as e:
+        print(f"Error delete_file_record: {e}")
+        return False
+    reap_blobs(orphans, remove_blob)
+    return ok
+
+
+def delete_file_records(keys: List[tuple], remove_blob=None) -> int:
+    """Elimina varios registros (user_id, filename) en una sola transacción, liberando sus blobs."""
+    orphans = []
+    try:
+        with db_pool.transaction() as cursor:
+            hashes = []
+            deleted = 0
+            for user_id, filename in keys:
+                cursor.execute('SELECT content_hash FROM archivos WHERE user_id=? AND filename=?', (user_id, filename))
+                row = cursor.fetchone()
+                cursor.execute('DELETE FROM archivos WHERE user_id=? AND filename=?', (user_id, filename))
+                deleted += cursor.rowcount
+                if row:
+                    hashes.append(row[0])
+            _release_blob_refs(cursor, hashes, orphans)
+    except Exception as e:
+        print(f"Error delete_file_records: {e}")
+        return 0
+    reap_blobs(orphans, remove_blob)
+    return deleted
+
+
+# ---------------- Subidas por chunks en curso ----------------
+# Cada chunk aceptado es una fila (offset, size, sha256); las escrituras van en transacciones
+# BEGIN IMMEDIATE, que serializan los chunks concurrentes de una misma subida entre workers.
+
+UPLOAD_COLUMNS = ('upload_id, user_id, original_name, display_name, total_size, chunk_size, total_chunks, '
+                  'content_sha256, declared_chunk_hashes, hash_epoch, started_at, updated_at, '
+                  'protocol, upload_metadata, concat, final_filename')
+
+
+def _load_upload(cursor, upload_id: str, user_id: Optional[int] = None) -> Optional[Dict]:
+    query = f'SELECT {UPLOAD_COLUMNS} FROM uploads_in_progress WHERE upload_id=?'
+    params: list = [upload_id]
+    if user_id is not None:
+        query += ' AND user_id=?'
+        params.append(user_id)
+    row = cursor.execute(query, params).fetchone()
+    if not row:
+        return None
+    chunks = cursor.execute(
+        'SELECT chunk_index, size, sha256 FROM upload_chunks WHERE upload_id=?', (upload_id,)
+    ).fetchall()
+    return {
+        'upload_id': row[0],
+        'user_id': row[1],
+        'original_name': row[2],
+        'display_name': row[3],
+        'total_size': row[4],
+        'chunk_size': row[5],
+        'total_chunks': row[6],
+        'content_sha256': row[7],
+        'declared_chunk_hashes': json.loads(row[8]) if row[8] else [],
+        'hash_epoch': row[9],
+        'started_at': row[10],
+        'updated_at': row[11],
+        'protocol': row[12],  # 'chunks' (/api/chunk) o 'tus' (por offset)
+        'upload_metadata': row[13],
+        'concat': row[14],
+        'final_filename': row[15],
+        'chunks': {r[0]: r[2] for r in chunks},  # índice -> sha256
+        'received_bytes': sum(r[1] for r in chunks),
+    }
+
+
+def create_upload(upload: Dict, chunks: Optional[List[tuple]] = None) -> bool:
+    """Registra una subida nueva; `chunks` (index, offset, size, sha256) sólo al importar estado previo."""
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute(
+                f'INSERT INTO uploads_in_progress ({UPLOAD_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (upload['upload_id'], upload['user_id'], upload['original_name'], upload['display_name'],
+                 upload['total_size'], upload['chunk_size'], upload['total_chunks'], upload.get('content_sha256'),
+                 json.dumps(upload.get('declared_chunk_hashes') or []), upload.get('hash_epoch', 0),
+                 upload['started_at'], upload['started_at'], upload.get('protocol', 'chunks'),
+                 upload.get('upload_metadata'), upload.get('concat'), upload.get('final_filename'))
+            )
+            if chunks:
+                cursor.executemany(
+                    'INSERT INTO upload_chunks (upload_id, chunk_index, offset, size, sha256, received_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [(upload['upload_id'], i, off, size, sha, upload['started_at']) for i, off, size, sha in chunks]
+                )
+        return True
+    except Exception as e:
+        print(f"Error create_upload: {e}")
+        return False
+
+
+def get_upload(user_id: int, upload_id: str) -> Optional[Dict]:
+    try:
+        with db_pool.connection() as conn:
+            return _load_upload(conn, upload_id, user_id)
+    except Exception as e:
+        print(f"Error get_upload: {e}")
+        return None
+
+
+def find_user_uploads(user_id: int, total_size: Optional[int] = None) -> List[Dict]:
+    """Subidas en curso del usuario (opcionalmente sólo las de un tamaño total dado)."""
+    try:
+        with db_pool.connection() as conn:
+            query = 'SELECT upload_id FROM uploads_in_progress WHERE user_id=?'
+            params: list = [user_id]
+            if total_size is not None:
+                query += ' AND total_size=?'
+                params.append(total_size)
+            ids = [r[0] for r in conn.execute(query, params).fetchall()]
+            return [u for u in (_load_upload(conn, upload_id) for upload_id in ids) if u]
+    except Exception as e:
+        print(f"Error find_user_uploads: {e}")
+        return []
+
+
+def record_upload_chunk(upload_id: str, chunk_index: int, offset: int, size: int,
+                        sha256: str, now: str) -> Optional[Dict]:
+    """Marca un chunk como recibido (idempotente) y retorna el estado actualizado de la subida.
+
+    Si el chunk ya constaba con otro contenido se incrementa `hash_epoch`: los hashes
+    incrementales calculados sobre el contenido anterior dejan de valer.
+    """
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute('SELECT sha256 FROM upload_chunks WHERE upload_id=? AND chunk_index=?', (upload_id, chunk_index))
+            previous = cursor.fetchone()
+            cursor.execute(
+                'INSERT OR REPLACE INTO upload_chunks (upload_id, chunk_index, offset, size, sha256, received_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (upload_id, chunk_index, offset, size, sha256, now)
+            )
+            epoch_bump = 1 if previous and previous[0] != sha256 else 0
+            cursor.execute(
+                'UPDATE uploads_in_progress SET hash_epoch = hash_epoch + ?, updated_at = ? WHERE upload_id=?',
+                (epoch_bump, now, upload_id)
+            )
+            if cursor.rowcount == 0:
+                raise LookupError(f'subida {upload_id} no encontrada')
+            return _load_upload(cursor, upload_id)
+    except Exception as e:
+        print(f"Error record_upload_chunk: {e}")
+        return None
+
+
+def remove_upload_chunks(upload_id: str, indexes: List[int], now: str) -> bool:
+    """Desmarca chunks recibidos; si alguno constaba incrementa `hash_epoch`. Retorna si quitó alguno."""
+    try:
+        with db_pool.transaction() as cursor:
+            removed = 0
+            for chunk_index in indexes:
+                cursor.execute('DELETE FROM upload_chunks WHERE upload_id=? AND chunk_index=?', (upload_id, chunk_index))
+                removed += cursor.rowcount
+            if removed:
+                cursor.execute(
+                    'UPDATE uploads_in_progress SET hash_epoch = hash_epoch + 1, updated_at = ? WHERE upload_id=?',
+                    (now, upload_id)
+                )
+        return removed > 0
+    except Exception as e:
+        print(f"Error remove_upload_chunks: {e}")
+        return False
+
+
+def adopt_upload(upload_id: str, original_name: str, display_name: str, declared_chunk_hashes: List[str],
+                 content_sha256: Optional[str], now: str) -> Optional[Dict]:
+    """Reutilizar una subida abortada para un nuevo intento con los hashes declarados.
+
+    Los chunks cuyo hash no coincide con el declarado se desmarcan en la misma transacción.
+    Retorna la subida actualizada con la clave extra `stale` (chunks descartados).
+    """
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute('SELECT chunk_index, sha256 FROM upload_chunks WHERE upload_id=?', (upload_id,))
+            stale = [i for i, sha in cursor.fetchall()
+                     if i >= len(declared_chunk_hashes) or sha != declared_chunk_hashes[i]]
+            cursor.executemany('DELETE FROM upload_chunks WHERE upload_id=? AND chunk_index=?',
+                               [(upload_id, i) for i in stale])
+            cursor.execute(
+                'UPDATE uploads_in_progress SET original_name=?, display_name=?, declared_chunk_hashes=?, '
+                'content_sha256=?, hash_epoch = hash_epoch + ?, updated_at=? WHERE upload_id=?',
+                (original_name, display_name, json.dumps(declared_chunk_hashes), content_sha256,
+                 1 if stale else 0, now, upload_id)
+            )
+            upload = _load_upload(cursor, upload_id)
+            if upload:
+                upload['stale'] = stale
+            return upload
+    except Exception as e:
+        print(f"Error adopt_upload: {e}")
+        return None
+
+
+def delete_upload(upload_id: str) -> bool:
+    try:
+        return db_pool.execute('DELETE FROM uploads_in_progress WHERE upload_id=?', (upload_id,)) > 0
+    except Exception as e:
+        print(f"Error delete_upload: {e}")
+        return False
+
+
+def mark_upload_completed(upload_id: str, final_filename: str, now: str) -> bool:
+    """Subida tus ya registrada en el catálogo: se conserva (sin .part) hasta que caduque para
+    que un HEAD posterior del cliente vea el offset final en lugar de un 404."""
+    try:
+        return db_pool.execute(
+            'UPDATE uploads_in_progress SET final_filename=?, updated_at=? WHERE upload_id=?',
+            (final_filename, now, upload_id)
+        ) > 0
+    except Exception as e:
+        print(f"Error mark_upload_completed: {e}")
+        return False
+
+
+def get_upload_ranges(user_id: int, upload_id: str) -> Optional[List[tuple]]:
+    """Rangos (offset, size) de los chunks recibidos, ordenados por offset; None si la subida no existe."""
+    try:
+        with db_pool.connection() as conn:
+            row = conn.execute('SELECT 1 FROM uploads_in_progress WHERE upload_id=? AND user_id=?',
+                               (upload_id, user_id)).fetchone()
+            if not row:
+                return None
+            return conn.execute('SELECT offset, size FROM upload_chunks WHERE upload_id=? ORDER BY offset',
+                                (upload_id,)).fetchall()
+    except Exception as e:
+        print(f"Error get_upload_ranges: {e}")
+        return None
+
+
+def get_stale_uploads(before: str, limit: int = 500) -> List[Dict]:
+    """Subidas en curso sin actividad desde `before` (ISO), las más antiguas primero."""
+    try:
+        rows = db_pool.fetchall(
+            'SELECT upload_id, user_id, total_size, updated_at FROM uploads_in_progress '
+            'WHERE updated_at < ? ORDER BY updated_at LIMIT ?',
+            (before, limit)
+        )
+        return [{'upload_id': r[0], 'user_id': r[1], 'total_size': r[2], 'updated_at': r[3]} for r in rows]
+    except Exception as e:
+        print(f"Error get_stale_uploads: {e}")
+        return []
+
+
+def get_upload_ids(upload_ids: List[str]) -> set:
+    """Cuáles de `upload_ids` siguen registradas como subidas en curso."""
+    try:
+        found = set()
+        for i in range(0, len(upload_ids), 500):
+            part = upload_ids[i:i + 500]
+            placeholders = ','.join('?' * len(part))
+            found.update(r[0] for r in db_pool.fetchall(
+                f'SELECT upload_id FROM uploads_in_progress WHERE upload_id IN ({placeholders})', part))
+        return found
+    except Exception as e:
+        print(f"Error get_upload_ids: {e}")
+        return set(upload_ids)  # ante la duda no se borra nada
+
+
+# ------------------------- Borrados en segundo plano -------------------------
+DELETE_JOB_COLUMNS = ('id, description, path, status, total_files, total_bytes, deleted_files, deleted_bytes, '
+                      'error, created_at, started_at, finished_at, updated_at')
+
+
+def _delete_job_to_dict(row) -> Dict:
+    keys = [c.strip() for c in DELETE_JOB_COLUMNS.split(',')]
+    return dict(zip(keys, row))
+
+
+def create_delete_job(description: str, path: str, now: str) -> Optional[int]:
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO delete_jobs (description, path, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                (description, path, now, now)
+            )
+            return cursor.lastrowid
+    except Exception as e:
+        print(f"Error create_delete_job: {e}")
+        return None
+
+
+def claim_delete_job(now: str, stale_before: str) -> Optional[Dict]:
+    """Reclamar el trabajo pendiente más antiguo (o uno en curso cuyo worker dejó de dar señales)."""
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute(
+                f"SELECT {DELETE_JOB_COLUMNS} FROM delete_jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND updated_at < ?) ORDER BY id LIMIT 1",
+                (stale_before,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            job = _delete_job_to_dict(row)
+            cursor.execute(
+                "UPDATE delete_jobs SET status = 'running', started_at = COALESCE(started_at, ?), updated_at = ? WHERE id = ?",
+                (now, now, job['id'])
+            )
+            job.update(status='running', started_at=job['started_at'] or now, updated_at=now)
+            return job
+    except Exception as e:
+        print(f"Error claim_delete_job: {e}")
+        return None
+
+
+def update_delete_job_progress(job_id: int, now: str, deleted_files: int, deleted_bytes: int,
+                               total_files: Optional[int] = None, total_bytes: Optional[int] = None) -> bool:
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute(
+                'UPDATE delete_jobs SET deleted_files = ?, deleted_bytes = ?, '
+                'total_files = COALESCE(?, total_files), total_bytes = COALESCE(?, total_bytes), updated_at = ? WHERE id = ?',
+                (deleted_files, deleted_bytes, total_files, total_bytes, now, job_id)
+            )
+            return cursor.rowcount > 0
+    except Exception as e:
+        print(f"Error update_delete_job_progress: {e}")
+        return False
+
+
+def finish_delete_job(job_id: int, now: str, error: Optional[str] = None) -> bool:
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute(
+                'UPDATE delete_jobs SET status = ?, error = ?, finished_at = ?, updated_at = ? WHERE id = ?',
+                ('failed' if error else 'done', error, now, now, job_id)
+            )
+            return cursor.rowcount > 0
+    except Exception as e:
+        print(f"Error finish_delete_job: {e}")
+        return False
+
+
+def get_delete_jobs(limit: int = 20) -> List[Dict]:
+    """Trabajos de borrado más recientes primero."""
+    try:
+        rows = db_pool.fetchall(f'SELECT {DELETE_JOB_COLUMNS} FROM delete_jobs ORDER BY id DESC LIMIT ?', (limit,))
+        return [_delete_job_to_dict(r) for r in rows]
+    except Exception as e:
+        print(f"Error get_delete_jobs: {e}")
+        return []
+
+
+def get_delete_job_paths() -> set:
+    """Directorios de papelera que algún trabajo (de cualquier estado) referencia."""
+    try:
+        return {r[0] for r in db_pool.fetchall('SELECT path FROM delete_jobs')}
+    except Exception as e:
+        print(f"Error get_delete_job_paths: {e}")
+        return set()
+
+
+# ---------------- Tokens de API (clientes sin navegador) ----------------
+
+def create_api_token(user_id: int, token_hash: str, name: Optional[str], now: str) -> Optional[int]:
+    try:
+        with db_pool.transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO api_tokens (user_id, token_hash, name, created_at) VALUES (?, ?, ?, ?)',
+                (user_id, token_hash, name, now)
+            )
+            return cursor.lastrowid
+    except Exception as e:
+        print(f"Error create_api_token: {e}")
+        return None
+
+
+def get_api_token_user(token_hash: str, now: str, touch_before: str) -> Optional[int]:
+    """user_id dueño del token si el usuario está activo. `last_used_at` sólo se actualiza si
+    es anterior a `touch_before` (una escritura por minuto, no una por petición)."""
+    try:
+        row = db_pool.fetchone(
+            "SELECT t.id, t.user_id, t.last_used_at FROM api_tokens t JOIN usuarios u ON u.id = t.user_id "
+            "WHERE t.token_hash=? AND u.estado='activo'",
+            (token_hash,)
+        )
+        if not row:
+            return None
+        if not row[2] or row[2] < touch_before:
+            db_pool.execute('UPDATE api_tokens SET last_used_at=? WHERE id=?', (now, row[0]))
+        return row[1]
+    except Exception as e:
+        print(f"Error get_api_token_user: {e}")
+        return None
+
+
+def get_user_api_tokens(user_id: int) -> List[Dict]:
+    try:
+        rows = db_pool.fetchall(
+            'SELECT id, name, created_at, last_used_at FROM api_tokens WHERE user_id=? ORDER BY id', (user_id,)
+        )
+        return [{"id": r[0], "name": r[1], "created_at": r[2], "last_used_at": r[3]} for r in rows]
+    except Exception as e:
+        print(f"Error get_user_api_tokens: {e}")
+        return []
+
+
+def delete_api_token(user_id: int, token_id: int) -> bool:
+    try:
+        return db_pool.execute('DELETE FROM api_tokens WHERE id=? AND user_id=?', (token_id, user_id)) > 0
+    except Exception as e:
+        print(f"Error delete_api_token: {e}")
+        return False
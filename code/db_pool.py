@@ -0,0 +1,106 @@
+"""
+Capa de acceso compartida a SQLite.
+
+- Pool de conexiones por proceso (worker): cada petición toma una conexión ya abierta y la
+  devuelve al terminar, en lugar de abrir y cerrar el archivo en cada consulta.
+- WAL: las lecturas no bloquean a la escritura ni al revés; busy_timeout hace que un
+  escritor espere al otro en lugar de fallar con 'database is locked'.
+- sqlite3 cachea las sentencias preparadas por conexión (cached_statements); al
+  reutilizar conexiones, las consultas repetidas no se vuelven a compilar.
+- Escrituras en transacciones cortas con BEGIN IMMEDIATE: el bloqueo se pide al principio,
+  así no hay que reintentar a mitad de transacción.
+"""
+import os
+import queue
+import sqlite3
+from contextlib import contextmanager
+
+DB_PATH = os.environ.get('DB_PATH', '/app/db/database.db')
+
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', '8'))
+CACHED_STATEMENTS = 256
+
+_pool = None
+_pool_pid = None
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # autocommit; las transacciones se abren explícitamente
+        check_same_thread=False,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    # INSERT OR REPLACE borra la fila previa: así también disparan los triggers de borrado (contadores)
+    conn.execute('PRAGMA recursive_triggers=ON')
+    return conn
+
+
+def _get_pool():
+    # Las conexiones no deben cruzar un fork (gunicorn crea los workers tras importar la app)
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = queue.LifoQueue(maxsize=POOL_SIZE)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+@contextmanager
+def connection():
+    """Tomar prestada una conexión del pool (se crea si no hay ninguna libre)."""
+    pool = _get_pool()
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@contextmanager
+def transaction():
+    """Transacción de escritura corta; hace COMMIT al salir o ROLLBACK si hay excepción."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def fetchone(query, params=()):
+    with connection() as conn:
+        return conn.execute(query, params).fetchone()
+
+
+def fetchall(query, params=()):
+    with connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def execute(query, params=()):
+    """Una sola sentencia de escritura (autocommit). Retorna rowcount."""
+    with connection() as conn:
+        return conn.execute(query, params).rowcount
+
+
+def executemany(query, seq_of_params):
+    """Varias filas en una sola transacción. Retorna rowcount total."""
+    with transaction() as cursor:
+        cursor.executemany(query, seq_of_params)
+        return cursor.rowcount
@@ -0,0 +1,173 @@
+"""
+Borrados grandes en segundo plano.
+
+Eliminar un usuario con cientos de GB no puede hacerse dentro de la petición del panel de
+admin: unlink de archivos enormes tarda y bajo gevent congelaría el worker. En su lugar,
+dentro de la misma operación se mueve todo a una papelera `.trash/<uuid>` (renames en el
+mismo volumen, casi gratis) y se encola un trabajo en la tabla delete_jobs. Un hilo por
+proceso (greenlet bajo gunicorn+gevent, como el barrido de expirados) reclama los trabajos
+de uno en uno, borra archivo por archivo a través de diskio y guarda el progreso.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import diskio  # type: ignore
+from blobstore import blob_trasher  # type: ignore
+from uploads import UPLOAD_FOLDER, format_file_size  # type: ignore
+from db_logic import (  # type: ignore
+    delete_user_completely, create_delete_job, claim_delete_job, update_delete_job_progress,
+    finish_delete_job, get_delete_job_paths
+)
+
+TRASH_FOLDER = os.environ.get('TRASH_FOLDER', os.path.join(UPLOAD_FOLDER, '.trash'))
+POLL_INTERVAL = int(os.environ.get('DELETE_JOBS_POLL_SECONDS', '30'))  # 0 desactiva el hilo
+# Un trabajo 'running' sin progreso en este tiempo se da por abandonado (worker reiniciado)
+STALE_AFTER = timedelta(seconds=int(os.environ.get('DELETE_JOBS_STALE_SECONDS', '300')))
+PROGRESS_EVERY = 2.0  # segundos entre actualizaciones de progreso
+
+logger = logging.getLogger('delete_jobs')
+
+_wakeup = threading.Event()
+_started = False
+
+
+def _new_trash_dir():
+    path = os.path.join(TRASH_FOLDER, uuid.uuid4().hex)
+    os.makedirs(path)
+    return path
+
+
+def _dir_trasher(trash_dir):
+    def trash(path):
+        diskio.run(path, os.rename, path, os.path.join(trash_dir, os.path.basename(path)))
+    return trash
+
+
+def enqueue(description, trash_dir):
+    """Registrar un trabajo para borrar `trash_dir` (o eliminarlo ya si está vacío)."""
+    if not os.listdir(trash_dir):
+        os.rmdir(trash_dir)
+        return None
+    job_id = create_delete_job(description, trash_dir, datetime.now().isoformat())
+    if job_id is not None:
+        logger.info("[delete] trabajo %s encolado: %s", job_id, description)
+        _wakeup.set()
+    return job_id
+
+
+def delete_user_in_background(user_id):
+    """Eliminar usuario y catálogo ya; sus blobs huérfanos y su directorio van a la papelera.
+
+    Retorna (success, job_id); job_id es None si no había nada que borrar del disco.
+    """
+    trash_dir = _new_trash_dir()
+    success = delete_user_completely(user_id, blob_trasher(trash_dir), _dir_trasher(trash_dir))
+    job_id = enqueue(f'usuario {user_id}', trash_dir)
+    return success, job_id
+
+
+def _scan(path):
+    """(archivos, bytes) bajo `path`."""
+    files = size = 0
+    for root, _dirs, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+            files += 1
+    return files, size
+
+
+def _remove_file(path):
+    try:
+        size = os.lstat(path).st_size
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def run_job(job):
+    """Borrar el contenido de la papelera de `job` archivo por archivo; idempotente si se reanuda."""
+    job_id, path = job['id'], job['path']
+    total_files, total_bytes = diskio.run(path, _scan, path) if os.path.isdir(path) else (0, 0)
+    # Reanudado tras una caída: lo ya borrado cuenta como hecho
+    deleted_files, deleted_bytes = job['deleted_files'] or 0, job['deleted_bytes'] or 0
+    update_delete_job_progress(job_id, datetime.now().isoformat(), deleted_files, deleted_bytes,
+                               total_files + deleted_files, total_bytes + deleted_bytes)
+    last_report = time.monotonic()
+    for root, dirs, names in os.walk(path, topdown=False):
+        for name in names:
+            deleted_bytes += diskio.run(root, _remove_file, os.path.join(root, name))
+            deleted_files += 1
+            if time.monotonic() - last_report >= PROGRESS_EVERY:
+                update_delete_job_progress(job_id, datetime.now().isoformat(), deleted_files, deleted_bytes)
+                last_report = time.monotonic()
+        for name in dirs:
+            diskio.run(root, os.rmdir, os.path.join(root, name))
+    if os.path.isdir(path):
+        diskio.run(path, os.rmdir, path)
+    update_delete_job_progress(job_id, datetime.now().isoformat(), deleted_files, deleted_bytes)
+    logger.info("[delete] trabajo %s completado: %s archivo(s), %s", job_id, deleted_files, format_file_size(deleted_bytes))
+
+
+def run_pending_jobs():
+    """Procesar trabajos hasta vaciar la cola. Retorna cuántos se procesaron."""
+    processed = 0
+    while True:
+        now = datetime.now()
+        job = claim_delete_job(now.isoformat(), (now - STALE_AFTER).isoformat())
+        if not job:
+            return processed
+        try:
+            run_job(job)
+            finish_delete_job(job['id'], datetime.now().isoformat())
+        except Exception as e:
+            logger.exception("[delete] fallo en trabajo %s", job['id'])
+            finish_delete_job(job['id'], datetime.now().isoformat(), str(e))
+        processed += 1
+
+
+def recover_orphan_trash(min_age=STALE_AFTER):
+    """Encolar papeleras sin trabajo (caída entre el rename y el INSERT) con cierta antigüedad."""
+    if not os.path.isdir(TRASH_FOLDER):
+        return 0
+    known = get_delete_job_paths()
+    cutoff = time.time() - min_age.total_seconds()
+    recovered = 0
+    for entry in os.scandir(TRASH_FOLDER):
+        if entry.is_dir() and entry.path not in known and entry.stat().st_mtime < cutoff:
+            if enqueue('papelera sin trabajo', entry.path):
+                recovered += 1
+    return recovered
+
+
+def _loop(interval):
+    try:
+        recover_orphan_trash()
+    except Exception:
+        logger.exception("[delete] fallo recuperando papeleras huérfanas")
+    while True:
+        try:
+            run_pending_jobs()
+        except Exception:
+            logger.exception("[delete] fallo procesando la cola de borrados")
+        _wakeup.wait(interval)
+        _wakeup.clear()
+
+
+def start_delete_worker(interval=None):
+    """Arrancar el procesador de borrados en segundo plano (una vez por proceso)."""
+    global _started
+    interval = POLL_INTERVAL if interval is None else interval
+    if _started or interval <= 0:
+        return False
+    thread = threading.Thread(target=_loop, args=(interval,), name='delete-jobs', daemon=True)
+    thread.start()
+    _started = True
+    return True
@@ -0,0 +1,118 @@
+"""
+Ejecutor acotado para E/S de disco.
+
+Bajo gunicorn+gevent una llamada bloqueante (write, fdatasync, rename, unlink de un archivo
+grande) detiene el worker entero: el hub no atiende ninguna otra petición hasta que vuelve.
+Estas operaciones se ejecutan aquí en hilos reales del sistema:
+
+- Con gevent (threading parcheado) se usa gevent.threadpool.ThreadPool: el greenlet que
+  espera cede el hub mientras el hilo trabaja.
+- Sin gevent (servidor de desarrollo, transfer_server.py, sweeper.py) un ThreadPoolExecutor.
+- Un pool por volumen (st_dev), así un disco lento no acapara los hilos de los demás. La
+  concurrencia por defecto es DISK_IO_CONCURRENCY y DISK_IO_VOLUMES la fija por punto de
+  montaje: `/app/uploads=8,/mnt/lento=2`.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = max(1, int(os.environ.get('DISK_IO_CONCURRENCY', '4')))
+
+
+def _parse_volumes(value):
+    volumes = {}
+    for item in (value or '').split(','):
+        mount, sep, limit = item.strip().rpartition('=')
+        if sep and mount and limit.strip().isdigit():
+            volumes[mount.strip()] = max(1, int(limit))
+    return volumes
+
+
+VOLUME_CONCURRENCY = _parse_volumes(os.environ.get('DISK_IO_VOLUMES'))
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = None
+_device_limits = None
+_local = threading.local()
+
+
+def _use_gevent():
+    try:
+        from gevent import monkey  # type: ignore
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def _device(path):
+    """st_dev del volumen que contiene `path` (o su directorio existente más cercano)."""
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if not parent or parent == path:
+                raise
+            path = parent
+
+
+def _limit_for(device):
+    global _device_limits
+    if _device_limits is None:
+        limits = {}
+        for mount, limit in VOLUME_CONCURRENCY.items():
+            try:
+                limits[_device(mount)] = limit
+            except OSError:
+                continue
+        _device_limits = limits
+    return _device_limits.get(device, DEFAULT_CONCURRENCY)
+
+
+def _pool(path):
+    # Los hilos no sobreviven a un fork (gunicorn crea los workers tras importar la app)
+    global _pools, _pools_pid
+    device = _device(path)
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools, _pools_pid = {}, os.getpid()
+        pool = _pools.get(device)
+        if pool is None:
+            limit = _limit_for(device)
+            if _use_gevent():
+                from gevent.threadpool import ThreadPool  # type: ignore
+                pool = ThreadPool(limit)
+            else:
+                pool = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f'diskio-{device}')
+            _pools[device] = pool
+        return pool
+
+
+def _call_in_pool(func, args, kwargs):
+    _local.inside = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.inside = False
+
+
+def run(path, func, *args, **kwargs):
+    """Ejecutar `func(*args, **kwargs)` en el pool del volumen de `path` y esperar el resultado.
+
+    Las excepciones se propagan al llamador. Una llamada hecha desde un hilo del propio
+    ejecutor se ejecuta directamente (evita bloqueos por anidamiento).
+    """
+    if getattr(_local, 'inside', False):
+        return func(*args, **kwargs)
+    pool = _pool(path)
+    if isinstance(pool, ThreadPoolExecutor):
+        return pool.submit(_call_in_pool, func, args, kwargs).result()
+    return pool.apply(_call_in_pool, (func, args, kwargs))
+
+
+def stats():
+    """Concurrencia configurada por volumen en este proceso (para el panel de admin)."""
+    with _pools_lock:
+        return {device: (pool._max_workers if isinstance(pool, ThreadPoolExecutor) else pool.maxsize)
+                for device, pool in _pools.items()}
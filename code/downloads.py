@@ -0,0 +1,229 @@
+"""
+Motor de descargas: respuestas completas y parciales (Range) sin copiar el archivo en Python.
+
+- Con gunicorn el cuerpo se entrega como `wsgi.file_wrapper`, de modo que el servidor usa
+  `os.sendfile` desde el offset actual del descriptor y hasta Content-Length.
+- Sin file_wrapper (servidor de desarrollo) se usa un iterador acotado con `os.pread`.
+- Varios rangos en una misma petición se sirven como `multipart/byteranges`.
+- Una variante comprimida (ver variants.py) se sirve igual, con Content-Encoding: los
+  rangos se aplican sobre los bytes comprimidos.
+- Modo offload opcional (DOWNLOAD_OFFLOAD=nginx|apache): la app sólo autoriza y valida
+  el Range, y el proxy envía los bytes vía X-Accel-Redirect / X-Sendfile.
+"""
+import os
+import re
+import uuid
+from urllib.parse import quote
+from flask import request, Response  # type: ignore
+from checksums import digest_headers  # type: ignore
+
+# Tamaño de lectura cuando no hay sendfile (default 4MB, entre 256KB y 32MB)
+try:
+    _chunk_mb = int(os.environ.get('RANGE_CHUNK_SIZE_MB', '4'))
+except ValueError:
+    _chunk_mb = 4
+READ_CHUNK_SIZE = max(256 * 1024, min(_chunk_mb * 1024 * 1024, 32 * 1024 * 1024))
+
+# Límite de rangos por petición: por encima se responde el archivo completo
+MAX_RANGES = int(os.environ.get('DOWNLOAD_MAX_RANGES', '32'))
+
+# Offload al proxy: '' (desactivado), 'nginx' (X-Accel-Redirect) o 'apache' (X-Sendfile)
+DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', '').strip().lower()
+# Raíz física de los archivos y location interna de nginx que la expone
+DOWNLOAD_OFFLOAD_ROOT = os.environ.get('DOWNLOAD_OFFLOAD_ROOT', os.environ.get('UPLOAD_FOLDER', '/app/uploads'))
+DOWNLOAD_OFFLOAD_PREFIX = os.environ.get('DOWNLOAD_OFFLOAD_PREFIX', '/_protected_uploads/')
+
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_ranges(range_header, file_size):
+    """Parsear `Range: bytes=...` a una lista de (start, end) inclusivos.
+
+    Retorna None si la cabecera no es aplicable (se sirve el archivo completo)
+    y [] si ningún rango es satisfacible (416).
+    """
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+    specs = range_header[len('bytes='):].split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        m = _RANGE_SPEC.match(spec)
+        if not m:
+            return None
+        start_str, end_str = m.groups()
+        if start_str == '' and end_str == '':
+            return None
+        if start_str == '':
+            # últimos N bytes
+            length = int(end_str)
+            if length == 0:
+                continue
+            start = max(0, file_size - length)
+            end = file_size - 1
+        else:
+            start = int(start_str)
+            end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+            if end_str and int(end_str) < start:
+                return None
+        if start >= file_size:
+            continue
+        ranges.append((start, end))
+    return ranges
+
+
+def content_disposition(download_name):
+    """Content-Disposition con nombre ASCII de respaldo y filename* UTF-8 (RFC 6266)."""
+    ascii_name = download_name.encode('ascii', 'replace').decode('ascii').replace('?', '_').replace('"', '')
+    value = f'attachment; filename="{ascii_name}"'
+    if ascii_name != download_name:
+        value += f"; filename*=UTF-8''{quote(download_name)}"
+    return value
+
+
+def file_etag(st):
+    return f'"{int(st.st_mtime)}-{st.st_size}"'
+
+
+class _BoundedFileIterator:
+    """Iterador que entrega [offset, offset+length) con pread, sin cargar más de un bloque."""
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.remaining = length
+
+    def __iter__(self):
+        fd = self.f.fileno()
+        while self.remaining > 0:
+            data = os.pread(fd, min(READ_CHUNK_SIZE, self.remaining), self.offset)
+            if not data:
+                break
+            self.offset += len(data)
+            self.remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+def _file_body(path, offset, length):
+    """Cuerpo de respuesta para un único tramo: file_wrapper (sendfile) si el servidor lo ofrece."""
+    f = open(path, 'rb')
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        # gunicorn hace sendfile desde la posición actual hasta Content-Length
+        f.seek(offset)
+        return file_wrapper(f, READ_CHUNK_SIZE)
+    return _BoundedFileIterator(f, offset, length)
+
+
+def _multipart_body(path, ranges, boundary, part_headers):
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        for (start, end), head in zip(ranges, part_headers):
+            yield head
+            offset, remaining = start, end - start + 1
+            while remaining > 0:
+                data = os.pread(fd, min(READ_CHUNK_SIZE, remaining), offset)
+                if not data:
+                    return
+                offset += len(data)
+                remaining -= len(data)
+                yield data
+        yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+def _offload_response(path, download_name, mimetype, extra_headers=None):
+    """Respuesta vacía con la cabecera que hace que el proxy sirva el archivo (o None si no aplica)."""
+    headers = dict(extra_headers or {})
+    headers['Content-Disposition'] = content_disposition(download_name)
+    if DOWNLOAD_OFFLOAD == 'nginx':
+        root = os.path.abspath(DOWNLOAD_OFFLOAD_ROOT)
+        real = os.path.abspath(path)
+        if os.path.commonpath([root, real]) != root:
+            return None
+        rel = os.path.relpath(real, root)
+        headers['X-Accel-Redirect'] = DOWNLOAD_OFFLOAD_PREFIX.rstrip('/') + '/' + quote(rel)
+    elif DOWNLOAD_OFFLOAD == 'apache':
+        headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        return None
+    return Response(status=200, mimetype=mimetype, headers=headers)
+
+
+def _integrity_headers(st, content_hash, content_encoding):
+    if not content_encoding:
+        return digest_headers(content_hash) if content_hash else {'ETag': file_etag(st)}
+    # Otra representación: ETag propio; Digest/Repr-Digest describirían los bytes comprimidos
+    base = f'sha256-{content_hash}' if content_hash else file_etag(st).strip('"')
+    return {'ETag': f'"{base}-{content_encoding}"'}
+
+
+def send_file_ranges(path, download_name, mimetype='application/octet-stream', content_hash=None,
+                     content_encoding=None):
+    """Servir un archivo completo o parcial (uno o varios rangos) sin copiarlo en memoria.
+
+    Con `content_hash` (SHA-256 calculado al subir) el ETag es fuerte y se añade Digest.
+    Con `content_encoding`, `path` es la variante comprimida del contenido.
+    """
+    st = os.stat(path)
+    file_size = st.st_size
+    integrity = _integrity_headers(st, content_hash, content_encoding)
+    etag = integrity['ETag']
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(download_name),
+    }
+    headers.update(integrity)
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+
+    ranges = parse_ranges(request.headers.get('Range'), file_size)
+    if DOWNLOAD_OFFLOAD:
+        # El Range lo sirve el proxy; aquí sólo se rechazan los no satisfacibles
+        if ranges == []:
+            return Response(status=416, headers={'Content-Range': f'bytes */{file_size}'})
+        offloaded = _offload_response(path, download_name, mimetype, integrity)
+        if offloaded is not None:
+            return offloaded
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range and if_range.strip() != etag:
+        ranges = None  # el recurso cambió: enviar completo
+
+    if ranges is None:
+        if request.if_none_match and request.if_none_match.contains_weak(etag.strip('"')):
+            return Response(status=304, headers={'ETag': etag})
+        headers['Content-Length'] = str(file_size)
+        return Response(_file_body(path, 0, file_size), status=200, mimetype=mimetype,
+                        headers=headers, direct_passthrough=True)
+
+    if not ranges:
+        return Response(status=416, headers={'Content-Range': f'bytes */{file_size}'})
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        length = end - start + 1
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        headers['Content-Length'] = str(length)
+        return Response(_file_body(path, start, length), status=206, mimetype=mimetype,
+                        headers=headers, direct_passthrough=True)
+
+    # multipart/byteranges: longitud exacta calculada a partir de las cabeceras de cada parte
+    boundary = uuid.uuid4().hex
+    part_headers = []
+    total = 0
+    for i, (start, end) in enumerate(ranges):
+        head = (
+            ('\r\n' if i else '') + f'--{boundary}\r\n'
+            f'Content-Type: {mimetype}\r\n'
+            f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+        ).encode('ascii')
+        part_headers.append(head)
+        total += len(head) + (end - start + 1)
+    total += len(f'\r\n--{boundary}--\r\n')
+    headers['Content-Length'] = str(total)
+    return Response(_multipart_body(path, ranges, boundary, part_headers), status=206,
+                    content_type=f'multipart/byteranges; boundary={boundary}',
+                    headers=headers, direct_passthrough=True)
@@ -95,7 +95,10 @@ def attach_request_logging(app):
             is_multipart = (request.content_type or '').lower().startswith('multipart/form-data')
             # Umbral (5MB) para decidir si se omite parsing; configurable vía env LOGGING_FORM_PARSE_THRESHOLD
             threshold = int(os.environ.get('LOGGING_FORM_PARSE_THRESHOLD', 5 * 1024 * 1024))
-            if is_multipart and content_length > threshold:
+            if request.endpoint in app.config.get('STREAMING_ENDPOINTS', ()):
+                # El cuerpo lo lee la vista en streaming; parsearlo aquí lo consumiría
+                form_raw = {'_skipped': f'streaming ~{content_length} bytes'}
+            elif is_multipart and content_length > threshold:
                 form_raw = {
                     '_skipped': f'multipart ~{content_length} bytes (omitido para no bloquear subida)'
                 }
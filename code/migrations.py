@@ -0,0 +1,394 @@
+"""
+Migraciones de esquema versionadas con `PRAGMA user_version`.
+
+Cada paso tiene un número y se aplica una sola vez, en su propia transacción junto con
+la actualización de user_version. Los pasos son idempotentes (IF NOT EXISTS / comprobación
+de columnas) para que una base creada por versiones anteriores, que parte de
+user_version=0, llegue al mismo esquema. Un flock sobre un archivo junto a la base
+garantiza que sólo un worker de gunicorn migra; los demás esperan y encuentran la
+versión ya al día.
+"""
+import os
+import fcntl
+import db_pool  # type: ignore
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {r[1] for r in cursor.fetchall()}
+
+
+def _m001_usuarios(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            email TEXT UNIQUE,
+            password TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cols = _columns(cursor, 'usuarios')
+    if 'estado' not in cols:
+        cursor.execute("ALTER TABLE usuarios ADD COLUMN estado TEXT NOT NULL DEFAULT 'pendiente'")
+    if 'fecha_registro' not in cols:
+        # SQLite no admite ADD COLUMN con DEFAULT no constante en tablas con filas: la columna
+        # se añade sin default y un trigger rellena la fecha de los usuarios nuevos
+        cursor.execute("ALTER TABLE usuarios ADD COLUMN fecha_registro TIMESTAMP")
+        cursor.execute("UPDATE usuarios SET fecha_registro = CURRENT_TIMESTAMP WHERE fecha_registro IS NULL")
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS usuarios_fecha_registro AFTER INSERT ON usuarios
+            WHEN new.fecha_registro IS NULL BEGIN
+                UPDATE usuarios SET fecha_registro = CURRENT_TIMESTAMP WHERE id = new.id;
+            END
+        ''')
+
+
+def _m002_archivos(cursor):
+    # Catálogo de archivos subidos (sustituye a los sidecars .meta)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archivos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            upload_date TEXT NOT NULL,
+            expires_date TEXT,
+            deleted_at TEXT,
+            UNIQUE (user_id, filename)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archivos_user_fecha ON archivos (user_id, upload_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archivos_expira ON archivos (expires_date)')
+
+
+def _m003_share_tokens(cursor):
+    # Índice global nombre -> dueño para descargas públicas y tokens opacos para compartir
+    if 'share_token' not in _columns(cursor, 'archivos'):
+        cursor.execute("ALTER TABLE archivos ADD COLUMN share_token TEXT")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archivos_filename ON archivos (filename)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_archivos_token ON archivos (share_token)')
+    cursor.execute("UPDATE archivos SET share_token = lower(hex(randomblob(16))) WHERE share_token IS NULL")
+
+
+def _m004_content_hash(cursor):
+    if 'content_hash' not in _columns(cursor, 'archivos'):
+        cursor.execute("ALTER TABLE archivos ADD COLUMN content_hash TEXT")
+
+
+def _m005_blobs(cursor):
+    # Almacén deduplicado: un blob por contenido (SHA-256) con recuento de referencias del catálogo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archivos_hash ON archivos (content_hash)')
+
+
+def _m006_busqueda_usuarios(cursor):
+    # Filtro por estado con paginación por id sin recorrer la tabla entera
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_estado ON usuarios (estado, id)')
+    # Índice de texto (trigramas: equivale a LIKE '%x%' pero indexado) sobre nombre y email,
+    # sincronizado con usuarios mediante triggers. Si SQLite no trae FTS5 se sigue usando LIKE.
+    try:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS usuarios_fts USING fts5("
+            "nombre, email, content='usuarios', content_rowid='id', tokenize='trigram')"
+        )
+    except Exception as e:
+        print(f"[MIGRATION] FTS5 no disponible, la búsqueda de usuarios usará LIKE: {e}")
+        return
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_fts_ai AFTER INSERT ON usuarios BEGIN
+            INSERT INTO usuarios_fts(rowid, nombre, email) VALUES (new.id, new.nombre, new.email);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_fts_ad AFTER DELETE ON usuarios BEGIN
+            INSERT INTO usuarios_fts(usuarios_fts, rowid, nombre, email) VALUES ('delete', old.id, old.nombre, old.email);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_fts_au AFTER UPDATE OF nombre, email ON usuarios BEGIN
+            INSERT INTO usuarios_fts(usuarios_fts, rowid, nombre, email) VALUES ('delete', old.id, old.nombre, old.email);
+            INSERT INTO usuarios_fts(rowid, nombre, email) VALUES (new.id, new.nombre, new.email);
+        END
+    """)
+    cursor.execute("INSERT INTO usuarios_fts(usuarios_fts) VALUES ('rebuild')")
+
+
+def _m007_contadores(cursor):
+    # Estadísticas mantenidas por triggers en la misma transacción que cada cambio, para que
+    # el panel de admin lea unas pocas filas en lugar de contar tablas completas.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS contadores (
+            clave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uso_usuario (
+            user_id INTEGER PRIMARY KEY,
+            archivos INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS actividad_diaria (
+            dia TEXT PRIMARY KEY,
+            subidas INTEGER NOT NULL DEFAULT 0,
+            bytes_subidos INTEGER NOT NULL DEFAULT 0,
+            descargas INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    def bump(key, delta):
+        return (f"INSERT INTO contadores (clave, valor) VALUES ({key}, {delta}) "
+                f"ON CONFLICT(clave) DO UPDATE SET valor = valor + excluded.valor;")
+
+    triggers = {
+        'contadores_usuarios_ai': f"""AFTER INSERT ON usuarios BEGIN
+            {bump("'usuarios:' || new.estado", 1)}
+        END""",
+        'contadores_usuarios_ad': f"""AFTER DELETE ON usuarios BEGIN
+            {bump("'usuarios:' || old.estado", -1)}
+            DELETE FROM uso_usuario WHERE user_id = old.id;
+        END""",
+        'contadores_usuarios_au': f"""AFTER UPDATE OF estado ON usuarios WHEN old.estado IS NOT new.estado BEGIN
+            {bump("'usuarios:' || old.estado", -1)}
+            {bump("'usuarios:' || new.estado", 1)}
+        END""",
+        'contadores_archivos_ai': f"""AFTER INSERT ON archivos BEGIN
+            {bump("'archivos'", 1)}
+            {bump("'bytes'", "new.size")}
+            INSERT INTO uso_usuario (user_id, archivos, bytes) VALUES (new.user_id, 1, new.size)
+                ON CONFLICT(user_id) DO UPDATE SET archivos = archivos + 1, bytes = bytes + excluded.bytes;
+            INSERT INTO actividad_diaria (dia, subidas, bytes_subidos) VALUES (substr(new.upload_date, 1, 10), 1, new.size)
+                ON CONFLICT(dia) DO UPDATE SET subidas = subidas + 1, bytes_subidos = bytes_subidos + excluded.bytes_subidos;
+        END""",
+        'contadores_archivos_ad': f"""AFTER DELETE ON archivos BEGIN
+            {bump("'archivos'", -1)}
+            {bump("'bytes'", "-old.size")}
+            UPDATE uso_usuario SET archivos = archivos - 1, bytes = bytes - old.size WHERE user_id = old.user_id;
+        END""",
+        'contadores_blobs_ai': f"""AFTER INSERT ON blobs BEGIN
+            {bump("'blobs'", 1)}
+            {bump("'blob_bytes'", "new.size")}
+        END""",
+        'contadores_blobs_ad': f"""AFTER DELETE ON blobs BEGIN
+            {bump("'blobs'", -1)}
+            {bump("'blob_bytes'", "-old.size")}
+        END""",
+    }
+    for name, body in triggers.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    # Valores iniciales a partir de los datos existentes
+    cursor.execute("DELETE FROM contadores")
+    cursor.execute("DELETE FROM uso_usuario")
+    cursor.execute("DELETE FROM actividad_diaria")
+    cursor.execute("INSERT INTO contadores (clave, valor) SELECT 'usuarios:' || estado, COUNT(*) FROM usuarios GROUP BY estado")
+    cursor.execute("INSERT INTO contadores (clave, valor) SELECT 'archivos', COUNT(*) FROM archivos")
+    cursor.execute("INSERT INTO contadores (clave, valor) SELECT 'bytes', COALESCE(SUM(size), 0) FROM archivos")
+    cursor.execute("INSERT INTO contadores (clave, valor) SELECT 'blobs', COUNT(*) FROM blobs")
+    cursor.execute("INSERT INTO contadores (clave, valor) SELECT 'blob_bytes', COALESCE(SUM(size), 0) FROM blobs")
+    cursor.execute("INSERT INTO uso_usuario (user_id, archivos, bytes) SELECT user_id, COUNT(*), COALESCE(SUM(size), 0) FROM archivos GROUP BY user_id")
+    cursor.execute(
+        "INSERT INTO actividad_diaria (dia, subidas, bytes_subidos) "
+        "SELECT substr(upload_date, 1, 10), COUNT(*), COALESCE(SUM(size), 0) FROM archivos GROUP BY 1"
+    )
+
+
+def _m008_cuotas(cursor):
+    # Cuotas por usuario; NULL en una columna = usar el valor por defecto (USER_QUOTA_MB / USER_QUOTA_FILES)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cuotas (
+            user_id INTEGER PRIMARY KEY,
+            max_bytes INTEGER,
+            max_archivos INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS cuotas_usuarios_ad AFTER DELETE ON usuarios BEGIN
+            DELETE FROM cuotas WHERE user_id = old.id;
+        END
+    ''')
+
+
+def _m009_subidas_en_curso(cursor):
+    # Estado de las subidas por chunks (antes .upload_<id>.json): cada chunk aceptado es una
+    # fila con su rango exacto, así el progreso se reconstruye sin fiarse del tamaño del .part
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploads_in_progress (
+            upload_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            original_name TEXT NOT NULL,
+            display_name TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL,
+            content_sha256 TEXT,
+            declared_chunk_hashes TEXT,
+            hash_epoch INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_in_progress_user ON uploads_in_progress(user_id, total_size)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            received_at TEXT NOT NULL,
+            PRIMARY KEY (upload_id, chunk_index)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS uploads_in_progress_ad AFTER DELETE ON uploads_in_progress BEGIN
+            DELETE FROM upload_chunks WHERE upload_id = old.upload_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS uploads_in_progress_usuarios_ad AFTER DELETE ON usuarios BEGIN
+            DELETE FROM uploads_in_progress WHERE user_id = old.id;
+        END
+    ''')
+
+
+def _m010_subidas_inactivas(cursor):
+    # El barrido de subidas abandonadas busca por última actividad
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_in_progress_updated ON uploads_in_progress(updated_at)')
+
+
+def _m011_subidas_tus(cursor):
+    # Subidas del protocolo tus en la misma tabla: se escriben por offset (sin rejilla de chunks),
+    # guardan Upload-Metadata/Upload-Concat y, una vez completas, el nombre del archivo resultante
+    columns = _columns(cursor, 'uploads_in_progress')
+    if 'protocol' not in columns:
+        cursor.execute("ALTER TABLE uploads_in_progress ADD COLUMN protocol TEXT NOT NULL DEFAULT 'chunks'")
+    if 'upload_metadata' not in columns:
+        cursor.execute("ALTER TABLE uploads_in_progress ADD COLUMN upload_metadata TEXT")
+    if 'concat' not in columns:
+        cursor.execute("ALTER TABLE uploads_in_progress ADD COLUMN concat TEXT")
+    if 'final_filename' not in columns:
+        cursor.execute("ALTER TABLE uploads_in_progress ADD COLUMN final_filename TEXT")
+
+
+def _m012_borrados_en_segundo_plano(cursor):
+    # Borrados grandes (eliminar un usuario) como trabajos en cola: `path` es el directorio de
+    # papelera con lo que hay que borrar; updated_at hace de latido del worker que lo procesa
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS delete_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            description TEXT NOT NULL,
+            path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            total_files INTEGER,
+            total_bytes INTEGER,
+            deleted_files INTEGER NOT NULL DEFAULT 0,
+            deleted_bytes INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_delete_jobs_status ON delete_jobs(status, id)')
+
+
+def _m013_tokens_api(cursor):
+    # Tokens personales para clientes sin navegador (tus): sólo se guarda su SHA-256
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token_hash TEXT NOT NULL UNIQUE,
+            name TEXT,
+            created_at TEXT NOT NULL,
+            last_used_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_tokens_user ON api_tokens(user_id)')
+
+
+MIGRATIONS = [
+    (1, 'tabla usuarios', _m001_usuarios),
+    (2, 'catálogo de archivos', _m002_archivos),
+    (3, 'tokens de compartición', _m003_share_tokens),
+    (4, 'hash de contenido', _m004_content_hash),
+    (5, 'almacén de blobs', _m005_blobs),
+    (6, 'índices de búsqueda de usuarios', _m006_busqueda_usuarios),
+    (7, 'contadores de uso', _m007_contadores),
+    (8, 'cuotas por usuario', _m008_cuotas),
+    (9, 'subidas por chunks en curso', _m009_subidas_en_curso),
+    (10, 'índice de subidas inactivas', _m010_subidas_inactivas),
+    (11, 'subidas tus', _m011_subidas_tus),
+    (12, 'borrados en segundo plano', _m012_borrados_en_segundo_plano),
+    (13, 'tokens de API', _m013_tokens_api),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+LOCK_PATH = db_pool.DB_PATH + '.migrate.lock'
+
+_capabilities = None
+
+
+def current_version():
+    return db_pool.fetchone('PRAGMA user_version')[0]
+
+
+def run_migrations():
+    """Aplicar los pasos pendientes. Retorna la lista de versiones aplicadas por este proceso."""
+    global _capabilities
+    os.makedirs(os.path.dirname(db_pool.DB_PATH), exist_ok=True)
+    # Camino rápido: sin lock ni introspección si ya está al día
+    if current_version() >= SCHEMA_VERSION:
+        return []
+    applied = []
+    with open(LOCK_PATH, 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            version = current_version()
+            for number, description, step in MIGRATIONS:
+                if number <= version:
+                    continue
+                with db_pool.transaction() as cursor:
+                    step(cursor)
+                    cursor.execute(f'PRAGMA user_version = {number}')
+                print(f"[MIGRATION] {number:03d} {description} aplicada")
+                applied.append(number)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    _capabilities = None
+    return applied
+
+
+def schema_capabilities():
+    """Mapa tabla -> columnas, calculado una vez por proceso (el esquema sólo cambia al migrar)."""
+    global _capabilities
+    if _capabilities is None:
+        caps = {}
+        with db_pool.connection() as conn:
+            tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            for table in tables:
+                caps[table] = frozenset(r[1] for r in conn.execute(f"PRAGMA table_info({table})"))
+        _capabilities = caps
+    return _capabilities
+
+
+def has_column(table, column):
+    return column in schema_capabilities().get(table, ())
+
+
+def has_table(table):
+    return table in schema_capabilities()
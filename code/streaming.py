@@ -0,0 +1,96 @@
+"""
+Lectura incremental de cuerpos de subida.
+
+Werkzeug, al acceder a `request.files`, vuelca el multipart completo a un temporal antes
+de que la vista lo vea. Aquí el cuerpo se decodifica a medida que llega desde
+`request.stream`, así que cada trozo se escribe directamente en su destino y la memoria
+por petición queda acotada a READ_SIZE.
+"""
+import os
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, Field, File, Data, Epilogue  # type: ignore
+
+READ_SIZE = int(os.environ.get('UPLOAD_READ_SIZE_KB', '4096')) * 1024  # 4MB
+MAX_FIELD_SIZE = 64 * 1024
+
+
+def iter_body(stream, read_size=READ_SIZE):
+    """Iterar un cuerpo crudo (application/octet-stream) en trozos de read_size."""
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        yield data
+
+
+class MultipartPart:
+    """Una parte del multipart. Sus datos deben consumirse antes de pedir la siguiente."""
+
+    def __init__(self, parser, name, filename, headers):
+        self._parser = parser
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.done = False
+
+    def iter_data(self):
+        while not self.done:
+            event = self._parser._next_event()
+            if not isinstance(event, Data):
+                raise ValueError('Multipart mal formado')
+            if not event.more_data:
+                self.done = True
+            if event.data:
+                yield event.data
+
+    def read_value(self, max_size=MAX_FIELD_SIZE):
+        """Leer una parte pequeña (campo de formulario) como texto."""
+        buf = bytearray()
+        for data in self.iter_data():
+            buf.extend(data)
+            if len(buf) > max_size:
+                raise ValueError(f'Campo {self.name} demasiado grande')
+        return buf.decode('utf-8', 'replace')
+
+
+class MultipartStream:
+    """Parser multipart/form-data incremental sobre un stream WSGI."""
+
+    def __init__(self, stream, boundary, read_size=READ_SIZE):
+        if not boundary:
+            raise ValueError('Multipart sin boundary')
+        self._stream = stream
+        self._read_size = read_size
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self._eof = False
+
+    def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if event is not NEED_DATA:
+                return event
+            if self._eof:
+                raise ValueError('Cuerpo multipart incompleto')
+            data = self._stream.read(self._read_size)
+            if not data:
+                self._eof = True
+                self._decoder.receive_data(None)
+            else:
+                self._decoder.receive_data(data)
+
+    def parts(self):
+        """Generar las partes en orden; las que no se consumen se descartan al avanzar."""
+        while True:
+            event = self._next_event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, (Field, File)):
+                part = MultipartPart(self, event.name, getattr(event, 'filename', None), event.headers)
+                yield part
+                if not part.done:
+                    for _ in part.iter_data():
+                        pass
+
+
+def multipart_from_request(req):
+    """Construir el parser para la petición Flask actual (sin tocar request.form/files)."""
+    return MultipartStream(req.stream, req.mimetype_params.get('boundary'))
@@ -0,0 +1,107 @@
+"""
+Barrido periódico de archivos expirados y de subidas por chunks abandonadas.
+
+Se ejecuta dentro de cada worker como hilo daemon (greenlet bajo gunicorn+gevent)
+o como proceso independiente:
+
+    python sweeper.py            # bucle continuo
+    python sweeper.py --once     # una sola pasada (cron)
+"""
+import os
+import sys
+import time
+import fcntl
+import logging
+import threading
+
+from uploads import UPLOAD_FOLDER, sweep_expired_files, sweep_stale_uploads, format_file_size  # type: ignore
+
+SWEEP_INTERVAL = int(os.environ.get('EXPIRY_SWEEP_INTERVAL', '600'))  # segundos, 0 desactiva
+SWEEP_BATCH_SIZE = int(os.environ.get('EXPIRY_SWEEP_BATCH', '500'))
+LOCK_PATH = os.path.join(UPLOAD_FOLDER, '.sweeper.lock')
+# Segundos mínimos entre pasadas adelantadas con request_sweep()
+REQUEST_MIN_GAP = 60
+
+logger = logging.getLogger('sweeper')
+
+_wakeup = threading.Event()
+_started = False
+_last_pass = 0.0
+
+
+def run_sweep():
+    """Ejecutar una pasada si ningún otro worker/proceso está barriendo.
+
+    Retorna el dict de sweep_expired_files (más `uploads`/`upload_bytes` de
+    sweep_stale_uploads), o None si otro proceso tiene el lock.
+    """
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    with open(LOCK_PATH, 'a') as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            result = sweep_expired_files(batch_size=SWEEP_BATCH_SIZE)
+            stale = sweep_stale_uploads(batch_size=SWEEP_BATCH_SIZE)
+            result['uploads'] = stale['uploads']
+            result['upload_bytes'] = stale['bytes']
+            return result
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _loop(interval):
+    global _last_pass
+    while True:
+        _last_pass = time.monotonic()
+        try:
+            run_sweep()
+        except Exception:
+            logger.exception("[sweep] fallo en barrido de expirados / subidas abandonadas")
+        _wakeup.wait(interval)
+        _wakeup.clear()
+
+
+def request_sweep():
+    """Adelantar la próxima pasada del barrido en segundo plano de este proceso.
+
+    No barre en el hilo del llamador. Si la última pasada empezó hace menos de
+    REQUEST_MIN_GAP segundos no se repite. Retorna False si en este proceso no corre el
+    barrido (EXPIRY_SWEEP_INTERVAL=0).
+    """
+    if not _started:
+        return False
+    if time.monotonic() - _last_pass >= REQUEST_MIN_GAP:
+        _wakeup.set()
+    return True
+
+
+def start_expiry_sweeper(interval=None):
+    """Arrancar el barrido en segundo plano (una vez por proceso)."""
+    global _started
+    interval = SWEEP_INTERVAL if interval is None else interval
+    if _started or interval <= 0:
+        return False
+    thread = threading.Thread(target=_loop, args=(interval,), name='expiry-sweeper', daemon=True)
+    thread.start()
+    _started = True
+    return True
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    if '--once' in argv:
+        result = run_sweep()
+        if result is None:
+            print("Otro proceso está barriendo; nada que hacer")
+        else:
+            print(f"Eliminados {result['files']} archivo(s), {format_file_size(result['bytes'])} recuperados")
+            print(f"Eliminadas {result['uploads']} subida(s) abandonada(s), {format_file_size(result['upload_bytes'])} recuperados")
+        return 0
+    _loop(SWEEP_INTERVAL or 600)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+"""
+Entorno aislado para las pruebas: base de datos y almacenamiento en un directorio temporal.
+
+Los módulos de la app leen sus rutas (DB_PATH, UPLOAD_FOLDER...) al importarse, así que se
+fijan aquí, antes de cualquier import de `code/`.
+"""
+import os
+import sys
+import shutil
+import itertools
+import tempfile
+
+import pytest
+
+_ROOT = tempfile.mkdtemp(prefix='filetransfer-tests-')
+os.environ.update({
+    'DB_PATH': os.path.join(_ROOT, 'db', 'database.db'),
+    'UPLOAD_FOLDER': os.path.join(_ROOT, 'uploads'),
+    'SECRET_KEY': 'tests',
+    'EXPIRY_SWEEP_INTERVAL': '0',
+    'DELETE_JOBS_POLL_SECONDS': '0',
+})
+for _var in ('BLOB_FOLDER', 'INCOMING_FOLDER', 'TRASH_FOLDER', 'USER_QUOTA_MB', 'USER_QUOTA_FILES',
+             'MAX_UPLOAD_SIZE', 'CHUNK_SIZE_MB', 'DOWNLOAD_OFFLOAD', 'INSTANT_UPLOAD'):
+    os.environ.pop(_var, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CSRF_TOKEN = 'csrf-tests'
+_user_numbers = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def flask_app():
+    import app as app_module
+    flask_app = app_module.main(background_workers=False)
+    flask_app.config['TESTING'] = True
+    yield flask_app
+    shutil.rmtree(_ROOT, ignore_errors=True)
+
+
+@pytest.fixture
+def make_user(flask_app):
+    """Crear usuarios activos; al terminar se borran con sus archivos y blobs."""
+    import db_pool
+    from db_logic import delete_user_completely
+    from blobstore import remove_blob
+    created = []
+
+    def make():
+        n = next(_user_numbers)
+        with db_pool.transaction() as cursor:
+            cursor.execute("INSERT INTO usuarios (nombre, email, password, estado) VALUES (?, ?, 'x', 'activo')",
+                           (f'usuario{n}', f'usuario{n}@example.com'))
+            created.append(cursor.lastrowid)
+        return created[-1]
+    yield make
+    for created_id in created:
+        delete_user_completely(created_id, remove_blob)
+
+
+@pytest.fixture
+def user_id(make_user):
+    return make_user()
+
+
+@pytest.fixture
+def csrf_headers():
+    return {'X-CSRF-Token': CSRF_TOKEN}
+
+
+@pytest.fixture
+def client_for(flask_app):
+    """Cliente de pruebas con la sesión del usuario indicado iniciada."""
+    def make_client(uid):
+        client = flask_app.test_client()
+        # SESSION_COOKIE_SECURE: la cookie sólo viaja por https
+        client.environ_base['wsgi.url_scheme'] = 'https'
+        with client.session_transaction() as sess:
+            sess['user_id'] = uid
+            sess['username'] = f'usuario{uid}'
+            sess['_csrf'] = CSRF_TOKEN
+        return client
+    return make_client
+
+
+@pytest.fixture
+def client(client_for, user_id):
+    return client_for(user_id)
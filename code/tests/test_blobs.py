@@ -0,0 +1,119 @@
+import os
+import hashlib
+
+import pytest
+
+import db_pool
+import db_logic
+from blobstore import blob_path, remove_blob, variant_path
+from uploads import sweep_expired_files
+
+
+def _refcount(content_hash):
+    row = db_pool.fetchone('SELECT refcount FROM blobs WHERE hash = ?', (content_hash,))
+    return row[0] if row else None
+
+
+def _upload(client, csrf_headers, name, data):
+    r = client.put('/api/upload_stream', data=data, headers={**csrf_headers, 'X-Filename': name})
+    assert r.status_code == 200, r.json
+    return r.json['filename'], r.json['sha256']
+
+
+def _expire(user_id, filename):
+    db_pool.execute("UPDATE archivos SET expires_date = '2000-01-01T00:00:00' WHERE user_id = ? AND filename = ?",
+                    (user_id, filename))
+
+
+@pytest.fixture
+def shared(make_user, client_for, csrf_headers):
+    """Dos usuarios que suben el mismo contenido: un solo blob con dos referencias."""
+    data = os.urandom(64 * 1024)
+    users = []
+    for n in range(2):
+        uid = make_user()
+        client = client_for(uid)
+        filename, content_hash = _upload(client, csrf_headers, f'compartido{n}.bin', data)
+        users.append((uid, client, filename))
+    return users, content_hash
+
+
+def test_mismo_contenido_comparte_blob(shared):
+    _, content_hash = shared
+    assert _refcount(content_hash) == 2
+    assert os.path.isfile(blob_path(content_hash))
+
+
+def test_borrar_libera_el_blob_con_la_ultima_referencia(shared, csrf_headers):
+    (first, second), content_hash = shared
+    for n, (_, client, filename) in enumerate((first, second)):
+        r = client.post('/api/delete_file', json={'filename': filename}, headers=csrf_headers)
+        assert r.status_code == 200
+        if n == 0:
+            assert _refcount(content_hash) == 1
+            assert os.path.isfile(blob_path(content_hash))
+    assert _refcount(content_hash) is None
+    assert not os.path.exists(blob_path(content_hash))
+
+
+def test_expiracion_libera_el_blob_y_sus_variantes(shared):
+    (first, second), content_hash = shared
+    path = blob_path(content_hash)
+    with open(variant_path(path, 'gzip'), 'wb') as f:
+        f.write(b'variante')
+
+    _expire(first[0], first[2])
+    assert sweep_expired_files()['files'] == 1
+    assert _refcount(content_hash) == 1
+    assert os.path.isfile(path)
+
+    _expire(second[0], second[2])
+    assert sweep_expired_files()['files'] == 1
+    assert _refcount(content_hash) is None
+    assert not os.path.exists(path)
+    assert not os.path.exists(variant_path(path, 'gzip'))
+
+
+def test_borrar_usuario_conserva_los_blobs_compartidos(shared, csrf_headers):
+    (first, second), content_hash = shared
+    own, own_hash = _upload(first[1], csrf_headers, 'propio.bin', os.urandom(1024))
+
+    assert db_logic.delete_user_completely(first[0], remove_blob)
+
+    assert _refcount(content_hash) == 1
+    assert os.path.isfile(blob_path(content_hash))
+    assert _refcount(own_hash) is None
+    assert not os.path.exists(blob_path(own_hash))
+    assert db_logic.get_user_file_records(second[0])[0]['filename'] == second[2]
+
+
+def test_fallo_al_registrar_no_deja_blob_huerfano(client, csrf_headers, monkeypatch):
+    insert = db_logic._insert_blob_file
+
+    def insert_then_fail(*args, **kwargs):
+        insert(*args, **kwargs)
+        raise RuntimeError('fallo tras insertar')
+    # El fallo llega dentro de la transacción, con el blob ya colocado y su fila insertada
+    monkeypatch.setattr(db_logic, '_insert_blob_file', insert_then_fail)
+    data = os.urandom(4096)
+
+    r = client.put('/api/upload_stream', data=data, headers={**csrf_headers, 'X-Filename': 'x.bin'})
+
+    assert r.status_code == 500
+    content_hash = hashlib.sha256(data).hexdigest()
+    assert _refcount(content_hash) is None
+    assert not os.path.exists(blob_path(content_hash))
+
+
+def test_borrado_en_segundo_plano_conserva_los_blobs_compartidos(shared, csrf_headers):
+    from delete_jobs import delete_user_in_background, run_pending_jobs
+    (first, second), content_hash = shared
+    own, own_hash = _upload(first[1], csrf_headers, 'propio.bin', os.urandom(1024))
+
+    ok, job_id = delete_user_in_background(first[0])
+    assert ok and job_id is not None
+    run_pending_jobs()
+
+    assert _refcount(content_hash) == 1
+    assert os.path.isfile(blob_path(content_hash))
+    assert not os.path.exists(blob_path(own_hash))
@@ -0,0 +1,92 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def stored(client, csrf_headers):
+    """Archivos subidos: {nombre almacenado: (nombre visible, contenido)}."""
+    result = {}
+    for name, data in (('informe.pdf', os.urandom(70 * 1024)), ('fotos/playa.jpg', os.urandom(1000)),
+                       ('vacio.txt', b'')):
+        r = client.put('/api/upload_stream', data=data, headers={**csrf_headers, 'X-Filename': name})
+        assert r.status_code == 200, r.json
+        result[r.json['filename']] = (name, data)
+    return result
+
+
+def _bundle(client, stored, fmt, **headers):
+    query = '&'.join(f'f={f}' for f in stored)
+    return client.get(f'/bundle?format={fmt}&{query}', headers=headers)
+
+
+def _by_content(stored):
+    return sorted(data for _, data in stored.values())
+
+
+def test_zip_valido(client, stored):
+    r = _bundle(client, stored, 'zip')
+
+    assert r.status_code == 200
+    body = r.get_data()
+    assert int(r.headers['Content-Length']) == len(body)
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        names = archive.namelist()
+        assert sorted(archive.read(n) for n in names) == _by_content(stored)
+    assert sorted(names) == ['fotos/playa.jpg', 'informe.pdf', 'vacio.txt']
+
+
+def test_nombres_dentro_del_paquete():
+    from bundles import _archive_name
+    used = set()
+    names = [_archive_name(n, used) for n in ('informe.pdf', 'INFORME.pdf', '../../etc/passwd', 'notas', 'notas')]
+    # Los repetidos reciben un sufijo en lugar de pisarse y no se escapa del directorio
+    assert names == ['informe.pdf', 'INFORME (2).pdf', 'etc/passwd', 'notas', 'notas (2)']
+
+
+def test_tar_valido(client, stored):
+    r = _bundle(client, stored, 'tar')
+
+    assert r.status_code == 200
+    body = r.get_data()
+    assert int(r.headers['Content-Length']) == len(body)
+    with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+        contents = sorted(archive.extractfile(m).read() for m in archive.getmembers())
+    assert contents == _by_content(stored)
+
+
+@pytest.mark.parametrize('start,end', [(0, 511), (100, 70000), (70 * 1024 + 300, None)])
+def test_rango_tar_coincide_con_el_paquete_completo(client, stored, start, end):
+    full = _bundle(client, stored, 'tar')
+    body = full.get_data()
+    spec = f'bytes={start}-{"" if end is None else end}'
+
+    r = _bundle(client, stored, 'tar', Range=spec, **{'If-Range': full.headers['ETag']})
+
+    assert r.status_code == 206
+    last = len(body) - 1 if end is None else end
+    assert r.headers['Content-Range'] == f'bytes {start}-{last}/{len(body)}'
+    assert r.get_data() == body[start:last + 1]
+
+
+def test_rango_tar_con_etag_antiguo_devuelve_todo(client, stored):
+    r = _bundle(client, stored, 'tar', Range='bytes=0-99', **{'If-Range': '"tar-otro"'})
+    assert r.status_code == 200
+    assert int(r.headers['Content-Length']) == len(r.get_data())
+
+
+def test_zip_no_admite_rangos(client, stored):
+    r = _bundle(client, stored, 'zip', Range='bytes=0-99')
+    assert r.status_code == 200
+    assert r.headers['Accept-Ranges'] == 'none'
+
+
+def test_archivo_ajeno_no_se_incluye(client_for, make_user, client, stored):
+    other = client_for(make_user())
+    r = _bundle(other, stored, 'zip')
+    assert r.status_code == 404
+    assert sorted(r.json['missing']) == sorted(stored)
@@ -0,0 +1,97 @@
+import os
+import hashlib
+import threading
+
+import pytest
+
+MB = 1024 * 1024
+RAW = {'Content-Type': 'application/octet-stream'}
+
+
+@pytest.fixture
+def upload(client, csrf_headers):
+    """Subida por chunks de 1MB con 3 chunks completos y uno parcial."""
+    data = os.urandom(3 * MB + 12345)
+    r = client.post('/api/chunk/init', json={'filename': 'datos.bin', 'total_size': len(data), 'chunk_size': MB},
+                    headers=csrf_headers)
+    assert r.status_code == 200, r.json
+    assert r.json['total_chunks'] == 4
+    return r.json['upload_id'], data
+
+
+def _put(client, csrf_headers, upload_id, index, data, sha256=None):
+    headers = {**csrf_headers, **RAW}
+    if sha256:
+        headers['X-Chunk-SHA256'] = sha256
+    return client.put(f'/api/chunk/upload/{upload_id}/{index}', data=data[index * MB:(index + 1) * MB], headers=headers)
+
+
+def _finalize(client, csrf_headers, upload_id):
+    return client.post('/api/chunk/finalize', json={'upload_id': upload_id}, headers=csrf_headers)
+
+
+def test_chunks_fuera_de_orden(client, csrf_headers, upload):
+    upload_id, data = upload
+    for index in (3, 1):
+        assert _put(client, csrf_headers, upload_id, index, data).status_code == 200
+
+    status = client.get(f'/api/chunk/status/{upload_id}').json
+    assert status['received_chunks'] == [1, 3]
+    assert status['missing_chunks'] == [0, 2]
+    assert status['received_ranges'] == [[MB, 2 * MB], [3 * MB, len(data)]]
+    r = _finalize(client, csrf_headers, upload_id)
+    assert r.status_code == 400
+    assert r.json['missing_chunks'] == [0, 2]
+
+    for index in (2, 0):
+        assert _put(client, csrf_headers, upload_id, index, data).status_code == 200
+    r = _finalize(client, csrf_headers, upload_id)
+
+    assert r.status_code == 200, r.json
+    assert r.json['sha256'] == hashlib.sha256(data).hexdigest()
+    assert client.get(f"/download/{r.json['filename']}").get_data() == data
+
+
+def test_chunks_en_paralelo(client_for, user_id, csrf_headers, upload):
+    upload_id, data = upload
+    results = {}
+
+    def send(index):
+        results[index] = _put(client_for(user_id), csrf_headers, upload_id, index, data).status_code
+    threads = [threading.Thread(target=send, args=(i,)) for i in (2, 0, 3, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {0: 200, 1: 200, 2: 200, 3: 200}
+    client = client_for(user_id)
+    r = _finalize(client, csrf_headers, upload_id)
+    assert r.status_code == 200, r.json
+    assert r.json['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+def test_chunk_repetido_es_idempotente(client, csrf_headers, upload):
+    upload_id, data = upload
+    for index in (0, 0, 1, 2, 3, 2):
+        assert _put(client, csrf_headers, upload_id, index, data).status_code == 200
+
+    assert client.get(f'/api/chunk/status/{upload_id}').json['received_bytes'] == len(data)
+    assert _finalize(client, csrf_headers, upload_id).json['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+def test_chunk_con_checksum_incorrecto_no_se_marca(client, csrf_headers, upload):
+    upload_id, data = upload
+    r = _put(client, csrf_headers, upload_id, 1, data, sha256=hashlib.sha256(b'otro').hexdigest())
+
+    assert r.status_code == 422
+    assert r.json['error_code'] == 'CHECKSUM_MISMATCH'
+    assert client.get(f'/api/chunk/status/{upload_id}').json['missing_chunks'] == [0, 1, 2, 3]
+    good = hashlib.sha256(data[MB:2 * MB]).hexdigest()
+    assert _put(client, csrf_headers, upload_id, 1, data, sha256=good).status_code == 200
+    assert client.get(f'/api/chunk/status/{upload_id}').json['received_chunks'] == [1]
+
+
+def test_chunk_fuera_de_rango(client, csrf_headers, upload):
+    upload_id, data = upload
+    assert _put(client, csrf_headers, upload_id, 4, data + b'x' * MB).status_code == 400
@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+import db_pool
+import migrations
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """Apuntar db_pool y las migraciones a una base aparte mientras dura la prueba."""
+    path = tmp_path / 'database.db'
+    monkeypatch.setattr(db_pool, 'DB_PATH', str(path))
+    monkeypatch.setattr(db_pool, '_pool', None)
+    monkeypatch.setattr(migrations, 'LOCK_PATH', str(path) + '.migrate.lock')
+    monkeypatch.setattr(migrations, '_capabilities', None)
+    yield path
+    pool = db_pool._get_pool()
+    while not pool.empty():
+        pool.get_nowait().close()
+
+
+def _tables():
+    return {r[0] for r in db_pool.fetchall("SELECT name FROM sqlite_master WHERE type='table'")}
+
+
+def test_migra_base_anterior_con_usuarios(legacy_db):
+    # Esquema de las primeras versiones: sin estado ni fecha_registro y con usuarios dentro
+    conn = sqlite3.connect(legacy_db)
+    conn.execute('''
+        CREATE TABLE usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            email TEXT UNIQUE,
+            password TEXT NOT NULL
+        )
+    ''')
+    conn.executemany('INSERT INTO usuarios (nombre, email, password) VALUES (?, ?, ?)',
+                     [('ana', 'ana@example.com', 'h1'), ('luis', 'luis@example.com', 'h2')])
+    conn.commit()
+    conn.close()
+
+    applied = migrations.run_migrations()
+
+    assert applied == [number for number, _, _ in migrations.MIGRATIONS]
+    assert migrations.current_version() == migrations.SCHEMA_VERSION
+    assert {'archivos', 'blobs', 'uploads_in_progress', 'upload_chunks', 'api_tokens'} <= _tables()
+    rows = db_pool.fetchall('SELECT nombre, estado, fecha_registro FROM usuarios ORDER BY id')
+    assert [r[0] for r in rows] == ['ana', 'luis']
+    assert all(r[1] == 'pendiente' and r[2] for r in rows)
+    # Los usuarios nuevos también reciben fecha aunque la columna no tenga default
+    db_pool.execute("INSERT INTO usuarios (nombre, email, password) VALUES ('eva', 'eva@example.com', 'h3')")
+    assert db_pool.fetchone("SELECT fecha_registro FROM usuarios WHERE nombre = 'eva'")[0]
+    assert db_pool.fetchall("SELECT rowid FROM usuarios_fts WHERE usuarios_fts MATCH '\"luis\"'")
+
+
+def test_migra_base_con_esquema_completo_anterior(legacy_db):
+    # Última versión antes de las migraciones versionadas: usuarios completo, user_version=0
+    conn = sqlite3.connect(legacy_db)
+    conn.execute('''
+        CREATE TABLE usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            email TEXT UNIQUE,
+            password TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("INSERT INTO usuarios (nombre, email, password, estado) VALUES ('ana', 'ana@example.com', 'h', 'activo')")
+    conn.commit()
+    conn.close()
+
+    migrations.run_migrations()
+
+    assert migrations.current_version() == migrations.SCHEMA_VERSION
+    assert db_pool.fetchone('SELECT estado FROM usuarios')[0] == 'activo'
+    # Volver a ejecutar no aplica nada
+    assert migrations.run_migrations() == []
+
+
+def test_migra_base_vacia(legacy_db):
+    migrations.run_migrations()
+    assert migrations.current_version() == migrations.SCHEMA_VERSION
+    db_pool.execute("INSERT INTO usuarios (nombre, email, password) VALUES ('ana', 'ana@example.com', 'h')")
+    assert db_pool.fetchone('SELECT fecha_registro FROM usuarios')[0]
@@ -0,0 +1,180 @@
+import io
+import tarfile
+
+import pytest
+
+from db_logic import set_user_quota
+
+KB = 1024
+
+
+@pytest.fixture
+def quota(user_id):
+    """Fijar la cuota en bytes del usuario de la prueba."""
+    def set_quota(max_bytes):
+        assert set_user_quota(user_id, max_bytes, None)
+    return set_quota
+
+
+def _tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _chunked_upload(client, csrf_headers, payload, **init):
+    r = client.post('/api/chunk/init', json={'filename': 'lote.tar', 'total_size': len(payload), **init},
+                    headers=csrf_headers)
+    assert r.status_code == 200, r.json
+    upload_id, chunk_size = r.json['upload_id'], r.json['chunk_size']
+    for index in range(r.json['total_chunks']):
+        piece = payload[index * chunk_size:(index + 1) * chunk_size]
+        r = client.put(f'/api/chunk/upload/{upload_id}/{index}', data=piece,
+                       headers={**csrf_headers, 'Content-Type': 'application/octet-stream'})
+        assert r.status_code == 200, r.json
+    return upload_id
+
+
+def _finalize(client, csrf_headers, upload_id):
+    return client.post('/api/chunk/finalize', json={'upload_id': upload_id}, headers=csrf_headers)
+
+
+def test_lote_tar_por_encima_de_media_cuota(client, csrf_headers, quota):
+    # La reserva de la propia sesión tar no debe contar contra el lote que se desempaqueta
+    payload = _tar({'fotos/a.bin': b'a' * (300 * KB), 'fotos/b.bin': b'b' * (300 * KB)})
+    quota(len(payload) + 100 * KB)
+    upload_id = _chunked_upload(client, csrf_headers, payload, batch='tar')
+
+    r = _finalize(client, csrf_headers, upload_id)
+
+    assert r.status_code == 200, r.json
+    assert sorted(f['display_name'] for f in r.json['files']) == ['fotos/a.bin', 'fotos/b.bin']
+    assert client.get(f'/api/chunk/status/{upload_id}').status_code == 404
+
+
+def test_lote_tar_que_ya_no_cabe_en_la_cuota(client, csrf_headers, quota, user_id):
+    from db_logic import get_user_file_records
+    payload = _tar({'a.bin': b'a' * (300 * KB), 'b.bin': b'b' * (300 * KB)})
+    quota(len(payload))
+    upload_id = _chunked_upload(client, csrf_headers, payload, batch='tar')
+    # El administrador reduce la cuota mientras el tar se sube
+    quota(400 * KB)
+
+    r = _finalize(client, csrf_headers, upload_id)
+
+    assert r.status_code == 413
+    assert r.json['error_code'] == 'QUOTA_EXCEEDED'
+    assert get_user_file_records(user_id) == []
+
+
+def _chunk_init(client, csrf_headers, size, **extra):
+    return client.post('/api/chunk/init', json={'filename': 'a.bin', 'total_size': size, **extra},
+                       headers=csrf_headers)
+
+
+def test_subidas_en_curso_reservan_cuota(client, csrf_headers, quota):
+    quota(1024 * KB)
+    assert _chunk_init(client, csrf_headers, 700 * KB).status_code == 200
+
+    r = _chunk_init(client, csrf_headers, 700 * KB)
+
+    assert r.status_code == 413
+    assert r.json['error_code'] == 'QUOTA_EXCEEDED'
+
+
+def test_finalizar_chunks_no_cuenta_su_propia_reserva(client, csrf_headers, quota, user_id):
+    from uploads import quota_remaining
+    quota(1024 * KB)
+    data = b'c' * (700 * KB)
+    upload_id = _chunked_upload(client, csrf_headers, data)
+
+    r = _finalize(client, csrf_headers, upload_id)
+
+    assert r.status_code == 200, r.json
+    assert quota_remaining(user_id)[0] == 324 * KB
+
+
+def test_reanudar_no_cuenta_dos_veces_la_reserva(client, csrf_headers, quota):
+    import hashlib
+    quota(1536 * KB)
+    chunk = 1024 * KB
+    data = b'r' * chunk + b's' * (300 * KB)
+    hashes = [hashlib.sha256(data[:chunk]).hexdigest(), hashlib.sha256(data[chunk:]).hexdigest()]
+    first = _chunk_init(client, csrf_headers, len(data), chunk_size=chunk, chunk_hashes=hashes)
+    assert first.status_code == 200
+    upload_id = first.json['upload_id']
+    r = client.put(f'/api/chunk/upload/{upload_id}/0', data=data[:chunk],
+                   headers={**csrf_headers, 'Content-Type': 'application/octet-stream'})
+    assert r.status_code == 200
+
+    # Mismo archivo: se adopta la subida abierta en lugar de reservar otra
+    second = _chunk_init(client, csrf_headers, len(data), chunk_size=chunk, chunk_hashes=hashes)
+
+    assert second.status_code == 200, second.json
+    assert second.json['upload_id'] == upload_id
+    assert second.json['received_chunks'] == [0]
+
+
+def test_reanudacion_sin_chunks_comunes_reserva_aparte(client, csrf_headers, quota):
+    import hashlib
+    quota(1024 * KB)
+    data = b'r' * (700 * KB)
+    hashes = [hashlib.sha256(data).hexdigest()]
+    assert _chunk_init(client, csrf_headers, len(data), chunk_hashes=hashes).status_code == 200
+
+    # Nada que retomar (no llegó ningún chunk): la nueva subida necesita su propia reserva
+    r = _chunk_init(client, csrf_headers, len(data), chunk_hashes=hashes)
+
+    assert r.status_code == 413
+    assert r.json['error_code'] == 'QUOTA_EXCEEDED'
+
+
+TUS = {'Tus-Resumable': '1.0.0'}
+
+
+def _tus_create(client, csrf_headers, size, concat=None):
+    headers = {**csrf_headers, **TUS, 'Upload-Length': str(size), 'Upload-Metadata': 'filename YS5iaW4='}
+    if concat:
+        headers['Upload-Concat'] = concat
+    return client.post('/api/tus/', headers=headers)
+
+
+def _tus_patch(client, csrf_headers, location, offset, data):
+    return client.patch(location, data=data, headers={**csrf_headers, **TUS, 'Upload-Offset': str(offset),
+                                                      'Content-Type': 'application/offset+octet-stream'})
+
+
+def test_tus_reserva_y_completa_dentro_de_la_cuota(client, csrf_headers, quota, user_id):
+    from uploads import quota_remaining
+    quota(1024 * KB)
+    r = _tus_create(client, csrf_headers, 700 * KB)
+    assert r.status_code == 201
+    location = r.headers['Location']
+    assert _tus_create(client, csrf_headers, 700 * KB).status_code == 413
+
+    r = _tus_patch(client, csrf_headers, location, 0, b't' * (700 * KB))
+
+    assert r.status_code == 204
+    assert r.headers['Upload-Offset'] == str(700 * KB)
+    # Completada: cuenta en el catálogo, no como reserva además
+    assert quota_remaining(user_id)[0] == 324 * KB
+
+
+def test_tus_concatenacion_reemplaza_las_reservas_parciales(client, csrf_headers, quota, user_id):
+    from uploads import quota_remaining
+    quota(1024 * KB)
+    locations = []
+    for part in (b'x' * (400 * KB), b'y' * (400 * KB)):
+        r = _tus_create(client, csrf_headers, len(part), 'partial')
+        assert r.status_code == 201
+        assert _tus_patch(client, csrf_headers, r.headers['Location'], 0, part).status_code == 204
+        locations.append(r.headers['Location'])
+
+    r = _tus_create(client, csrf_headers, 0, 'final;' + ' '.join(locations))
+
+    assert r.status_code == 201
+    assert quota_remaining(user_id)[0] == 224 * KB
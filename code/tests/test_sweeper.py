@@ -0,0 +1,61 @@
+import pytest
+
+import db_pool
+import sweeper
+from db_logic import get_user_file_records
+
+
+def _upload_expired(client, csrf_headers, user_id, name, data):
+    r = client.put('/api/upload_stream', data=data, headers={**csrf_headers, 'X-Filename': name})
+    assert r.status_code == 200, r.json
+    db_pool.execute("UPDATE archivos SET expires_date = '2000-01-01T00:00:00' WHERE user_id = ? AND filename = ?",
+                    (user_id, r.json['filename']))
+    return r.json['filename']
+
+
+@pytest.fixture
+def two_users(make_user, client_for, csrf_headers):
+    users = []
+    for n in range(2):
+        uid = make_user()
+        client = client_for(uid)
+        users.append((uid, client, _upload_expired(client, csrf_headers, uid, f'v{n}.txt', b'viejo %d' % n)))
+    return users
+
+
+def test_cleanup_despierta_el_barrido_sin_ejecutarlo(two_users, csrf_headers, monkeypatch):
+    (uid, client, _), (other_id, _, _) = two_users
+    monkeypatch.setattr(sweeper, '_started', True)
+    monkeypatch.setattr(sweeper, '_last_pass', 0.0)
+    monkeypatch.setattr(sweeper, 'run_sweep', lambda: pytest.fail('barrido en el hilo de la petición'))
+    sweeper._wakeup.clear()
+
+    r = client.post('/api/cleanup_expired', headers=csrf_headers)
+
+    assert r.status_code == 202
+    assert 'files' not in r.json and 'bytes' not in r.json
+    assert sweeper._wakeup.is_set()
+    assert len(get_user_file_records(uid)) == 1 and len(get_user_file_records(other_id)) == 1
+    sweeper._wakeup.clear()
+
+
+def test_cleanup_no_repite_pasadas_recientes(two_users, csrf_headers, monkeypatch):
+    (_, client, _), _ = two_users
+    monkeypatch.setattr(sweeper, '_started', True)
+    monkeypatch.setattr(sweeper, '_last_pass', sweeper.time.monotonic())
+    sweeper._wakeup.clear()
+
+    assert client.post('/api/cleanup_expired', headers=csrf_headers).status_code == 202
+    assert not sweeper._wakeup.is_set()
+
+
+def test_cleanup_sin_barrido_solo_limpia_lo_propio(two_users, csrf_headers, monkeypatch):
+    (uid, client, filename), (other_id, _, _) = two_users
+    monkeypatch.setattr(sweeper, '_started', False)
+
+    r = client.post('/api/cleanup_expired', headers=csrf_headers)
+
+    assert r.status_code == 200
+    assert r.json['files'] == [filename]
+    assert get_user_file_records(uid) == []
+    assert len(get_user_file_records(other_id)) == 1
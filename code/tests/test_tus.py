@@ -0,0 +1,194 @@
+import os
+import base64
+import hashlib
+
+import pytest
+
+from db_logic import get_user_file_records
+
+TUS = {'Tus-Resumable': '1.0.0'}
+OFFSET_STREAM = {'Content-Type': 'application/offset+octet-stream'}
+
+
+def _metadata(filename):
+    return 'filename ' + base64.b64encode(filename.encode()).decode()
+
+
+def _checksum(algorithm, data):
+    return f'{algorithm} ' + base64.b64encode(hashlib.new(algorithm, data).digest()).decode()
+
+
+@pytest.fixture
+def tus(client, csrf_headers):
+    """Crear una subida tus y devolver (cliente, cabeceras, location)."""
+    headers = {**csrf_headers, **TUS}
+
+    def create(size, filename='datos.bin'):
+        r = client.post('/api/tus/', headers={**headers, 'Upload-Length': str(size), 'Upload-Metadata': _metadata(filename)})
+        assert r.status_code == 201, r.data
+        return r.headers['Location']
+    return client, headers, create
+
+
+def _patch(client, headers, location, offset, data, **extra):
+    return client.patch(location, data=data, headers={**headers, **OFFSET_STREAM, 'Upload-Offset': str(offset), **extra})
+
+
+def test_options_anuncia_extensiones(client):
+    r = client.options('/api/tus/')
+    assert r.status_code == 204
+    assert set(r.headers['Tus-Extension'].split(',')) == {'creation', 'termination', 'checksum', 'concatenation'}
+    assert 'sha256' in r.headers['Tus-Checksum-Algorithm']
+
+
+def test_version_requerida(client, csrf_headers):
+    r = client.post('/api/tus/', headers={**csrf_headers, 'Upload-Length': '1', 'Upload-Metadata': _metadata('a.bin')})
+    assert r.status_code == 412
+
+
+def test_subida_por_tramos_y_reanudacion(tus, user_id):
+    client, headers, create = tus
+    data = os.urandom(300 * 1024)
+    location = create(len(data))
+    assert client.head(location, headers=headers).headers['Upload-Offset'] == '0'
+
+    assert _patch(client, headers, location, 0, data[:100000]).headers['Upload-Offset'] == '100000'
+    # Offset que no coincide con el del servidor: 409 con el offset real
+    r = _patch(client, headers, location, 50000, data[50000:])
+    assert r.status_code == 409
+    assert client.head(location, headers=headers).headers['Upload-Offset'] == '100000'
+
+    r = _patch(client, headers, location, 100000, data[100000:])
+
+    assert r.status_code == 204
+    assert r.headers['Upload-Offset'] == str(len(data))
+    stored = get_user_file_records(user_id)[0]
+    assert stored['original_name'] == 'datos.bin'
+    assert client.get(f"/download/{stored['filename']}").get_data() == data
+
+
+def test_checksum_incorrecto_no_avanza_el_offset(tus):
+    client, headers, create = tus
+    data = os.urandom(4096)
+    location = create(len(data))
+
+    r = _patch(client, headers, location, 0, data, **{'Upload-Checksum': _checksum('sha256', b'otro')})
+
+    assert r.status_code == 460
+    assert client.head(location, headers=headers).headers['Upload-Offset'] == '0'
+    r = _patch(client, headers, location, 0, data, **{'Upload-Checksum': _checksum('sha256', data)})
+    assert r.status_code == 204
+    assert r.headers['Upload-Offset'] == str(len(data))
+
+
+@pytest.mark.parametrize('algorithm', ['sha1', 'md5'])
+def test_checksum_por_tramo(tus, algorithm):
+    client, headers, create = tus
+    data = os.urandom(8192)
+    location = create(len(data))
+    # Cada PATCH se verifica con el checksum de su propio tramo
+    for offset in (0, 4096):
+        piece = data[offset:offset + 4096]
+        r = _patch(client, headers, location, offset, piece, **{'Upload-Checksum': _checksum(algorithm, piece)})
+        assert r.status_code == 204
+    assert r.headers['Upload-Offset'] == str(len(data))
+
+
+def test_checksum_con_algoritmo_no_soportado(tus):
+    client, headers, create = tus
+    location = create(10)
+    r = _patch(client, headers, location, 0, b'0123456789', **{'Upload-Checksum': 'crc32 AAAA'})
+    assert r.status_code == 400
+
+
+def test_datos_por_encima_de_upload_length(tus):
+    client, headers, create = tus
+    location = create(10)
+    assert _patch(client, headers, location, 0, b'x' * 11).status_code == 413
+
+
+def test_method_override(tus):
+    client, headers, create = tus
+    location = create(4)
+    override = {**headers, **OFFSET_STREAM, 'Upload-Offset': '0', 'X-HTTP-Method-Override': 'PATCH'}
+    r = client.post(location, data=b'hola', headers=override)
+    assert r.status_code == 204
+    assert r.headers['Upload-Offset'] == '4'
+
+
+def test_terminacion(tus):
+    client, headers, create = tus
+    location = create(100)
+    assert client.delete(location, headers=headers).status_code == 204
+    assert client.head(location, headers=headers).status_code == 404
+
+
+def test_concatenacion(tus):
+    client, headers, create = tus
+    parts = [os.urandom(5000), os.urandom(7000)]
+    locations = []
+    for part in parts:
+        r = client.post('/api/tus/', headers={**headers, 'Upload-Length': str(len(part)), 'Upload-Concat': 'partial'})
+        assert r.status_code == 201
+        assert _patch(client, headers, r.headers['Location'], 0, part).status_code == 204
+        locations.append(r.headers['Location'])
+
+    r = client.post('/api/tus/', headers={**headers, 'Upload-Metadata': _metadata('unido.bin'),
+                                          'Upload-Concat': 'final;' + ' '.join(locations)})
+
+    assert r.status_code == 201
+    head = client.head(r.headers['Location'], headers=headers)
+    assert head.headers['Upload-Offset'] == str(len(parts[0]) + len(parts[1]))
+    assert all(client.head(loc, headers=headers).status_code == 404 for loc in locations)
+
+
+# ---------------- Tokens de API (Authorization: Bearer) ----------------
+
+@pytest.fixture
+def api_token(client, csrf_headers):
+    r = client.post('/api/tokens', json={'name': 'cli'}, headers=csrf_headers)
+    assert r.status_code == 201
+    return r.json['id'], r.json['token']
+
+
+def _create_headers(size=4):
+    return {**TUS, 'Upload-Length': str(size), 'Upload-Metadata': _metadata('token.bin')}
+
+
+def test_bearer_sin_cookie_ni_csrf(flask_app, api_token):
+    _, token = api_token
+    anonymous = flask_app.test_client()
+    auth = {'Authorization': f'Bearer {token}'}
+
+    r = anonymous.post('/api/tus/', headers={**_create_headers(), **auth})
+    assert r.status_code == 201
+    r = _patch(anonymous, {**TUS, **auth}, r.headers['Location'], 0, b'hola')
+
+    assert r.status_code == 204
+    assert r.headers['Upload-Offset'] == '4'
+
+
+def test_bearer_invalido_no_recurre_a_la_cookie(client, csrf_headers):
+    r = client.post('/api/tus/', headers={**_create_headers(), **csrf_headers, 'Authorization': 'Bearer ft_malo'})
+    assert r.status_code == 401
+    assert r.headers['WWW-Authenticate'].startswith('Bearer')
+
+
+def test_cookie_sin_csrf_sigue_rechazada(client):
+    assert client.post('/api/tus/', headers=_create_headers()).status_code == 400
+
+
+def test_token_revocado(flask_app, client, csrf_headers, api_token):
+    token_id, token = api_token
+    assert client.delete(f'/api/tokens/{token_id}', headers=csrf_headers).status_code == 200
+
+    r = flask_app.test_client().post('/api/tus/', headers={**_create_headers(), 'Authorization': f'Bearer {token}'})
+
+    assert r.status_code == 401
+
+
+def test_token_solo_vale_para_tus(flask_app, api_token):
+    # Fuera de las rutas tus el token no autentica ni exime del CSRF
+    _, token = api_token
+    r = flask_app.test_client().post('/api/tokens', json={}, headers={'Authorization': f'Bearer {token}'})
+    assert r.status_code == 400
@@ -0,0 +1,372 @@
+"""
+Servidor de transferencias asíncrono (aiohttp) para las rutas de subida y descarga.
+
+Con gunicorn+gevent cada transferencia larga ocupa un worker durante horas y la E/S de disco
+bloquea el hub. Este servicio atiende las mismas rutas (`/api/chunk/*`, `/api/upload_progress`,
+`/api/upload_stream` y `/download/<filename>`) sobre asyncio:
+
+- El cuerpo se lee del socket sin bloquear y se escribe por lotes de READ_SIZE en un pool de
+  hilos acotado (TRANSFER_IO_THREADS); mientras un lote se escribe se lee el siguiente.
+- Las consultas a SQLite y el registro en el catálogo también van al pool.
+- Las descargas usan FileResponse (sendfile desde el bucle, Range incluido), con la misma
+  compresión negociada que Flask (variants.py).
+- Sesión, CSRF y almacenamiento son los de la app Flask: la cookie se valida con su mismo
+  serializador (misma SECRET_KEY) y la escritura pasa por UploadWriter/ChunkWriter de uploads.py.
+
+Arranque: `python transfer_server.py` (TRANSFER_HOST/TRANSFER_PORT, por defecto 0.0.0.0:3001),
+detrás del proxy que enruta esas rutas aquí y el resto a gunicorn.
+"""
+import os
+import asyncio
+import functools
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web  # type: ignore
+from itsdangerous import BadSignature  # type: ignore
+from checksums import parse_sha256, digest_headers  # type: ignore
+from downloads import content_disposition, READ_CHUNK_SIZE  # type: ignore
+from streaming import READ_SIZE, MAX_FIELD_SIZE  # type: ignore
+from variants import negotiable, select_variant  # type: ignore
+from uploads import (  # type: ignore
+    UploadWriter, ChunkWriter, admission_error, allowed_file, start_chunked_upload,
+    upload_status, finalize_resumable_upload, resolve_download, count_download
+)
+
+IO_THREADS = int(os.environ.get('TRANSFER_IO_THREADS', '32'))
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='transfer-io')
+
+# Serializador de la cookie de sesión de Flask (se fija en create_app)
+_session = {'serializer': None, 'cookie': 'session', 'max_age': None}
+
+
+async def run_io(func, *args):
+    """Ejecutar E/S bloqueante (disco, SQLite) en el pool sin detener el bucle."""
+    return await asyncio.get_running_loop().run_in_executor(_io_pool, functools.partial(func, *args))
+
+
+def load_session(request):
+    cookie = request.cookies.get(_session['cookie'])
+    if not cookie:
+        return {}
+    try:
+        return _session['serializer'].loads(cookie, max_age=_session['max_age'])
+    except BadSignature:
+        return {}
+
+
+def json_result(request, result):
+    """(dict, status) -> JSON; si se rechaza sin haber leído el cuerpo, se cierra la conexión."""
+    result, status_code = result
+    response = web.json_response(result, status=status_code)
+    if status_code >= 400 and not request.content.is_eof():
+        response.force_close()
+    return response
+
+
+def requires_session(csrf=True):
+    """Sesión iniciada y (salvo csrf=False) cabecera X-CSRF-Token igual a la de la sesión."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            session = load_session(request)
+            if csrf:
+                token = session.get('_csrf')
+                if not token or request.headers.get('X-CSRF-Token') != token:
+                    response = web.Response(text='CSRF token inválido', status=400)
+                    response.force_close()
+                    return response
+            if 'user_id' not in session:
+                return json_result(request, ({'error': 'No autorizado'}, 401))
+            request['session'] = session
+            return await handler(request, session['user_id'])
+        return wrapper
+    return decorator
+
+
+def _declared_upload_length(request):
+    value = request.headers.get('X-Upload-Length')
+    return int(value) if value and value.isdigit() else None
+
+
+async def _iter_body(request):
+    async for data in request.content.iter_any():
+        yield data
+
+
+async def _iter_part(part):
+    while True:
+        data = await part.read_chunk(READ_SIZE)
+        if not data:
+            return
+        yield data
+
+
+async def _read_field(part):
+    value = bytearray()
+    async for data in _iter_part(part):
+        value += data
+        if len(value) > MAX_FIELD_SIZE:
+            raise ValueError(f'Campo {part.name} demasiado grande')
+    return value.decode('utf-8', 'replace')
+
+
+async def pump(chunks, writer):
+    """Pasar un cuerpo asíncrono a `writer` por lotes de READ_SIZE.
+
+    Cada lote se escribe en el pool mientras se sigue leyendo el siguiente; retorna False
+    si el writer cortó la escritura (límite superado).
+    """
+    loop = asyncio.get_running_loop()
+    pending = None
+    batch = bytearray()
+    try:
+        async for data in chunks:
+            batch += data
+            if len(batch) < READ_SIZE:
+                continue
+            if pending is not None and not await pending:
+                return False
+            pending = loop.run_in_executor(_io_pool, writer.write, batch)
+            batch = bytearray()
+        if pending is not None and not await pending:
+            return False
+        pending = None
+        return await run_io(writer.write, batch) if batch else True
+    except BaseException:
+        # No liberar el writer mientras un lote sigue escribiéndose en otro hilo
+        if pending is not None:
+            await asyncio.wait([pending])
+        raise
+
+
+async def run_writer(writer, chunks):
+    """open -> pump -> finish de un UploadWriter/ChunkWriter; retorna (dict, status)."""
+    try:
+        rejected = await run_io(writer.open)
+        if rejected:
+            return rejected
+        await pump(chunks, writer)
+        return await run_io(writer.finish)
+    except (Exception, asyncio.CancelledError) as e:
+        result = await asyncio.shield(run_io(writer.fail, e))
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        return result
+
+
+# ------------------------------ Subidas ------------------------------
+
+@requires_session(csrf=False)
+async def upload_progress(request, user_id):
+    """Igual que /api/upload_progress: multipart con el archivo en el campo `file`."""
+    rejected = await run_io(admission_error, user_id, False, request.content_length, True,
+                            _declared_upload_length(request))
+    if rejected:
+        return json_result(request, rejected)
+    if request.content_type != 'multipart/form-data':
+        return json_result(request, ({'error': 'No se seleccionó archivo'}, 400))
+    try:
+        expected_sha256 = parse_sha256(request.headers.get('X-Content-SHA256'))
+    except ValueError as e:
+        return json_result(request, ({'error': str(e)}, 400))
+    # Como en Flask, el token puede ir en la cabecera o en un campo `_csrf` previo al archivo
+    token = request['session'].get('_csrf')
+    csrf_ok = bool(token) and request.headers.get('X-CSRF-Token') == token
+    try:
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == '_csrf' and part.filename is None:
+                csrf_ok = csrf_ok or (bool(token) and await _read_field(part) == token)
+                continue
+            if part.name != 'file':
+                continue
+            if not csrf_ok:
+                return json_result(request, ({'error': 'CSRF token inválido'}, 400))
+            if not part.filename or not allowed_file(part.filename):
+                return json_result(request, ({'error': 'No se seleccionó ningún archivo'}, 400))
+            writer = UploadWriter(user_id, part.filename, _declared_upload_length(request), expected_sha256)
+            return json_result(request, await run_writer(writer, _iter_part(part)))
+    except ValueError as e:
+        return json_result(request, ({'error': f'Cuerpo inválido: {e}'}, 400))
+    return json_result(request, ({'error': 'No se seleccionó archivo'}, 400))
+
+
+@requires_session()
+async def upload_stream(request, user_id):
+    """Igual que /api/upload_stream: multipart (primera parte con archivo) o cuerpo crudo."""
+    multipart = request.content_type == 'multipart/form-data'
+    declared = _declared_upload_length(request)
+    rejected = await run_io(admission_error, user_id, False, request.content_length, multipart, declared)
+    if rejected:
+        return json_result(request, rejected)
+    try:
+        expected_sha256 = parse_sha256(request.headers.get('X-Content-SHA256'))
+    except ValueError as e:
+        return json_result(request, ({'error': str(e)}, 400))
+    if not multipart:
+        original_filename = unquote(request.headers.get('X-Filename') or request.query.get('filename') or '').strip()
+        if not allowed_file(original_filename):
+            return json_result(request, ({'error': 'Nombre de archivo requerido (cabecera X-Filename)'}, 400))
+        writer = UploadWriter(user_id, original_filename, declared or request.content_length, expected_sha256)
+        return json_result(request, await run_writer(writer, _iter_body(request)))
+    try:
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename is None:
+                continue  # campos (_csrf, etc.) se descartan
+            if not part.filename or not allowed_file(part.filename):
+                break
+            writer = UploadWriter(user_id, part.filename, declared, expected_sha256)
+            return json_result(request, await run_writer(writer, _iter_part(part)))
+    except ValueError as e:
+        return json_result(request, ({'error': f'Cuerpo inválido: {e}'}, 400))
+    return json_result(request, ({'error': 'No se seleccionó ningún archivo'}, 400))
+
+
+@requires_session()
+async def chunk_init(request, user_id):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    return json_result(request, await run_io(start_chunked_upload, user_id, data if isinstance(data, dict) else {}))
+
+
+def _chunk_admission(request, user_id):
+    rejected = admission_error(user_id, True, request.content_length)
+    if rejected:
+        return rejected
+    try:
+        parse_sha256(request.headers.get('X-Chunk-SHA256'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return None
+
+
+@requires_session()
+async def chunk_upload_raw(request, user_id):
+    """Chunk como cuerpo crudo en /api/chunk/upload/<upload_id>/<indice>."""
+    rejected = _chunk_admission(request, user_id)
+    if rejected:
+        return json_result(request, rejected)
+    writer = ChunkWriter(user_id, request.match_info['upload_id'], int(request.match_info['chunk_index']),
+                         parse_sha256(request.headers.get('X-Chunk-SHA256')))
+    return json_result(request, await run_writer(writer, _iter_body(request)))
+
+
+@requires_session()
+async def chunk_upload(request, user_id):
+    """Chunk en multipart: campos upload_id, chunk_index (y chunk_sha256) antes de la parte `chunk`."""
+    rejected = _chunk_admission(request, user_id)
+    if rejected:
+        return json_result(request, rejected)
+    if request.content_type != 'multipart/form-data':
+        return json_result(request, ({'error': 'Se esperaba multipart/form-data'}, 400))
+    fields = {}
+    try:
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name != 'chunk':
+                fields[part.name] = await _read_field(part)
+                continue
+            upload_id = fields.get('upload_id')
+            try:
+                chunk_index = int(fields.get('chunk_index', -1))
+            except ValueError:
+                return json_result(request, ({'error': 'chunk_index inválido'}, 400))
+            if not upload_id or chunk_index < 0:
+                return json_result(request, ({'error': 'Parámetros incompletos'}, 400))
+            chunk_sha256 = parse_sha256(request.headers.get('X-Chunk-SHA256')) or parse_sha256(fields.get('chunk_sha256'))
+            writer = ChunkWriter(user_id, upload_id, chunk_index, chunk_sha256)
+            return json_result(request, await run_writer(writer, _iter_part(part)))
+    except ValueError as e:
+        return json_result(request, ({'error': f'Cuerpo inválido: {e}'}, 400))
+    return json_result(request, ({'error': 'Parámetros incompletos'}, 400))
+
+
+@requires_session(csrf=False)
+async def chunk_status(request, user_id):
+    return json_result(request, await run_io(upload_status, user_id, request.match_info['upload_id']))
+
+
+@requires_session()
+async def chunk_finalize(request, user_id):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    upload_id = data.get('upload_id') if isinstance(data, dict) else None
+    if not upload_id:
+        return json_result(request, ({'error': 'upload_id requerido'}, 400))
+    return json_result(request, await run_io(finalize_resumable_upload, user_id, upload_id))
+
+
+# ------------------------------ Descargas ------------------------------
+
+async def download(request):
+    """Archivo propio (con sesión) o público, como /download/<filename> en Flask."""
+    filename = request.match_info['filename']
+    target = await run_io(resolve_download, filename, load_session(request).get('user_id'))
+    if not target:
+        return web.Response(text='Archivo no encontrado o expirado', status=404)
+    path, display_name, content_hash = target
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'Content-Disposition': content_disposition(display_name),
+        'Accept-Ranges': 'bytes',
+    }
+    selected = None
+    if negotiable(path, display_name, content_hash):
+        headers['Vary'] = 'Accept-Encoding'
+        selected = await run_io(select_variant, path, request.headers.get('Accept-Encoding'))
+    if selected:
+        # Variante comprimida en caché (variants.py); FileResponse aplica el Range sobre ella
+        path, headers['Content-Encoding'] = selected
+    elif content_hash:
+        # FileResponse fija su propio ETag (mtime/tamaño); Digest sigue siendo el SHA-256
+        headers.update({k: v for k, v in digest_headers(content_hash).items() if k != 'ETag'})
+    request['count_download'] = True
+    return web.FileResponse(path, chunk_size=READ_CHUNK_SIZE, headers=headers)
+
+
+async def _count_download(request, response):
+    if request.get('count_download'):
+        # Sin esperar: la actividad diaria no debe retrasar el envío
+        asyncio.get_running_loop().run_in_executor(
+            _io_pool, count_download, response.status, request.headers.get('Range'))
+
+
+async def _shutdown_pool(app):
+    _io_pool.shutdown(wait=True)
+
+
+def create_app():
+    """Aplicación aiohttp con la misma configuración (SECRET_KEY, BD, migraciones) que app.main().
+
+    Los hilos de fondo (barrido de expirados, cola de borrados) y las importaciones de datos
+    legados sólo corren en la app Flask; aquí no se duplican."""
+    from app import main as create_flask_app  # type: ignore
+    flask_app = create_flask_app(background_workers=False)
+    _session['serializer'] = flask_app.session_interface.get_signing_serializer(flask_app)
+    _session['cookie'] = flask_app.config['SESSION_COOKIE_NAME']
+    _session['max_age'] = int(flask_app.permanent_session_lifetime.total_seconds())
+
+    app = web.Application()
+    app.router.add_post('/api/upload_progress', upload_progress)
+    app.router.add_post('/api/upload_stream', upload_stream)
+    app.router.add_put('/api/upload_stream', upload_stream)
+    app.router.add_post('/api/chunk/init', chunk_init)
+    app.router.add_post('/api/chunk/upload', chunk_upload)
+    app.router.add_put('/api/chunk/upload/{upload_id}/{chunk_index:\\d+}', chunk_upload_raw)
+    app.router.add_get('/api/chunk/status/{upload_id}', chunk_status)
+    app.router.add_post('/api/chunk/finalize', chunk_finalize)
+    app.router.add_get('/download/{filename}', download)
+    app.on_response_prepare.append(_count_download)
+    app.on_cleanup.append(_shutdown_pool)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host=os.environ.get('TRANSFER_HOST', '0.0.0.0'),
+                port=int(os.environ.get('TRANSFER_PORT', '3001')))
@@ -0,0 +1,205 @@
+"""
+Servidor tus 1.0 (https://tus.io/protocols/resumable-upload) sobre las subidas resumibles.
+
+- Extensiones: creation, termination, checksum (sha1, sha256, md5) y concatenation.
+- POST /api/tus/ crea la subida (Upload-Length, Upload-Metadata con `filename`) y responde
+  su URL en Location; HEAD da el offset actual; PATCH (application/offset+octet-stream)
+  escribe desde Upload-Offset; DELETE la descarta.
+- Concatenación: varias subidas `Upload-Concat: partial` pueden enviarse en paralelo y
+  unirse con un POST `Upload-Concat: final;<url> <url> ...`.
+- El estado vive en uploads_in_progress (protocol='tus'); ver las subidas por offset en
+  uploads.py. Autenticación con `Authorization: Bearer <token de API>` (clientes tus de
+  línea de comandos o librerías; tokens en /api/tokens) o con la cookie de sesión y
+  X-CSRF-Token, como el resto de la API.
+"""
+import base64
+import binascii
+import hashlib
+from urllib.parse import urlparse
+from flask import request, Response, url_for  # type: ignore
+from werkzeug.exceptions import ClientDisconnected  # type: ignore
+from streaming import iter_body  # type: ignore
+from uploads import (  # type: ignore
+    allowed_file, get_offset_upload, start_offset_upload, append_at_offset,
+    concatenate_uploads, terminate_offset_upload
+)
+
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,termination,checksum,concatenation'
+CHECKSUM_ALGORITHMS = ('sha1', 'sha256', 'md5')
+
+# Códigos de error internos con un status propio en el protocolo
+_TUS_STATUS = {
+    'CHECKSUM_MISMATCH': 460,
+    'OFFSET_MISMATCH': 409,
+}
+
+
+def tus_response(status=204, headers=None, body=''):
+    response = Response(body, status=status, mimetype='text/plain')
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    response.headers['Cache-Control'] = 'no-store'
+    for key, value in (headers or {}).items():
+        response.headers[key] = value
+    return response
+
+
+def _error(result, status_code):
+    status_code = _TUS_STATUS.get(result.get('error_code'), status_code)
+    headers = {'Upload-Offset': str(result['offset'])} if 'offset' in result else None
+    return tus_response(status_code, headers, result.get('error', ''))
+
+
+def parse_metadata(header):
+    """Upload-Metadata: pares `clave valor-base64` separados por comas (el valor es opcional)."""
+    metadata = {}
+    if not header:
+        return metadata
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+        if not key:
+            raise ValueError('Upload-Metadata mal formado')
+        try:
+            metadata[key] = base64.b64decode(value.strip(), validate=True).decode('utf-8') if value.strip() else ''
+        except (binascii.Error, ValueError):
+            raise ValueError(f'Upload-Metadata: valor inválido para {key}')
+    return metadata
+
+
+def parse_checksum(header):
+    """Upload-Checksum: `<algoritmo> <digest en base64>`. Retorna (hasher, digest) o None."""
+    if not header:
+        return None
+    algorithm, _, encoded = header.strip().partition(' ')
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f'Algoritmo de checksum no soportado: {algorithm}')
+    try:
+        return hashlib.new(algorithm), base64.b64decode(encoded.strip(), validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError('Upload-Checksum inválido')
+
+
+def _upload_url(upload_id):
+    # Relativa: detrás del proxy HTTPS la app no conoce el esquema ni el host públicos
+    return url_for('tus_upload', upload_id=upload_id)
+
+
+def _until_disconnect(stream):
+    # Si el cliente se corta a mitad del PATCH se conserva lo recibido (núcleo de tus)
+    try:
+        yield from iter_body(stream)
+    except ClientDisconnected:
+        return
+
+
+def version_error():
+    """412 si el cliente no habla la versión soportada (OPTIONS no lleva Tus-Resumable)."""
+    if request.method == 'OPTIONS' or request.headers.get('Tus-Resumable') == TUS_VERSION:
+        return None
+    return tus_response(412, {'Tus-Version': TUS_VERSION}, 'Versión de tus no soportada')
+
+
+def handle_options():
+    return tus_response(204, {
+        'Tus-Version': TUS_VERSION,
+        'Tus-Extension': TUS_EXTENSIONS,
+        'Tus-Checksum-Algorithm': ','.join(CHECKSUM_ALGORITHMS),
+    })
+
+
+def handle_create(user_id):
+    try:
+        metadata = parse_metadata(request.headers.get('Upload-Metadata'))
+    except ValueError as e:
+        return tus_response(400, body=str(e))
+    filename = metadata.get('filename') or metadata.get('name')
+    concat = (request.headers.get('Upload-Concat') or '').strip()
+    if concat and concat != 'partial' and not concat.startswith('final;'):
+        return tus_response(400, body='Upload-Concat inválido')
+    # Las parciales no llegan al catálogo; el nombre se exige en la subida final
+    if concat != 'partial' and (not filename or not allowed_file(filename)):
+        return tus_response(400, body='Upload-Metadata debe incluir filename')
+
+    if concat.startswith('final;'):
+        urls = concat[len('final;'):].split()
+        partial_ids = [urlparse(u).path.rstrip('/').rsplit('/', 1)[-1] for u in urls]
+        if not partial_ids or not all(partial_ids):
+            return tus_response(400, body='Upload-Concat final sin subidas parciales')
+        result, status_code = concatenate_uploads(user_id, partial_ids, filename,
+                                                  request.headers.get('Upload-Metadata'), concat)
+    else:
+        length = request.headers.get('Upload-Length', '')
+        if not length.isdigit():
+            return tus_response(400, body='Upload-Length requerido')
+        result, status_code = start_offset_upload(user_id, filename, int(length),
+                                                  request.headers.get('Upload-Metadata'), concat or None)
+    if status_code != 201:
+        return _error(result, status_code)
+    return tus_response(201, {'Location': _upload_url(result['upload']['upload_id'])})
+
+
+def handle_head(user_id, upload_id):
+    meta = get_offset_upload(user_id, upload_id)
+    if not meta:
+        return tus_response(404)
+    offset = meta['total_size'] if meta['final_filename'] else meta['received_bytes']
+    headers = {'Upload-Offset': str(offset), 'Upload-Length': str(meta['total_size'])}
+    if meta['upload_metadata']:
+        headers['Upload-Metadata'] = meta['upload_metadata']
+    if meta['concat']:
+        headers['Upload-Concat'] = meta['concat']
+    return tus_response(200, headers)
+
+
+def handle_patch(user_id, upload_id):
+    if request.mimetype != 'application/offset+octet-stream':
+        return tus_response(415, body='Content-Type debe ser application/offset+octet-stream')
+    offset = request.headers.get('Upload-Offset', '')
+    if not offset.isdigit():
+        return tus_response(400, body='Upload-Offset requerido')
+    try:
+        checksum = parse_checksum(request.headers.get('Upload-Checksum'))
+    except ValueError as e:
+        return tus_response(400, body=str(e))
+    # Rechazar antes de leer el cuerpo si ya se sabe que excede el tamaño declarado
+    meta = get_offset_upload(user_id, upload_id)
+    if not meta:
+        return tus_response(404)
+    if request.content_length and int(offset) + request.content_length > meta['total_size']:
+        return tus_response(413, body='Los datos exceden Upload-Length')
+    result, status_code = append_at_offset(user_id, upload_id, int(offset),
+                                           _until_disconnect(request.stream), checksum)
+    if status_code != 200:
+        return _error(result, status_code)
+    return tus_response(204, {'Upload-Offset': str(result['offset'])})
+
+
+def handle_delete(user_id, upload_id):
+    result, status_code = terminate_offset_upload(user_id, upload_id)
+    if status_code != 204:
+        return _error(result, status_code)
+    return tus_response(204)
+
+
+def dispatch(user_id, upload_id=None):
+    """Atender una petición tus; X-HTTP-Method-Override permite PATCH/DELETE vía POST."""
+    rejected = version_error()
+    if rejected:
+        return rejected
+    method = request.method
+    if method == 'POST' and upload_id is not None:
+        method = (request.headers.get('X-HTTP-Method-Override') or '').upper()
+    if method == 'OPTIONS':
+        return handle_options()
+    if user_id is None:
+        return tus_response(401, {'WWW-Authenticate': 'Bearer realm="tus"'}, 'No autorizado')
+    if upload_id is None:
+        return handle_create(user_id) if method == 'POST' else tus_response(405)
+    if method == 'HEAD':
+        return handle_head(user_id, upload_id)
+    if method == 'PATCH':
+        return handle_patch(user_id, upload_id)
+    if method == 'DELETE':
+        return handle_delete(user_id, upload_id)
+    return tus_response(405)
@@ -2,14 +2,35 @@
 Módulo para manejo de uploads de archivos
 """
 import os
+import errno
+import fcntl
 import re
 import json
+import shutil
+import secrets
+import socket
+import tarfile
+import threading
 from datetime import datetime, timedelta
 from flask import flash, session, request, jsonify, send_file, Response # type: ignore
+from downloads import send_file_ranges # type: ignore
+from variants import negotiable, select_variant # type: ignore
+from streaming import iter_body, multipart_from_request, READ_SIZE # type: ignore
+from checksums import new_hasher, parse_sha256 # type: ignore
+from blobstore import BLOB_FOLDER, existing_blob_path, place_blob, blob_placer, remove_blob # type: ignore
+import diskio # type: ignore
+from urllib.parse import unquote
 import logging
+from db_logic import (  # type: ignore
+    insert_file_record, insert_blob_file_record, insert_blob_file_records, import_file_records, get_file_record, get_user_file_records,
+    get_expired_file_records, delete_file_record, delete_file_records, reap_blobs, user_references_blob,
+    find_file_record_by_name, find_file_record_by_token, record_download, get_user_quota, get_reserved_upload_bytes,
+    create_upload, get_upload, find_user_uploads, record_upload_chunk, remove_upload_chunks, adopt_upload, delete_upload,
+    mark_upload_completed, get_upload_ranges, get_stale_uploads, get_upload_ids
+)
 
 # Configuración de uploads
-UPLOAD_FOLDER = '/app/uploads'
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', '/app/uploads')
 ALLOWED_EXTENSIONS = {
     'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'svg',
     'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx',
@@ -18,115 +39,892 @@ ALLOWED_EXTENSIONS = {
     'py', 'js', 'html', 'css', 'json', 'xml'
 }
 
+# ------------------------------ Cuotas por usuario ------------------------------
+# Valores por defecto (0 = sin límite); la tabla `cuotas` puede fijar otros por usuario
+USER_QUOTA_BYTES = int(os.environ.get('USER_QUOTA_MB', '0')) * 1024 * 1024
+USER_QUOTA_FILES = int(os.environ.get('USER_QUOTA_FILES', '0'))
+
+def quota_remaining(user_id, exclude_uploads=None):
+    """(bytes, archivos) que le quedan al usuario; None = sin límite.
+
+    Los bytes descuentan el catálogo y lo que ya reservan sus subidas en curso (el .part se
+    prealoca con el tamaño total), salvo las de `exclude_uploads`: la propia subida que se
+    comprueba o las que va a reemplazar. Así N subidas abiertas no pueden ocupar N cuotas.
+    """
+    quota = get_user_quota(user_id)
+    max_bytes = USER_QUOTA_BYTES if quota['max_bytes'] is None else quota['max_bytes']
+    max_files = USER_QUOTA_FILES if quota['max_archivos'] is None else quota['max_archivos']
+    used = quota['bytes'] + get_reserved_upload_bytes(user_id, exclude_uploads) if max_bytes else 0
+    bytes_left = max(0, max_bytes - used) if max_bytes else None
+    files_left = max(0, max_files - quota['archivos']) if max_files else None
+    return bytes_left, files_left
+
+def _quota_error(bytes_left, files_left, size=None):
+    """Respuesta 413 si un archivo más (de `size` bytes, si se conoce) no cabe en la cuota."""
+    if files_left is not None and files_left < 1:
+        return {'error': 'Has alcanzado el número máximo de archivos de tu cuota', 'error_code': 'QUOTA_EXCEEDED', 'remaining_files': 0}, 413
+    if bytes_left is not None and size is not None and size > bytes_left:
+        return {'error': f'El archivo excede el espacio disponible en tu cuota ({format_file_size(bytes_left)})', 'error_code': 'QUOTA_EXCEEDED', 'remaining_bytes': bytes_left}, 413
+    return None
+
+# ------------------------------ Prealocación en disco ------------------------------
+# posix_fallocate reserva bloques reales (contiguos en ext4/XFS) en lugar de un archivo
+# disperso; UPLOAD_PREALLOCATE=0 la desactiva (en sistemas sin fallocate glibc la emula
+# escribiendo un byte por bloque).
+PREALLOCATE = os.environ.get('UPLOAD_PREALLOCATE', '1') != '0'
+
+def _preallocate(fd, size):
+    """Reservar `size` bytes para `fd` y fijar su tamaño.
+
+    Lanza OSError(ENOSPC) si el volumen no tiene espacio; si el sistema de archivos no
+    soporta fallocate se deja un archivo disperso del tamaño pedido.
+    """
+    if size <= 0:
+        return
+    if PREALLOCATE:
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+    os.ftruncate(fd, size)
+
+def _no_space_error(size=None):
+    detail = f' para {format_file_size(size)}' if size else ''
+    return {'error': f'No hay espacio suficiente en el servidor{detail}', 'error_code': 'INSUFFICIENT_STORAGE'}, 507
+
 # ------------------------- Subidas Resumibles (Chunks) -------------------------
 import uuid
 
 CHUNK_THRESHOLD = int(os.environ.get('CHUNK_UPLOAD_THRESHOLD_MB', '512')) * 1024 * 1024  # >512MB usa chunks
 DEFAULT_CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE_MB', '64')) * 1024 * 1024  # 64MB
 
-def _resumable_meta_path(user_id, upload_id):
+CHUNK_MIN_SIZE = 1 * 1024 * 1024  # 1MB
+CHUNK_MAX_SIZE = 256 * 1024 * 1024  # 256MB
+
+# Archivos en curso (chunks y subidas en streaming) fuera de los directorios de usuario.
+# Por defecto junto al almacén de blobs (mismo volumen: pasan a él con un hard link); en otro
+# volumen place_blob copia el archivo en lugar de enlazarlo
+INCOMING_FOLDER = os.environ.get('INCOMING_FOLDER', os.path.join(os.path.dirname(BLOB_FOLDER), '.incoming'))
+# Horas sin recibir chunks tras las que una subida se considera abandonada
+UPLOAD_STALE_TTL = timedelta(hours=float(os.environ.get('UPLOAD_STALE_TTL_HOURS', '24')))
+
+def _incoming_path(name):
+    os.makedirs(INCOMING_FOLDER, exist_ok=True)
+    return os.path.join(INCOMING_FOLDER, name)
+
+def _temp_file_path(upload_id):
+    return _incoming_path(f"{upload_id}.part")
+
+def _legacy_meta_path(user_id, upload_id):
+    """Estado en JSON de versiones anteriores (sólo se usa para importarlo a la base de datos)."""
     return os.path.join(get_user_upload_dir(user_id), f".upload_{upload_id}.json")
 
-def _temp_file_path(user_id, upload_id):
+def _legacy_part_path(user_id, upload_id):
     return os.path.join(get_user_upload_dir(user_id), f".upload_{upload_id}.part")
 
-def init_resumable_upload(user_id, original_name, total_size):
-    """Crear/recuperar estado de una subida resumible.
-    Retorna dict con upload_id, received_bytes, chunk_size.
+def _move_file(source_path, target):
+    """os.replace que, entre volúmenes distintos (EXDEV), copia + fsync y borra el origen."""
+    try:
+        os.replace(source_path, target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = f"{target}.{secrets.token_hex(8)}.tmp"
+    try:
+        with open(source_path, 'rb') as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_MIN_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    os.remove(source_path)
+
+# El estado de cada subida vive en uploads_in_progress / upload_chunks (db_logic);
+# meta['chunks'] es {índice: sha256} de los chunks ya recibidos.
+def _missing_chunks(meta, limit=None):
+    missing = []
+    for i in range(meta['total_chunks']):
+        if i not in meta['chunks']:
+            missing.append(i)
+            if limit and len(missing) >= limit:
+                break
+    return missing
+
+def _chunk_bounds(meta, chunk_index):
+    """Retorna (offset, longitud esperada) del chunk dentro del archivo final."""
+    offset = chunk_index * meta['chunk_size']
+    return offset, max(0, min(meta['chunk_size'], meta['total_size'] - offset))
+
+# Sesiones que usan la API /api/chunk: archivo normal o lote empaquetado en tar
+CHUNK_PROTOCOLS = ('chunks', 'batch')
+
+def _effective_chunk_size(chunk_size):
+    if not isinstance(chunk_size, int) or chunk_size <= 0:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    return max(CHUNK_MIN_SIZE, min(chunk_size, CHUNK_MAX_SIZE))
+
+def init_resumable_upload(user_id, original_name, total_size, chunk_size=None, content_sha256=None, chunk_hashes=None, protocol='chunks'):
+    """Crear estado de una subida resumible.
+
+    El tamaño de chunk queda fijo para toda la subida, de modo que cada índice
+    tiene su propio offset y los chunks pueden llegar en paralelo y en cualquier orden.
+    `chunk_hashes` (opcional) son los SHA-256 declarados por el cliente para cada chunk.
+    protocol='batch' marca una sesión cuyo contenido es un tar que se desempaqueta como lote.
+    Retorna la subida (dict) o None si no se pudo registrar. Lanza OSError(ENOSPC) si no
+    se puede reservar el espacio.
     """
     upload_id = uuid.uuid4().hex
+    chunk_size = _effective_chunk_size(chunk_size)
+    total_chunks = (total_size + chunk_size - 1) // chunk_size
     meta = {
         'upload_id': upload_id,
         'original_name': secure_filename(original_name),
         'display_name': original_name,
+        'user_id': user_id,
         'total_size': total_size,
         'received_bytes': 0,
-        'chunk_size': DEFAULT_CHUNK_SIZE,
+        'chunk_size': chunk_size,
+        'total_chunks': total_chunks,
+        'chunks': {},
+        'declared_chunk_hashes': chunk_hashes or [],
+        'content_sha256': content_sha256,
+        'hash_epoch': 0,
         'started_at': datetime.now().isoformat(),
-        'next_index': 0  # permitimos tamaños de chunk variables
+        'protocol': protocol,
     }
-    with open(_resumable_meta_path(user_id, upload_id), 'w', encoding='utf-8') as f:
-        json.dump(meta, f)
+    return _register_upload(meta)
+
+def _register_upload(meta):
+    """Crear el .part con su tamaño final (bloques reservados) y registrar la subida."""
+    temp_path = _temp_file_path(meta['upload_id'])
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        diskio.run(temp_path, _preallocate, fd, meta['total_size'])
+    except OSError:
+        os.close(fd)
+        os.remove(temp_path)
+        raise
+    os.close(fd)
+    if not create_upload(meta):
+        os.remove(temp_path)
+        return None
     return meta
 
-def load_resumable_meta(user_id, upload_id):
-    path = _resumable_meta_path(user_id, upload_id)
-    if not os.path.exists(path):
+# Subida instantánea: si el usuario ya tiene un archivo con el contenido declarado basta con
+# registrar otra referencia. Sólo con sus propios archivos: con los de otros usuarios, conocer
+# el hash bastaría para obtener una copia (y la respuesta revelaría que existe).
+# Desactivable con INSTANT_UPLOAD=0.
+INSTANT_UPLOAD = os.environ.get('INSTANT_UPLOAD', '1') != '0'
+
+def _require_existing_blob(content_hash):
+    # Llamado sólo si el blob desapareció entre la comprobación y la transacción
+    raise FileNotFoundError(content_hash)
+
+def try_instant_upload(user_id, original_name, total_size, content_sha256):
+    """Completar la subida sin transferir datos si el usuario ya tiene ese contenido (hash y tamaño)."""
+    if not INSTANT_UPLOAD or not content_sha256 or not user_references_blob(user_id, content_sha256):
         return None
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception:
+    path = existing_blob_path(content_sha256)
+    if not path or os.path.getsize(path) != total_size:
+        return None
+    now = datetime.now()
+    final_name = now.strftime('%Y%m%d_%H%M%S_') + secure_filename(original_name)
+    linked = insert_blob_file_record(
+        user_id, final_name, original_name, total_size,
+        now.isoformat(), (now + FILE_EXPIRATION).isoformat(),
+        new_share_token(), content_sha256, _require_existing_blob, remove_blob
+    )
+    if linked is not False:
         return None
+    logging.getLogger('uploads').info("[upload] instant user=%s file='%s' sha256=%s size=%s", user_id, final_name, content_sha256, format_file_size(total_size))
+    return {
+        'success': True,
+        'completed': True,
+        'instant': True,
+        'filename': final_name,
+        'size': format_file_size(total_size),
+        'sha256': content_sha256,
+        'message': f'Archivo "{original_name}" subido exitosamente (ya existía en el servidor).'
+    }
 
-def save_resumable_meta(user_id, meta):
-    path = _resumable_meta_path(user_id, meta['upload_id'])
-    try:
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(meta, f)
-    except Exception:
-        pass
+def find_resumable_upload(user_id, total_size, chunk_size, chunk_hashes):
+    """Subida anterior abortada con más chunks idénticos a `chunk_hashes` (o None).
 
-def append_chunk(user_id, upload_id, chunk_index, chunk_data, total_chunks=None):
-    meta = load_resumable_meta(user_id, upload_id)
+    Se comparan los hashes declarados por el cliente con los registrados al recibir cada chunk.
+    """
+    if not chunk_hashes:
+        return None
+    best, best_matches = None, 0
+    for meta in find_user_uploads(user_id, total_size):
+        if meta['protocol'] != 'chunks' or meta['chunk_size'] != chunk_size:
+            continue
+        held = meta['chunks']
+        matches = sum(1 for i, h in enumerate(chunk_hashes) if i in held and held[i] == h)
+        if matches > best_matches:
+            best, best_matches = meta, matches
+    if not best or not os.path.exists(_temp_file_path(best['upload_id'])):
+        return None
+    return best
+
+def resume_matching_upload(user_id, original_name, chunk_hashes, content_sha256, best):
+    """Reutilizar el .part de `best` (ver find_resumable_upload).
+
+    Los chunks que no coinciden se desmarcan y el cliente sólo tiene que enviar los que
+    faltan. Retorna la metadata o None si otra petición la adoptó o descartó entretanto.
+    """
+    best_id = best['upload_id']
+    meta = adopt_upload(best_id, secure_filename(original_name), original_name, chunk_hashes,
+                        content_sha256, datetime.now().isoformat())
     if not meta:
-        return {'error': 'Upload no encontrada'}, 404
-    temp_path = _temp_file_path(user_id, upload_id)
+        return None
+    if meta['stale']:
+        _drop_running_hash(best_id)
+    logging.getLogger('uploads').info("[upload] resume user=%s upload=%s chunks_reutilizados=%s descartados=%s", user_id, best_id, len(meta['chunks']), len(meta['stale']))
+    return meta
 
-    # Validar consistencia de tamaño ya recibido vs índice
-    expected_index = meta.get('next_index', meta['received_bytes'] // meta.get('chunk_size', 1))
-    if chunk_index != expected_index:
-        return {
-            'error': 'Índice de chunk inesperado',
-            'expected_index': expected_index,
-            'received_bytes': meta['received_bytes']
-        }, 409
-
-    with open(temp_path, 'ab', buffering=8*1024*1024) as f:
-        f.write(chunk_data)
-    meta['received_bytes'] += len(chunk_data)
-    meta['next_index'] = expected_index + 1
-    save_resumable_meta(user_id, meta)
-
-    completed = meta['received_bytes'] >= meta['total_size']
+def start_chunked_upload(user_id, data):
+    """Handshake de /api/chunk/init.
+
+    Con `sha256` (y `total_size`) la subida termina al instante si el contenido ya existe;
+    con `chunk_hashes` se retoma una subida abortada reutilizando los chunks idénticos.
+    Con `batch: "tar"` el contenido es un tar de muchos archivos que se registran juntos
+    al finalizar (ver BatchUpload); en ese modo no hay subida instantánea ni reanudación.
+    """
+    original_name = data.get('filename')
+    total_size = data.get('total_size')
+    if not original_name or not isinstance(total_size, int) or total_size < 0:
+        return {'error': 'Datos inválidos'}, 400
+    chunk_hashes = data.get('chunk_hashes') or []
+    if not isinstance(chunk_hashes, list):
+        return {'error': 'chunk_hashes debe ser una lista'}, 400
+    try:
+        content_sha256 = parse_sha256(data.get('sha256'))
+        chunk_hashes = [parse_sha256(h) for h in chunk_hashes]
+    except (ValueError, AttributeError, TypeError) as e:
+        return {'error': f'Checksum inválido: {e}'}, 400
+    chunk_size = _effective_chunk_size(data.get('chunk_size'))
+    total_chunks = (total_size + chunk_size - 1) // chunk_size
+    if chunk_hashes and len(chunk_hashes) != total_chunks:
+        return {'error': 'chunk_hashes no coincide con el número de chunks', 'chunk_size': chunk_size, 'total_chunks': total_chunks}, 400
+    batch = data.get('batch')
+    if batch is not None and batch not in BATCH_FORMATS:
+        return {'error': f'Formato de lote no soportado (usa {", ".join(BATCH_FORMATS)})'}, 400
+    # Rechazar antes de reservar nada si el archivo no cabe en la cuota. La subida abortada
+    # que se va a retomar ya tiene su reserva: no se cuenta dos veces
+    resumable = None if batch else find_resumable_upload(user_id, total_size, chunk_size, chunk_hashes)
+    over_quota = _quota_error(*quota_remaining(user_id, [resumable['upload_id']] if resumable else None), total_size)
+    if over_quota:
+        return over_quota
+    if batch:
+        try:
+            meta = init_resumable_upload(user_id, original_name, total_size, chunk_size, content_sha256, chunk_hashes, 'batch')
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            return _no_space_error(total_size)
+        if not meta:
+            return {'error': 'Error registrando la subida'}, 500
+        return {'success': True, 'upload_id': meta['upload_id'], 'chunk_size': meta['chunk_size'],
+                'total_chunks': meta['total_chunks'], 'received_chunks': []}, 200
+
+    instant = try_instant_upload(user_id, original_name, total_size, content_sha256)
+    if instant:
+        return instant, 200
+    meta = resumable and resume_matching_upload(user_id, original_name, chunk_hashes, content_sha256, resumable)
+    if resumable and not meta:
+        # No se pudo adoptar: la nueva subida reserva su propio espacio
+        over_quota = _quota_error(*quota_remaining(user_id), total_size)
+        if over_quota:
+            return over_quota
+    try:
+        meta = meta or init_resumable_upload(user_id, original_name, total_size, chunk_size, content_sha256, chunk_hashes)
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        logging.getLogger('uploads').warning("[upload] sin espacio user=%s total_size=%s", user_id, total_size)
+        return _no_space_error(total_size)
+    if not meta:
+        return {'error': 'Error registrando la subida'}, 500
     return {
         'success': True,
-        'received_bytes': meta['received_bytes'],
-    'completed': completed,
-    'next_index': meta['next_index'],
-        'total_size': meta['total_size']
+        'upload_id': meta['upload_id'],
+        'chunk_size': meta['chunk_size'],
+        'total_chunks': meta['total_chunks'],
+        'received_chunks': sorted(meta['chunks'])
     }, 200
 
+# SHA-256 incremental de subidas por chunks: cada proceso mantiene el hash del prefijo
+# contiguo ya recibido. Los chunks en orden se hashean mientras se escriben; los que llegaron
+# fuera de orden se leen (normalmente desde la caché de páginas) cuando el hueco se completa.
+# `hash_epoch` (en uploads_in_progress) cambia cuando se invalida un chunk ya aceptado; los estados
+# de cualquier worker con otra época se descartan.
+class _RunningHash:
+    def __init__(self, epoch=0):
+        self.lock = threading.Lock()
+        self.epoch = epoch
+        self.offset = 0
+        self.hasher = new_hasher()
+
+_running_hashes = {}
+_running_hashes_lock = threading.Lock()
+
+def _running_hash(upload_id, epoch=0):
+    with _running_hashes_lock:
+        state = _running_hashes.get(upload_id)
+        if state is None or state.epoch != epoch:
+            state = _running_hashes[upload_id] = _RunningHash(epoch)
+        return state
+
+def _drop_running_hash(upload_id):
+    with _running_hashes_lock:
+        return _running_hashes.pop(upload_id, None)
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+def _hash_file_range(hasher, fd, offset, length):
+    while length > 0:
+        data = os.pread(fd, min(READ_SIZE, length), offset)
+        if not data:
+            raise IOError('Archivo temporal más corto de lo esperado')
+        hasher.update(data)
+        offset += len(data)
+        length -= len(data)
+
+def _catch_up_running_hash(state, temp_path, meta):
+    """Avanzar el hash sobre los chunks contiguos ya recibidos (con state.lock tomado)."""
+    total = meta['total_size']
+    chunk_size = meta['chunk_size']
+    received = meta['chunks']
+    if state.offset >= total or state.offset // chunk_size not in received:
+        return
+    diskio.run(temp_path, _hash_received_prefix, state, temp_path, total, chunk_size, received)
+
+def _hash_received_prefix(state, temp_path, total, chunk_size, received):
+    fd = os.open(temp_path, os.O_RDONLY)
+    try:
+        while state.offset < total and state.offset // chunk_size in received:
+            end = min(state.offset + chunk_size, total)
+            _hash_file_range(state.hasher, fd, state.offset, end - state.offset)
+            state.offset = end
+    finally:
+        os.close(fd)
+
+def _final_content_hash(upload_id, temp_path, total_size, epoch=0):
+    """SHA-256 del archivo completo; sólo relee lo que este proceso no llegó a hashear."""
+    state = _drop_running_hash(upload_id)
+    if state is None or state.epoch != epoch:
+        state = _RunningHash(epoch)
+    if state.offset < total_size:
+        logging.getLogger('uploads').info("[upload] hash upload=%s releyendo %s desde offset %s", upload_id, format_file_size(total_size - state.offset), state.offset)
+        diskio.run(temp_path, _hash_file_tail, state.hasher, temp_path, state.offset, total_size - state.offset)
+    return state.hasher.hexdigest()
+
+def _hash_file_tail(hasher, temp_path, offset, length):
+    fd = os.open(temp_path, os.O_RDONLY)
+    try:
+        _hash_file_range(hasher, fd, offset, length)
+    finally:
+        os.close(fd)
+
+def _unmark_chunk(upload_id, chunk_index):
+    """Un chunk rechazado ya escribió bytes en su offset: si constaba como recibido deja de estarlo."""
+    if remove_upload_chunks(upload_id, [chunk_index], datetime.now().isoformat()):
+        _drop_running_hash(upload_id)
+
+class ChunkWriter:
+    """Escritura de un chunk en su offset del .part en tres pasos (open/write/finish).
+
+    Mismo reparto que UploadWriter: append_chunk los encadena en el hilo de la petición
+    y transfer_server.py los ejecuta en su pool de hilos entre lecturas del socket.
+    """
+
+    def __init__(self, user_id, upload_id, chunk_index, chunk_sha256=None):
+        self.user_id = user_id
+        self.upload_id = upload_id
+        self.chunk_index = chunk_index
+        self.chunk_sha256 = chunk_sha256
+        self.fd = None
+        self.received = 0
+
+    def open(self):
+        """Retorna (dict, status) si el chunk no se admite o None."""
+        meta = get_upload(self.user_id, self.upload_id)
+        if not meta or meta['protocol'] not in CHUNK_PROTOCOLS:
+            return {'error': 'Upload no encontrada'}, 404
+        self.temp_path = _temp_file_path(self.upload_id)
+        if not os.path.exists(self.temp_path):
+            return {'error': 'Archivo temporal no encontrado'}, 404
+
+        if self.chunk_index >= meta['total_chunks']:
+            return {'error': 'Índice de chunk fuera de rango', 'total_chunks': meta['total_chunks']}, 400
+        # La cuota pudo agotarse con otras subidas desde el init: no seguir escribiendo (el .part se conserva)
+        bytes_left, _ = quota_remaining(self.user_id, [self.upload_id])
+        over_quota = _quota_error(bytes_left, None, meta['total_size'])
+        if over_quota:
+            return over_quota
+        self.offset, self.expected_len = _chunk_bounds(meta, self.chunk_index)
+        declared = meta.get('declared_chunk_hashes') or []
+        if not self.chunk_sha256 and self.chunk_index < len(declared):
+            self.chunk_sha256 = declared[self.chunk_index]
+
+        # Si este chunk continúa el prefijo ya hasheado, se alimenta una copia del hash mientras se escribe
+        self.state = _running_hash(self.upload_id, meta['hash_epoch'])
+        self.prefix_hasher = self.state.hasher.copy() if self.state.offset == self.offset else None
+        self.chunk_hasher = new_hasher()
+        self.fd = os.open(self.temp_path, os.O_WRONLY)
+        return None
+
+    def write(self, piece):
+        """Escribir el siguiente trozo; False si el chunk ya supera su tamaño esperado."""
+        if self.received + len(piece) > self.expected_len:
+            self.received += len(piece)
+            return False
+        diskio.run(self.temp_path, self._store, piece)
+        self.received += len(piece)
+        return True
+
+    def _store(self, piece):
+        _pwrite_all(self.fd, piece, self.offset + self.received)
+        self.chunk_hasher.update(piece)
+        if self.prefix_hasher is not None:
+            self.prefix_hasher.update(piece)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def fail(self, e):
+        # Si ya se escribieron bytes en su offset, el chunk deja de contar como recibido
+        self.close()
+        if self.received:
+            _unmark_chunk(self.upload_id, self.chunk_index)
+        logging.getLogger('uploads').warning("[upload] chunk interrumpido user=%s upload=%s index=%s err=%s", self.user_id, self.upload_id, self.chunk_index, e)
+        return {'error': f'Error recibiendo el chunk: {e}'}, 500
+
+    def finish(self):
+        upload_id, chunk_index = self.upload_id, self.chunk_index
+        offset, expected_len = self.offset, self.expected_len
+        try:
+            if self.received == expected_len:
+                diskio.run(self.temp_path, os.fdatasync, self.fd)
+        finally:
+            self.close()
+        if self.received != expected_len:
+            _unmark_chunk(upload_id, chunk_index)
+            return {
+                'error': 'Tamaño de chunk inesperado',
+                'expected_size': expected_len,
+                'received_size': self.received
+            }, 400
+        chunk_digest = self.chunk_hasher.hexdigest()
+        if self.chunk_sha256 and chunk_digest != self.chunk_sha256:
+            logging.getLogger('uploads').warning("[upload] checksum chunk user=%s upload=%s index=%s esperado=%s recibido=%s", self.user_id, upload_id, chunk_index, self.chunk_sha256, chunk_digest)
+            _unmark_chunk(upload_id, chunk_index)
+            return {
+                'error': 'Checksum de chunk no coincide',
+                'error_code': 'CHECKSUM_MISMATCH',
+                'chunk_index': chunk_index,
+                'sha256': chunk_digest
+            }, 422
+
+        # Si el chunk ya constaba con otro contenido, record_upload_chunk cambia hash_epoch
+        meta = record_upload_chunk(upload_id, chunk_index, offset, expected_len, chunk_digest, datetime.now().isoformat())
+        if not meta:
+            return {'error': 'Error registrando el chunk'}, 500
+        received_chunks = len(meta['chunks'])
+
+        state = self.state
+        if state.epoch == meta['hash_epoch']:
+            with state.lock:
+                if self.prefix_hasher is not None and state.offset == offset:
+                    state.hasher = self.prefix_hasher
+                    state.offset = offset + expected_len
+                _catch_up_running_hash(state, self.temp_path, meta)
+
+        completed = received_chunks >= meta['total_chunks']
+        return {
+            'success': True,
+            'received_bytes': meta['received_bytes'],
+            'received_chunks': received_chunks,
+            'completed': completed,
+            'total_size': meta['total_size'],
+            'sha256': chunk_digest
+        }, 200
+
+def append_chunk(user_id, upload_id, chunk_index, chunk_data, total_chunks=None, chunk_sha256=None):
+    """Escribir un chunk en su offset dentro del .part y registrarlo como recibido.
+
+    `chunk_data` puede ser bytes o un iterable de bytes (cuerpo en streaming); se escribe
+    directamente en el offset sin acumular el chunk en memoria. Si se indica `chunk_sha256`,
+    el chunk sólo se marca como recibido cuando su hash coincide. Los datos se sincronizan
+    a disco (fdatasync) antes de registrar el chunk, así lo que consta en upload_chunks
+    sobrevive a un reinicio. Los chunks pueden llegar en cualquier orden; reenviar un chunk
+    ya recibido es idempotente.
+    """
+    writer = ChunkWriter(user_id, upload_id, chunk_index, chunk_sha256)
+    rejected = writer.open()
+    if rejected:
+        return rejected
+    if isinstance(chunk_data, (bytes, bytearray, memoryview)):
+        chunk_data = (chunk_data,)
+    try:
+        for piece in chunk_data:
+            if not writer.write(piece):
+                break
+    except BaseException:
+        writer.close()
+        raise
+    return writer.finish()
+
 def finalize_resumable_upload(user_id, upload_id):
-    meta = load_resumable_meta(user_id, upload_id)
-    if not meta:
+    meta = get_upload(user_id, upload_id)
+    if not meta or meta['protocol'] not in CHUNK_PROTOCOLS:
         return {'error': 'Upload no encontrada'}, 404
-    if meta['received_bytes'] < meta['total_size']:
-        return {'error': 'Upload incompleta'}, 400
-    temp_path = _temp_file_path(user_id, upload_id)
+    missing = _missing_chunks(meta, limit=100)
+    if missing:
+        return {'error': 'Upload incompleta', 'missing_chunks': missing}, 400
+    temp_path = _temp_file_path(upload_id)
     if not os.path.exists(temp_path):
         return {'error': 'Archivo temporal no encontrado'}, 404
+    if meta['protocol'] == 'batch':
+        result, status_code = _complete_batch_upload(user_id, meta, temp_path)
+        if status_code == 200:
+            delete_upload(upload_id)
+            _drop_running_hash(upload_id)
+            diskio.run(temp_path, os.remove, temp_path)
+        return result, status_code
+    result, status_code = _complete_upload(user_id, meta, temp_path, 'chunked')
+    if status_code == 200:
+        # El .part ya pasó al almacén de blobs: la subida deja de estar en curso
+        delete_upload(upload_id)
+    return result, status_code
+
+def _complete_upload(user_id, meta, temp_path, via, replaces=()):
+    """Registrar en el catálogo el .part completo de una subida (hash, cuota y almacén de blobs).
+
+    `replaces`: otras subidas en curso que se eliminan al terminar (parciales de una
+    concatenación); su reserva tampoco cuenta.
+    """
+    upload_id = meta['upload_id']
+    content_hash = _final_content_hash(upload_id, temp_path, meta['total_size'], meta['hash_epoch'])
+    expected = meta.get('content_sha256')
+    if expected and expected != content_hash:
+        return {'error': 'Checksum del archivo no coincide', 'error_code': 'CHECKSUM_MISMATCH', 'sha256': content_hash}, 422
+    over_quota = _quota_error(*quota_remaining(user_id, [upload_id, *replaces]), meta['total_size'])
+    if over_quota:
+        return over_quota
 
-    # Renombrar a nombre final con timestamp
+    # Nombre final con timestamp; el contenido pasa al almacén de blobs (o se deduplica)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
     final_name = timestamp + meta['original_name']
-    final_path = os.path.join(get_user_upload_dir(user_id), final_name)
-    os.replace(temp_path, final_path)
-    save_file_metadata(user_id, final_name, meta['display_name'])
-
-    # Limpiar metadata
-    try:
-        os.remove(_resumable_meta_path(user_id, upload_id))
-    except Exception:
-        pass
+    if save_file_metadata(user_id, final_name, meta['display_name'], meta['total_size'], content_hash, temp_path) is None:
+        return {'error': 'Error registrando el archivo'}, 500
 
     return {
         'success': True,
         'filename': final_name,
         'size': format_file_size(meta['total_size']),
-        'message': f'Archivo "{meta["display_name"]}" subido exitosamente (chunked).'
+        'sha256': content_hash,
+        'message': f'Archivo "{meta["display_name"]}" subido exitosamente ({via}).'
+    }, 200
+
+def upload_status(user_id, upload_id):
+    """Progreso de una subida por chunks: rangos de bytes recibidos (fin exclusivo) y chunks que faltan."""
+    meta = get_upload(user_id, upload_id)
+    ranges = get_upload_ranges(user_id, upload_id) if meta else None
+    if not meta or meta['protocol'] not in CHUNK_PROTOCOLS or ranges is None:
+        return {'error': 'Upload no encontrada'}, 404
+    merged = []
+    for offset, size in ranges:
+        if merged and merged[-1][1] == offset:
+            merged[-1][1] = offset + size
+        else:
+            merged.append([offset, offset + size])
+    missing = _missing_chunks(meta)
+    expires_at = datetime.fromisoformat(meta['updated_at']) + UPLOAD_STALE_TTL
+    return {
+        'success': True,
+        'upload_id': upload_id,
+        'filename': meta['display_name'],
+        'total_size': meta['total_size'],
+        'chunk_size': meta['chunk_size'],
+        'total_chunks': meta['total_chunks'],
+        'received_bytes': meta['received_bytes'],
+        'received_ranges': merged,
+        'received_chunks': sorted(meta['chunks']),
+        'missing_chunks': missing,
+        'completed': not missing,
+        'updated_at': meta['updated_at'],
+        'expires_at': expires_at.isoformat()
     }, 200
 
+# ------------------------- Subidas por offset (tus) -------------------------
+# Usadas por el servidor tus (tus.py). El archivo se escribe secuencialmente: cada PATCH
+# continúa en el offset actual. Se guardan en las mismas tablas que las subidas por chunks
+# (protocol='tus'); cada tramo aceptado es una fila de upload_chunks (índice = orden de
+# llegada) y el offset es la suma de los tramos. Las subidas parciales (concatenación) no
+# se registran al completarse: esperan a la subida final que las une.
+
+def get_offset_upload(user_id, upload_id):
+    meta = get_upload(user_id, upload_id)
+    return meta if meta and meta['protocol'] == 'tus' else None
+
+def start_offset_upload(user_id, original_name, total_size, upload_metadata=None, concat=None, replaces=None):
+    """Crear una subida tus de `total_size` bytes; las de 0 bytes se registran al momento.
+
+    `concat` es el valor de Upload-Concat ('partial' o 'final;...') y `replaces` las subidas
+    cuya reserva de cuota deja de contar (las parciales de una concatenación). Retorna
+    (dict, status) con la subida en 'upload'.
+    """
+    partial = concat == 'partial'
+    max_size = _max_upload_size()
+    if max_size and total_size > max_size:
+        return {'error': f'Tamaño excede el máximo permitido ({format_file_size(max_size)})', 'error_code': 'MAX_SIZE_EXCEEDED'}, 413
+    bytes_left, files_left = quota_remaining(user_id, replaces)
+    # Una parcial no añade un archivo al catálogo, pero sus bytes sí deben caber
+    over_quota = _quota_error(bytes_left, None if partial else files_left, total_size)
+    if over_quota:
+        return over_quota
+    meta = {
+        'upload_id': uuid.uuid4().hex,
+        'original_name': secure_filename(original_name or ''),
+        'display_name': original_name or '',
+        'user_id': user_id,
+        'total_size': total_size,
+        'chunk_size': 0,
+        'total_chunks': 0,
+        'hash_epoch': 0,
+        'started_at': datetime.now().isoformat(),
+        'protocol': 'tus',
+        'upload_metadata': upload_metadata,
+        'concat': concat,
+    }
+    try:
+        meta = _register_upload(meta)
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        logging.getLogger('uploads').warning("[upload] sin espacio user=%s total_size=%s", user_id, total_size)
+        return _no_space_error(total_size)
+    if not meta:
+        return {'error': 'Error registrando la subida'}, 500
+    meta['chunks'], meta['received_bytes'] = {}, 0
+    if total_size == 0 and not partial:
+        result, status_code = _complete_offset_upload(user_id, meta)
+        if status_code != 200:
+            return result, status_code
+    return {'success': True, 'upload': meta}, 201
+
+def _complete_offset_upload(user_id, meta, replaces=()):
+    result, status_code = _complete_upload(user_id, meta, _temp_file_path(meta['upload_id']), 'tus', replaces)
+    if status_code == 200:
+        mark_upload_completed(meta['upload_id'], result['filename'], datetime.now().isoformat())
+        meta['final_filename'] = result['filename']
+    return result, status_code
+
+def _offset_result(meta, **extra):
+    result = {
+        'success': True,
+        'offset': meta['received_bytes'] if not meta.get('final_filename') else meta['total_size'],
+        'completed': bool(meta.get('final_filename')),
+        'filename': meta.get('final_filename'),
+    }
+    result.update(extra)
+    return result
+
+def _store_piece(fd, piece, offset, hashers):
+    _pwrite_all(fd, piece, offset)
+    for hasher in hashers:
+        hasher.update(piece)
+
+def append_at_offset(user_id, upload_id, offset, data, checksum=None):
+    """Escribir un tramo de una subida tus a partir de `offset` (debe ser el offset actual).
+
+    `data` es un iterable de bytes; si se corta antes de tiempo se conserva lo recibido
+    (salvo con `checksum`, un par (hasher, digest esperado) que exige el tramo completo).
+    Un lock exclusivo sobre el .part impide dos escrituras simultáneas en la misma subida.
+    Al llegar al tamaño total, la subida (salvo parciales) se registra en el catálogo.
+    """
+    meta = get_offset_upload(user_id, upload_id)
+    if not meta:
+        return {'error': 'Upload no encontrada'}, 404
+    if meta['concat'] and meta['concat'] != 'partial':
+        return {'error': 'Una subida final de concatenación no admite datos', 'error_code': 'FINAL_UPLOAD'}, 403
+    temp_path = _temp_file_path(upload_id)
+    try:
+        fd = os.open(temp_path, os.O_WRONLY)
+    except FileNotFoundError:
+        fd = None
+    if fd is None or meta['final_filename']:
+        # Completada (el .part ya está en el almacén de blobs): sólo se acepta el offset final
+        meta = get_offset_upload(user_id, upload_id)
+        if meta and meta['final_filename'] and offset == meta['total_size']:
+            return _offset_result(meta), 200
+        if meta and meta['final_filename']:
+            return {'error': 'Offset no coincide', 'error_code': 'OFFSET_MISMATCH', 'offset': meta['total_size']}, 409
+        return {'error': 'Archivo temporal no encontrado'}, 404
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return {'error': 'La subida está recibiendo datos en otra petición', 'error_code': 'UPLOAD_LOCKED'}, 423
+        # Con el lock tomado el offset registrado ya no puede cambiar
+        meta = get_offset_upload(user_id, upload_id)
+        if not meta:
+            return {'error': 'Upload no encontrada'}, 404
+        if meta['final_filename']:
+            return _offset_result(meta), 200
+        if offset != meta['received_bytes']:
+            return {'error': 'Offset no coincide', 'error_code': 'OFFSET_MISMATCH', 'offset': meta['received_bytes']}, 409
+        bytes_left, _ = quota_remaining(user_id, [upload_id])
+        over_quota = _quota_error(bytes_left, None, meta['total_size'])
+        if over_quota:
+            return over_quota
+
+        remaining = meta['total_size'] - offset
+        state = _running_hash(upload_id, meta['hash_epoch'])
+        prefix_hasher = state.hasher.copy() if state.offset == offset else None
+        piece_hasher = new_hasher()
+        received = 0
+        for piece in data:
+            if received + len(piece) > remaining:
+                return {'error': 'Los datos exceden el tamaño declarado de la subida', 'error_code': 'UPLOAD_LENGTH_EXCEEDED'}, 413
+            hashers = [h for h in (piece_hasher, prefix_hasher, checksum[0] if checksum else None) if h is not None]
+            diskio.run(temp_path, _store_piece, fd, piece, offset + received, hashers)
+            received += len(piece)
+        if checksum and checksum[0].digest() != checksum[1]:
+            # Los bytes escritos quedan más allá del offset y el siguiente PATCH los sobrescribe
+            logging.getLogger('uploads').warning("[upload] checksum tus user=%s upload=%s offset=%s %s", user_id, upload_id, offset, checksum[0].name)
+            return {'error': 'Checksum del tramo no coincide', 'error_code': 'CHECKSUM_MISMATCH', 'offset': offset}, 422
+        if not received:
+            return _offset_result(meta), 200
+        diskio.run(temp_path, os.fdatasync, fd)
+        meta = record_upload_chunk(upload_id, len(meta['chunks']), offset, received,
+                                   piece_hasher.hexdigest(), datetime.now().isoformat())
+        if not meta:
+            return {'error': 'Error registrando los datos'}, 500
+        with state.lock:
+            if prefix_hasher is not None and state.offset == offset and state.epoch == meta['hash_epoch']:
+                state.hasher = prefix_hasher
+                state.offset = offset + received
+
+        if meta['received_bytes'] < meta['total_size'] or meta['concat'] == 'partial':
+            return _offset_result(meta), 200
+        # Se registra con el lock tomado: una petición concurrente verá final_filename
+        result, status_code = _complete_offset_upload(user_id, meta)
+        if status_code != 200:
+            return result, status_code
+        logging.getLogger('uploads').info("[upload] tus completada user=%s upload=%s file='%s'", user_id, upload_id, result['filename'])
+        return _offset_result(meta, sha256=result['sha256']), 200
+    finally:
+        os.close(fd)
+
+def concatenate_uploads(user_id, partial_ids, original_name, upload_metadata=None, concat=None):
+    """Extensión concatenation: crear la subida final uniendo subidas parciales completas.
+
+    El contenido se copia en una sola pasada que también calcula el SHA-256 final; después
+    se registra en el catálogo y se eliminan las parciales. Retorna (dict, status).
+    """
+    parts = []
+    for partial_id in partial_ids:
+        meta = get_offset_upload(user_id, partial_id)
+        if not meta or meta['concat'] != 'partial':
+            return {'error': f'Subida parcial no encontrada: {partial_id}'}, 404
+        if meta['received_bytes'] < meta['total_size']:
+            return {'error': f'Subida parcial incompleta: {partial_id}', 'error_code': 'PARTIAL_INCOMPLETE'}, 400
+        parts.append(meta)
+    total_size = sum(p['total_size'] for p in parts)
+    # Las parciales se eliminan al terminar: su reserva no cuenta contra la subida final
+    result, status_code = start_offset_upload(user_id, original_name, total_size, upload_metadata, concat,
+                                              [p['upload_id'] for p in parts])
+    if status_code != 201:
+        return result, status_code
+    meta = result['upload']
+    upload_id = meta['upload_id']
+    if not meta.get('final_filename'):
+        result, status_code = _concatenate_into(user_id, meta, parts)
+        if status_code != 201:
+            return result, status_code
+        meta = result['upload']
+    for part in parts:
+        terminate_offset_upload(user_id, part['upload_id'])
+    logging.getLogger('uploads').info("[upload] tus concatenada user=%s upload=%s partes=%s file='%s'", user_id, upload_id, len(parts), meta['final_filename'])
+    return {'success': True, 'upload': meta}, 201
+
+def _copy_parts(temp_path, parts, hasher):
+    offset = 0
+    out = os.open(temp_path, os.O_WRONLY)
+    try:
+        for part in parts:
+            src = os.open(_temp_file_path(part['upload_id']), os.O_RDONLY)
+            try:
+                pos = 0
+                while pos < part['total_size']:
+                    piece = os.pread(src, min(READ_SIZE, part['total_size'] - pos), pos)
+                    if not piece:
+                        raise IOError('Subida parcial más corta de lo esperado')
+                    hasher.update(piece)
+                    _pwrite_all(out, piece, offset + pos)
+                    pos += len(piece)
+            finally:
+                os.close(src)
+            offset += part['total_size']
+        os.fdatasync(out)
+    finally:
+        os.close(out)
+
+def _concatenate_into(user_id, meta, parts):
+    upload_id = meta['upload_id']
+    total_size = meta['total_size']
+    try:
+        hasher = new_hasher()
+        temp_path = _temp_file_path(upload_id)
+        diskio.run(temp_path, _copy_parts, temp_path, parts, hasher)
+    except OSError as e:
+        logging.getLogger('uploads').error("[upload] error concatenando upload=%s: %s", upload_id, e)
+        terminate_offset_upload(user_id, upload_id)
+        if e.errno == errno.ENOSPC:
+            return _no_space_error(total_size)
+        return {'error': 'Error concatenando las subidas parciales'}, 500
+    # Registrar el contenido como un solo tramo y dejar el hash listo para el cierre
+    meta = record_upload_chunk(upload_id, 0, 0, total_size, hasher.hexdigest(), datetime.now().isoformat())
+    if not meta:
+        return {'error': 'Error registrando la subida'}, 500
+    state = _running_hash(upload_id, meta['hash_epoch'])
+    with state.lock:
+        state.hasher, state.offset = hasher, total_size
+    result, status_code = _complete_offset_upload(user_id, meta, [p['upload_id'] for p in parts])
+    if status_code != 200:
+        return result, status_code
+    return {'success': True, 'upload': meta}, 201
+
+def terminate_offset_upload(user_id, upload_id):
+    """Extensión termination: descartar la subida y su .part."""
+    meta = get_offset_upload(user_id, upload_id)
+    if not meta:
+        return {'error': 'Upload no encontrada'}, 404
+    delete_upload(upload_id)
+    _drop_running_hash(upload_id)
+    temp_path = _temp_file_path(upload_id)
+    try:
+        diskio.run(temp_path, os.remove, temp_path)
+    except FileNotFoundError:
+        pass
+    return {'success': True}, 204
+
 def secure_filename(filename):
     """Función para asegurar nombres de archivo"""
     # Remover caracteres peligrosos y mantener solo alfanuméricos, puntos, guiones y guiones bajos
@@ -210,134 +1008,421 @@ def get_user_upload_dir(user_id):
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
+FILE_EXPIRATION = timedelta(days=5)
+
 def get_file_metadata_path(user_id, filename):
-    """Obtener la ruta del archivo de metadatos"""
+    """Ruta del antiguo sidecar .meta (sólo se usa para importar al catálogo)"""
     user_dir = get_user_upload_dir(user_id)
     return os.path.join(user_dir, f".{filename}.meta")
 
-def save_file_metadata(user_id, filename, original_name):
-    """Guardar metadatos del archivo incluyendo fecha de expiración"""
-    try:
-        metadata = {
-            'original_name': original_name,
-            'upload_date': datetime.now().isoformat(),
-            'expires_date': (datetime.now() + timedelta(days=5)).isoformat(),
-            'user_id': user_id
-        }
-        
-        metadata_path = get_file_metadata_path(user_id, filename)
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"Error saving metadata: {e}")
-        return False
+def save_file_metadata(user_id, filename, original_name, size=None, content_hash=None, source_path=None):
+    """Registrar el archivo en el catálogo incluyendo fecha de expiración.
+
+    Con `source_path` y `content_hash` el contenido se guarda en el almacén de blobs: si ya
+    existía sólo se añade la referencia. Registrado el archivo, `source_path` se borra; si
+    falla se conserva (el cliente puede reintentar). En ese modo retorna True (blob nuevo),
+    False (deduplicado) o None (error).
+    """
+    if size is None:
+        try:
+            size = os.path.getsize(source_path or os.path.join(get_user_upload_dir(user_id), filename))
+        except OSError:
+            size = 0
+    now = datetime.now()
+    if source_path and content_hash:
+        # El blob se coloca antes de la transacción; `source_path` se borra sólo tras el commit
+        placed = place_blob(source_path, content_hash)
+        created = insert_blob_file_record(
+            user_id, filename, original_name, size,
+            now.isoformat(), (now + FILE_EXPIRATION).isoformat(),
+            new_share_token(), content_hash, blob_placer(source_path), remove_blob
+        )
+        if created is None:
+            if placed:
+                reap_blobs([content_hash], remove_blob)
+            return None
+        diskio.run(source_path, os.remove, source_path)
+        if created is False:
+            logging.getLogger('uploads').info("[upload] dedup user=%s file='%s' sha256=%s size=%s", user_id, filename, content_hash, format_file_size(size))
+        return created
+    return insert_file_record(
+        user_id, filename, original_name, size,
+        now.isoformat(), (now + FILE_EXPIRATION).isoformat(),
+        new_share_token(), content_hash
+    )
+
+def new_share_token():
+    """Token opaco para enlaces públicos (no expone el nombre con timestamp)"""
+    return secrets.token_urlsafe(16)
 
 def load_file_metadata(user_id, filename):
-    """Cargar metadatos del archivo"""
-    try:
-        metadata_path = get_file_metadata_path(user_id, filename)
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return None
-    except Exception:
-        return None
+    """Cargar metadatos del archivo desde el catálogo"""
+    return get_file_record(user_id, filename)
 
-def is_file_expired(user_id, filename):
-    """Verificar si un archivo ha expirado"""
-    metadata = load_file_metadata(user_id, filename)
-    if not metadata or 'expires_date' not in metadata:
+def _is_record_expired(record, now=None):
+    if not record or not record.get('expires_date'):
         return False
-    
     try:
-        expires_date = datetime.fromisoformat(metadata['expires_date'])
-        return datetime.now() > expires_date
+        return (now or datetime.now()) > datetime.fromisoformat(record['expires_date'])
     except Exception:
         return False
 
-def cleanup_expired_files(user_id):
-    """Limpiar archivos expirados del usuario"""
-    user_dir = get_user_upload_dir(user_id)
-    cleaned_files = []
-    
-    if os.path.exists(user_dir):
+def is_file_expired(user_id, filename):
+    """Verificar si un archivo ha expirado"""
+    return _is_record_expired(load_file_metadata(user_id, filename))
+
+def _display_name_fallback(filename):
+    return filename.split('_', 3)[-1] if '_' in filename else filename
+
+def import_legacy_metadata():
+    """Importar una sola vez los sidecars .meta (y archivos sin metadatos) al catálogo.
+
+    Deja una marca en UPLOAD_FOLDER para no volver a recorrer el disco en cada arranque.
+    Retorna el número de registros importados.
+    """
+    marker = os.path.join(UPLOAD_FOLDER, '.catalog_imported')
+    if os.path.exists(marker) or not os.path.isdir(UPLOAD_FOLDER):
+        return 0
+    records = []
+    sidecars = []
+    for entry in os.listdir(UPLOAD_FOLDER):
+        if not entry.startswith('user_'):
+            continue
+        try:
+            user_id = int(entry.replace('user_', ''))
+        except ValueError:
+            continue
+        user_dir = os.path.join(UPLOAD_FOLDER, entry)
+        if not os.path.isdir(user_dir):
+            continue
         for filename in os.listdir(user_dir):
-            if filename.startswith('.') and filename.endswith('.meta'):
+            if filename.startswith('.'):
                 continue
-                
             file_path = os.path.join(user_dir, filename)
-            if os.path.isfile(file_path) and is_file_expired(user_id, filename):
+            if not os.path.isfile(file_path):
+                continue
+            st = os.stat(file_path)
+            meta_path = os.path.join(user_dir, f".{filename}.meta")
+            metadata = {}
+            if os.path.exists(meta_path):
                 try:
-                    os.remove(file_path)
-                    # Remover también el archivo de metadatos
-                    metadata_path = get_file_metadata_path(user_id, filename)
-                    if os.path.exists(metadata_path):
-                        os.remove(metadata_path)
-                    cleaned_files.append(filename)
-                except Exception as e:
-                    print(f"Error removing expired file {filename}: {e}")
-    
+                    with open(meta_path, 'r', encoding='utf-8') as f:
+                        metadata = json.load(f)
+                    sidecars.append(meta_path)
+                except Exception:
+                    metadata = {}
+            records.append((
+                user_id,
+                filename,
+                metadata.get('original_name') or _display_name_fallback(filename),
+                st.st_size,
+                metadata.get('upload_date') or datetime.fromtimestamp(st.st_mtime).isoformat(),
+                metadata.get('expires_date'),
+                new_share_token(),
+                None,
+            ))
+    imported = import_file_records(records) if records else 0
+    for meta_path in sidecars:
+        try:
+            os.remove(meta_path)
+        except OSError:
+            pass
+    with open(marker, 'w') as f:
+        f.write(datetime.now().isoformat())
+    logging.getLogger('uploads').info("[catalog] importados %s archivos desde sidecars .meta", imported)
+    return imported
+
+def import_legacy_resumable_uploads():
+    """Pasar a uploads_in_progress las subidas por chunks que quedaron en .upload_<id>.json
+    y mover sus .part desde el directorio del usuario a INCOMING_FOLDER.
+
+    Sólo se importan los chunks con hash registrado; el resto se volverá a pedir al cliente.
+    Los .part sin estado se eliminan. Retorna el número de subidas importadas.
+    """
+    marker = os.path.join(UPLOAD_FOLDER, '.incoming_imported')
+    if os.path.exists(marker) or not os.path.isdir(UPLOAD_FOLDER):
+        return 0
+    imported = 0
+    for entry in os.listdir(UPLOAD_FOLDER):
+        if not entry.startswith('user_'):
+            continue
+        try:
+            user_id = int(entry.replace('user_', ''))
+        except ValueError:
+            continue
+        user_dir = os.path.join(UPLOAD_FOLDER, entry)
+        if not os.path.isdir(user_dir):
+            continue
+        names = os.listdir(user_dir)
+        for name in names:
+            if not (name.startswith('.upload_') and name.endswith('.json')):
+                continue
+            upload_id = name[len('.upload_'):-len('.json')]
+            meta_path = _legacy_meta_path(user_id, upload_id)
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except Exception:
+                continue
+            if os.path.exists(_legacy_part_path(user_id, upload_id)):
+                bitmap = int(meta.get('chunk_bitmap') or '0', 16)
+                hashes = meta.get('chunk_hashes') or {}
+                chunks = []
+                for i in range(meta['total_chunks']):
+                    if (bitmap >> i) & 1 and hashes.get(str(i)):
+                        offset, size = _chunk_bounds(meta, i)
+                        chunks.append((i, offset, size, hashes[str(i)]))
+                meta['user_id'] = user_id
+                meta['hash_epoch'] = 0
+                meta.setdefault('started_at', datetime.now().isoformat())
+                if not create_upload(meta, chunks):
+                    continue
+                imported += 1
+            try:
+                os.remove(meta_path)
+            except OSError:
+                pass
+        parts = [n[len('.upload_'):-len('.part')] for n in names if n.startswith('.upload_') and n.endswith('.part')]
+        known = get_upload_ids(parts)
+        for upload_id in parts:
+            part_path = _legacy_part_path(user_id, upload_id)
+            try:
+                if upload_id in known:
+                    _move_file(part_path, _temp_file_path(upload_id))
+                else:
+                    os.remove(part_path)
+            except OSError:
+                pass
+    with open(marker, 'w') as f:
+        f.write(datetime.now().isoformat())
+    if imported:
+        logging.getLogger('uploads').info("[upload] importadas %s subidas en curso desde .upload_*.json", imported)
+    return imported
+
+def stored_file_path(user_id, filename, record=None):
+    """Ruta física del contenido: el blob si existe, si no el archivo legado en el directorio del usuario."""
+    blob = existing_blob_path((record or {}).get('content_hash'))
+    return blob or os.path.join(UPLOAD_FOLDER, f"user_{user_id}", filename)
+
+def _remove_file_and_record(user_id, filename):
+    # Archivos legados viven en el directorio del usuario; los blobs se liberan por refcount
+    file_path = os.path.join(get_user_upload_dir(user_id), filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    delete_file_record(user_id, filename, remove_blob)
+
+def cleanup_expired_files(user_id):
+    """Limpiar archivos expirados del usuario"""
+    cleaned_files = []
+    for record in get_expired_file_records(datetime.now().isoformat(), user_id):
+        filename = record['filename']
+        try:
+            _remove_file_and_record(user_id, filename)
+            cleaned_files.append(filename)
+        except Exception as e:
+            print(f"Error removing expired file {filename}: {e}")
     return cleaned_files
 
+def sweep_expired_files(batch_size=500):
+    """Eliminar los archivos expirados de todos los usuarios, por lotes ordenados por expiración.
+
+    Cada lote borra los archivos del disco y sus registros en una sola transacción.
+    Retorna {'files': n, 'bytes': b} con lo recuperado.
+    """
+    logger = logging.getLogger('uploads')
+    reclaimed_files = 0
+    reclaimed_bytes = 0
+    now = datetime.now().isoformat()
+    while True:
+        batch = get_expired_file_records(now, limit=batch_size)
+        if not batch:
+            break
+        keys = []
+        for record in batch:
+            file_path = os.path.join(UPLOAD_FOLDER, f"user_{record['user_id']}", record['filename'])
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                    reclaimed_bytes += record['size'] or 0
+                reclaimed_files += 1
+            except Exception as e:
+                logger.error("[sweep] error eliminando %s: %s", file_path, e)
+            # El registro se elimina igualmente para que el lote siguiente avance
+            keys.append((record['user_id'], record['filename']))
+        # Los blobs sólo cuentan como espacio recuperado cuando se va su última referencia
+        blob_sizes = {r['content_hash']: r['size'] or 0 for r in batch if r.get('content_hash')}
+        def _remove_orphan(content_hash):
+            nonlocal reclaimed_bytes
+            remove_blob(content_hash)
+            reclaimed_bytes += blob_sizes.get(content_hash, 0)
+        if not delete_file_records(keys, _remove_orphan):
+            break
+        if len(batch) < batch_size:
+            break
+    if reclaimed_files:
+        logger.info("[sweep] eliminados %s archivos expirados (%s)", reclaimed_files, format_file_size(reclaimed_bytes))
+    return {'files': reclaimed_files, 'bytes': reclaimed_bytes}
+
+def sweep_stale_uploads(batch_size=500):
+    """Eliminar subidas en curso sin actividad durante UPLOAD_STALE_TTL y archivos huérfanos
+    de INCOMING_FOLDER (sin subida registrada, p. ej. tras caerse un worker a mitad de escritura).
+
+    Retorna {'uploads': n, 'bytes': b} con lo recuperado.
+    """
+    logger = logging.getLogger('uploads')
+    cutoff = datetime.now() - UPLOAD_STALE_TTL
+    removed_uploads = 0
+    reclaimed_bytes = 0
+    while True:
+        batch = get_stale_uploads(cutoff.isoformat(), limit=batch_size)
+        for upload in batch:
+            # Primero el registro: un chunk que llegue ahora ya no podrá marcarse
+            delete_upload(upload['upload_id'])
+            _drop_running_hash(upload['upload_id'])
+            try:
+                part_path = _temp_file_path(upload['upload_id'])
+                reclaimed_bytes += os.stat(part_path).st_blocks * 512
+                os.remove(part_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("[sweep] error eliminando subida %s: %s", upload['upload_id'], e)
+            removed_uploads += 1
+        if len(batch) < batch_size:
+            break
+
+    if os.path.isdir(INCOMING_FOLDER):
+        cutoff_ts = cutoff.timestamp()
+        old = {}
+        for entry in os.scandir(INCOMING_FOLDER):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if st.st_mtime < cutoff_ts:
+                old[entry.name] = st
+        part_ids = [n[:-len('.part')] for n in old if n.endswith('.part')]
+        known = get_upload_ids(part_ids)
+        for name, st in old.items():
+            if name.endswith('.part') and name[:-len('.part')] in known:
+                continue
+            try:
+                os.remove(os.path.join(INCOMING_FOLDER, name))
+                reclaimed_bytes += st.st_blocks * 512
+                removed_uploads += 1
+            except OSError:
+                pass
+    if removed_uploads:
+        logger.info("[sweep] eliminadas %s subidas abandonadas (%s)", removed_uploads, format_file_size(reclaimed_bytes))
+    return {'uploads': removed_uploads, 'bytes': reclaimed_bytes}
+
 def get_user_files(user_id):
-    """Obtener lista de archivos del usuario con información extendida"""
-    # Limpiar archivos expirados primero
-    cleanup_expired_files(user_id)
-    
-    user_dir = get_user_upload_dir(user_id)
+    """Obtener lista de archivos del usuario con información extendida (desde el catálogo).
+
+    No borra nada: los expirados pendientes de barrido simplemente se omiten.
+    """
     files = []
-    if os.path.exists(user_dir):
-        for filename in os.listdir(user_dir):
-            # Saltar archivos de metadatos
-            if filename.startswith('.') and filename.endswith('.meta'):
-                continue
-                
-            file_path = os.path.join(user_dir, filename)
-            if os.path.isfile(file_path):
-                # Cargar metadatos
-                metadata = load_file_metadata(user_id, filename)
-                
-                file_size = os.path.getsize(file_path)
-                display_name = filename
-                expires_date = None
-                days_left = None
-                
-                if metadata:
-                    display_name = metadata.get('original_name', filename.split('_', 3)[-1] if '_' in filename else filename)
-                    if 'expires_date' in metadata:
-                        try:
-                            expires_date = datetime.fromisoformat(metadata['expires_date'])
-                            days_left = max(0, (expires_date - datetime.now()).days)
-                        except Exception:
-                            pass
-                else:
-                    # Fallback para archivos sin metadatos
-                    display_name = filename.split('_', 3)[-1] if '_' in filename else filename
-                
-                file_info = {
-                    'name': filename,
-                    'display_name': display_name,
-                    'size': file_size,
-                    'size_formatted': format_file_size(file_size),
-                    'modified': datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%d/%m/%Y %H:%M'),
-                    'icon': get_file_icon(filename),
-                    'extension': filename.rsplit('.', 1)[1].upper() if '.' in filename else 'FILE',
-                    'expires_date': expires_date.strftime('%d/%m/%Y') if expires_date else None,
-                    'days_left': days_left
-                }
-                files.append(file_info)
-    
-    # Ordenar por fecha de modificación (más recientes primero)
-    files.sort(key=lambda x: os.path.getmtime(os.path.join(user_dir, x['name'])), reverse=True)
+    now = datetime.now()
+    for record in get_user_file_records(user_id):
+        if _is_record_expired(record, now):
+            continue
+        filename = record['filename']
+        expires_date = None
+        days_left = None
+        if record.get('expires_date'):
+            try:
+                expires_date = datetime.fromisoformat(record['expires_date'])
+                days_left = max(0, (expires_date - now).days)
+            except Exception:
+                pass
+        try:
+            modified = datetime.fromisoformat(record['upload_date']).strftime('%d/%m/%Y %H:%M')
+        except Exception:
+            modified = ''
+        file_size = record['size']
+        files.append({
+            'name': filename,
+            'display_name': record.get('original_name') or _display_name_fallback(filename),
+            'size': file_size,
+            'size_formatted': format_file_size(file_size),
+            'modified': modified,
+            'icon': get_file_icon(filename),
+            'extension': filename.rsplit('.', 1)[1].upper() if '.' in filename else 'FILE',
+            'expires_date': expires_date.strftime('%d/%m/%Y') if expires_date else None,
+            'days_left': days_left,
+            'share_token': record.get('share_token')
+        })
+    # Ya vienen ordenados por fecha de subida (más recientes primero)
     return files
 
+def _max_upload_size():
+    """Límite opcional configurable por env MAX_UPLOAD_SIZE (bytes)."""
+    try:
+        max_size_env = os.environ.get('MAX_UPLOAD_SIZE')
+        return int(max_size_env) if max_size_env else None
+    except ValueError:
+        return None
+
+def _declared_upload_length():
+    total_size_header = request.headers.get('X-Upload-Length')
+    if total_size_header and total_size_header.isdigit():
+        return int(total_size_header)
+    return None
+
+# Holgura para cabeceras y boundaries cuando sólo se conoce el Content-Length de un multipart
+MULTIPART_OVERHEAD = 64 * 1024
+
+def upload_admission(user_id, chunked=False, batch=False):
+    """Control previo al cuerpo: compara las longitudes declaradas con MAX_UPLOAD_SIZE y la cuota.
+
+    Usa X-Upload-Length (tamaño del archivo) y Content-Length; en multipart se descuenta
+    MULTIPART_OVERHEAD. En chunks sólo se limita el tamaño máximo de un chunk (la cuota se
+    comprobó en el init). En lotes el cuerpo suma muchos archivos: sólo se compara con la cuota.
+    Retorna (dict, 413) si la subida no se admite o None.
+    """
+    return admission_error(user_id, chunked, request.content_length,
+                           request.mimetype == 'multipart/form-data', _declared_upload_length(), batch)
+
+def admission_error(user_id, chunked, content_length, multipart=False, declared_length=None, batch=False):
+    """upload_admission con las cabeceras ya extraídas (también lo usa transfer_server.py)."""
+    if content_length and multipart:
+        content_length = max(0, content_length - MULTIPART_OVERHEAD)
+    if chunked:
+        if content_length and content_length > CHUNK_MAX_SIZE:
+            return {'error': f'Chunk demasiado grande (máximo {format_file_size(CHUNK_MAX_SIZE)})', 'error_code': 'CHUNK_TOO_LARGE'}, 413
+        return None
+    size = max((n for n in (declared_length, content_length) if n), default=None)
+    max_size = None if batch else _max_upload_size()
+    if max_size and size and size > max_size:
+        return {'error': f'Tamaño excede el máximo permitido ({format_file_size(max_size)})', 'error_code': 'MAX_SIZE_EXCEEDED'}, 413
+    if user_id is None:
+        return None
+    return _quota_error(*quota_remaining(user_id), size)
+
+def close_unread_body(response):
+    """Si una subida se rechaza sin haber leído todo el cuerpo, cerrar la conexión.
+
+    El servidor drenaría el resto del cuerpo para reutilizar la conexión (keep-alive);
+    con `Connection: close` y el socket cerrado para lectura, la respuesta se envía y el
+    cliente deja de transmitir.
+    """
+    if response.status_code < 400 or getattr(request.stream, 'is_exhausted', False):
+        return response
+    response.headers['Connection'] = 'close'
+    sock = request.environ.get('gunicorn.socket')
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+    return response
+
 def handle_file_upload(file, user_id):
     """Manejar la subida de un archivo de forma segura y eficiente para archivos grandes.
 
     - Usa escritura por chunks para no cargar el archivo completo en memoria.
     - Valida un límite máximo opcional configurable por env MAX_UPLOAD_SIZE (bytes).
+    - Aplica la cuota del usuario (bytes y número de archivos) mientras escribe.
     """
     if not file or file.filename == '':
         return {'error': 'No se seleccionó ningún archivo'}, 400
@@ -345,214 +1430,497 @@ def handle_file_upload(file, user_id):
     if not allowed_file(file.filename):
         return {'error': f'Tipo de archivo no permitido. Extensiones permitidas: {", ".join(sorted(ALLOWED_EXTENSIONS))}'}, 400
 
-    # Límite opcional
     try:
-        max_size_env = os.environ.get('MAX_UPLOAD_SIZE')
-        max_size = int(max_size_env) if max_size_env else None
-    except ValueError:
-        max_size = None
+        expected_sha256 = parse_sha256(request.headers.get('X-Content-SHA256'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return store_upload_stream(user_id, file.filename, iter_body(file.stream), _declared_upload_length(), expected_sha256)
+
+class UploadWriter:
+    """Escritura incremental de una subida completa en INCOMING_FOLDER.
+
+    `open()` valida cuota y tamaño y crea (prealoca) el archivo; `write()` añade un trozo
+    (False si se superó el límite y hay que dejar de enviar); `finish()` verifica y registra
+    en el catálogo; `fail(e)` limpia tras una excepción. La E/S de disco pasa por diskio (no
+    bloquea el hub de gevent); el servidor asíncrono (transfer_server.py) además ejecuta cada
+    paso en su pool de hilos.
+    """
+
+    def __init__(self, user_id, original_filename, declared_length=None, expected_sha256=None):
+        self.user_id = user_id
+        self.original_filename = original_filename
+        self.declared_length = declared_length
+        self.expected_sha256 = expected_sha256
+        self.hasher = new_hasher()
+        self.file_path = None  # para limpieza segura en caso de excepción
+        self.f = None
+        self.total_written = 0
+        self.exceeded = False
+        self.logger = logging.getLogger('uploads')
+
+    def open(self):
+        """Retorna (dict, status) si la subida no se admite o None."""
+        self.max_size = _max_upload_size()
+        self.bytes_left, files_left = quota_remaining(self.user_id)
+        over_quota = _quota_error(self.bytes_left, files_left, self.declared_length)
+        if over_quota:
+            return over_quota
+        if self.max_size and self.declared_length and self.declared_length > self.max_size:
+            return {'error': f'Tamaño excede el máximo permitido ({format_file_size(self.max_size)})', 'error_code': 'MAX_SIZE_EXCEEDED'}, 413
+        limits = [limit for limit in (self.max_size, self.bytes_left) if limit is not None]
+        self.write_limit = min(limits) if limits else None
 
-    file_path = None  # para limpieza segura en caso de excepción
-    try:
-        original_filename = file.filename
-        filename = secure_filename(original_filename)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        filename = timestamp + filename
-
-        user_dir = get_user_upload_dir(user_id)
-        file_path = os.path.join(user_dir, filename)
-
-        # Escritura por chunks
-        total_written = 0
-        logger = logging.getLogger('uploads')
-        logger.info("[upload] start user=%s original='%s' target='%s' max_size=%s", user_id, original_filename, filename, format_file_size(max_size) if max_size else 'None')
-        chunk_size = 8 * 1024 * 1024  # 8MB
-        stream = file.stream  # werkzeug FileStorage stream
-        # Prealocación si se conoce el tamaño total (no chunked)
-        total_size_header = request.headers.get('X-Upload-Length')
-        preallocate = False
-        total_int = 0
-        if total_size_header and total_size_header.isdigit():
-            try:
-                total_int = int(total_size_header)
-                preallocate = total_int > 0
-            except Exception:
-                preallocate = False
-        with open(file_path, 'wb', buffering=8*1024*1024) as f:
-            if preallocate and total_int > 0:
-                try:
-                    f.truncate(total_int)
-                    f.seek(0)
-                except Exception:
-                    pass
-            while True:
-                chunk = stream.read(chunk_size)
-                if not chunk:
-                    break
-                f.write(chunk)
-                total_written += len(chunk)
-                # Log cada ~1GB
-                if total_written % (1024 * 1024 * 1024) < chunk_size:
-                    logger.info("[upload] progress user=%s file='%s' written=%s", user_id, filename, format_file_size(total_written))
-            if max_size and total_written > max_size:
-                f.close()
-                try:
-                    os.remove(file_path)
-                except Exception:
-                    pass
-                logger.warning("[upload] aborted user=%s file='%s' reason=max_size_exceeded written=%s limit=%s", user_id, filename, total_written, max_size)
-                return {'error': f'Tamaño excede el máximo permitido ({format_file_size(max_size)})', 'error_code': 'MAX_SIZE_EXCEEDED'}, 400
+        self.filename = timestamp + secure_filename(self.original_filename)
+
+        # Se escribe en INCOMING_FOLDER; al registrarlo pasa al almacén de blobs
+        self.file_path = _incoming_path(f"{uuid.uuid4().hex}.tmp")
+        self.logger.info("[upload] start user=%s original='%s' target='%s' max_size=%s", self.user_id, self.original_filename, self.filename, format_file_size(self.max_size) if self.max_size else 'None')
+        # Prealocación si se conoce el tamaño total (no chunked); sin espacio se falla antes de escribir
+        self.preallocate = bool(self.declared_length and self.declared_length > 0)
+        self.next_log = 1024 * 1024 * 1024
+        self.f = diskio.run(self.file_path, open, self.file_path, 'wb', buffering=8*1024*1024)
+        if self.preallocate:
+            diskio.run(self.file_path, _preallocate, self.f.fileno(), self.declared_length)
+        return None
+
+    def write(self, chunk):
+        if self.write_limit is not None and self.total_written + len(chunk) > self.write_limit:
+            self.total_written += len(chunk)
+            self.exceeded = True
+            return False
+        diskio.run(self.file_path, self._store, chunk)
+        self.total_written += len(chunk)
+        # Log cada ~1GB
+        if self.total_written >= self.next_log:
+            self.next_log += 1024 * 1024 * 1024
+            self.logger.info("[upload] progress user=%s file='%s' written=%s", self.user_id, self.filename, format_file_size(self.total_written))
+        return True
+
+    def _store(self, chunk):
+        self.f.write(chunk)
+        self.hasher.update(chunk)
+
+    def _close(self):
+        with self.f:
+            if self.preallocate and not self.exceeded and self.total_written != self.declared_length:
+                self.f.truncate(self.total_written)
+
+    def finish(self):
+        diskio.run(self.file_path, self._close)
+        total_written = self.total_written
+        if self.exceeded:
+            diskio.run(self.file_path, os.remove, self.file_path)
+            if self.max_size and total_written > self.max_size:
+                self.logger.warning("[upload] aborted user=%s file='%s' reason=max_size_exceeded written=%s limit=%s", self.user_id, self.filename, total_written, self.max_size)
+                return {'error': f'Tamaño excede el máximo permitido ({format_file_size(self.max_size)})', 'error_code': 'MAX_SIZE_EXCEEDED'}, 413
+            self.logger.warning("[upload] aborted user=%s file='%s' reason=quota_exceeded written=%s limit=%s", self.user_id, self.filename, total_written, self.bytes_left)
+            return _quota_error(self.bytes_left, None, total_written)
 
-        # Guardar metadatos
-        save_file_metadata(user_id, filename, original_filename)
-        logger.info("[upload] complete user=%s file='%s' size=%s", user_id, filename, format_file_size(total_written))
+        content_hash = self.hasher.hexdigest()
+        if self.expected_sha256 and content_hash != self.expected_sha256:
+            diskio.run(self.file_path, os.remove, self.file_path)
+            self.logger.warning("[upload] aborted user=%s file='%s' reason=checksum_mismatch expected=%s got=%s", self.user_id, self.filename, self.expected_sha256, content_hash)
+            return {'error': 'Checksum del archivo no coincide', 'error_code': 'CHECKSUM_MISMATCH', 'sha256': content_hash}, 422
+
+        # Guardar metadatos (el archivo pasa al almacén de blobs o se deduplica)
+        if save_file_metadata(self.user_id, self.filename, self.original_filename, total_written, content_hash, self.file_path) is None:
+            raise RuntimeError('No se pudo registrar el archivo en el catálogo')
+        self.logger.info("[upload] complete user=%s file='%s' size=%s", self.user_id, self.filename, format_file_size(total_written))
 
         return {
             'success': True,
-            'message': f'Archivo "{original_filename}" subido exitosamente. Expira en 5 días.',
-            'filename': filename,
-            'size': format_file_size(total_written)
+            'message': f'Archivo "{self.original_filename}" subido exitosamente. Expira en 5 días.',
+            'filename': self.filename,
+            'size': format_file_size(total_written),
+            'sha256': content_hash
         }, 200
-    except Exception as e:
+
+    def fail(self, e):
         # Intentar limpiar archivo parcial
-        if file_path and os.path.exists(file_path):
+        if self.f is not None:
+            try:
+                self.f.close()
+            except Exception:
+                pass
+        if self.file_path and os.path.exists(self.file_path):
             try:
-                os.remove(file_path)
+                os.remove(self.file_path)
             except Exception:
                 pass
-        logging.getLogger('uploads').exception(f"[upload] failure user={user_id} original='{getattr(file,'filename',None)}' err={e}")
+        if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+            self.logger.warning("[upload] sin espacio user=%s original='%s' declared=%s", self.user_id, self.original_filename, self.declared_length)
+            return _no_space_error(self.declared_length)
+        self.logger.exception(f"[upload] failure user={self.user_id} original='{self.original_filename}' err={e}")
         return {'error': f'Error al subir el archivo: {str(e)}'}, 500
 
+def store_upload_stream(user_id, original_filename, chunks, declared_length=None, expected_sha256=None):
+    """Escribir un iterable de bytes en el archivo final del usuario y registrarlo en el catálogo.
+
+    `chunks` puede venir de un FileStorage ya volcado por werkzeug o directamente del
+    parser incremental (streaming.py), en cuyo caso los bytes sólo se escriben una vez.
+    El SHA-256 se calcula durante la escritura y, si el cliente lo envió, se verifica.
+    La escritura se corta en cuanto se supera MAX_UPLOAD_SIZE o la cuota del usuario.
+    """
+    writer = UploadWriter(user_id, original_filename, declared_length, expected_sha256)
+    try:
+        rejected = writer.open()
+        if rejected:
+            return rejected
+        for chunk in chunks:
+            if not writer.write(chunk):
+                break
+        return writer.finish()
+    except Exception as e:
+        return writer.fail(e)
+
+# ------------------------------ Subida por lotes (carpetas) ------------------------------
+# Muchos archivos pequeños en un solo cuerpo multipart (una parte por archivo, con la ruta
+# relativa como nombre) o en una sesión por chunks que transporta un tar. Cada archivo se
+# escribe y hashea en INCOMING_FOLDER y al final todos se registran en una sola transacción.
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '10000'))
+BATCH_FORMATS = ('tar',)
+
+def batch_display_name(relative_path):
+    """Ruta relativa limpia ('fotos/2024/a.jpg'): sin '.', '..', separadores repetidos ni caracteres de control."""
+    parts = [re.sub(r'[\x00-\x1f\x7f]', '', p).strip() for p in re.split(r'[\\/]+', relative_path or '')]
+    return '/'.join(p for p in parts if p and p not in ('.', '..'))
+
+class BatchUpload:
+    """Archivos de una subida por lotes pendientes de registrar juntos.
+
+    `add()` escribe uno en INCOMING_FOLDER y lo deja pendiente; `commit()` los registra todos
+    en una transacción del catálogo; `discard()` borra los temporales si el lote se rechaza.
+    MAX_UPLOAD_SIZE se aplica a cada archivo y la cuota al acumulado del lote. `replaces` son
+    las subidas en curso cuya reserva deja de contar (la sesión tar que se desempaqueta).
+    """
+
+    def __init__(self, user_id, replaces=None):
+        self.user_id = user_id
+        self.max_size = _max_upload_size()
+        self.bytes_left, self.files_left = quota_remaining(user_id, replaces)
+        self.timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
+        self.pending = []
+        self.names = set()
+        self.total_bytes = 0
+        os.makedirs(INCOMING_FOLDER, exist_ok=True)
+
+    def _stored_name(self, display_name):
+        # Archivos con el mismo nombre en carpetas distintas no deben pisarse en el catálogo
+        base = secure_filename(display_name.rsplit('/', 1)[-1])
+        name, n = self.timestamp + base, 1
+        while name in self.names:
+            n += 1
+            name = f'{self.timestamp}{n}_{base}'
+        self.names.add(name)
+        return name
+
+    def _limit(self):
+        """Bytes que aún admite el siguiente archivo (None = sin límite)."""
+        limits = [self.max_size] if self.max_size else []
+        if self.bytes_left is not None:
+            limits.append(self.bytes_left - self.total_bytes)
+        return min(limits) if limits else None
+
+    def add(self, relative_path, chunks):
+        """Escribir un archivo del lote. Retorna (dict, status) si no se admite o None."""
+        display_name = batch_display_name(relative_path)
+        if not display_name or not allowed_file(display_name):
+            return {'error': f'Nombre de archivo inválido en el lote: {relative_path}'}, 400
+        if len(self.pending) >= BATCH_MAX_FILES:
+            return {'error': f'Demasiados archivos en el lote (máximo {BATCH_MAX_FILES})', 'error_code': 'BATCH_TOO_LARGE'}, 413
+        if self.files_left is not None:
+            over_quota = _quota_error(None, self.files_left - len(self.pending))
+            if over_quota:
+                return over_quota
+        limit = self._limit()
+        temp_path = os.path.join(INCOMING_FOLDER, f"{uuid.uuid4().hex}.tmp")
+        hasher = new_hasher()
+        size = 0
+        try:
+            f = diskio.run(temp_path, open, temp_path, 'wb', buffering=1024*1024)
+            # Registrado desde ya: discard() lo borra aunque falle a mitad
+            self.pending.append((temp_path, display_name, 0, None))
+            try:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if limit is not None and size > limit:
+                        break
+                    diskio.run(temp_path, _write_and_hash, f, hasher, chunk)
+            finally:
+                diskio.run(temp_path, f.close)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                return _no_space_error(size)
+            raise
+        if limit is not None and size > limit:
+            if self.max_size and size > self.max_size:
+                return {'error': f'{display_name}: tamaño excede el máximo permitido ({format_file_size(self.max_size)})', 'error_code': 'MAX_SIZE_EXCEEDED'}, 413
+            return _quota_error(self.bytes_left - self.total_bytes, None, size)
+        self.pending[-1] = (temp_path, display_name, size, hasher.hexdigest())
+        self.total_bytes += size
+        return None
+
+    def discard(self):
+        for temp_path, *_ in self.pending:
+            try:
+                diskio.run(temp_path, os.remove, temp_path)
+            except FileNotFoundError:
+                pass
+        self.pending = []
+
+    def commit(self):
+        """Registrar todo el lote en una transacción. Retorna (dict, status)."""
+        if not self.pending:
+            return {'error': 'No se seleccionó ningún archivo'}, 400
+        now = datetime.now()
+        upload_date, expires_date = now.isoformat(), (now + FILE_EXPIRATION).isoformat()
+        records, files, placed = [], [], []
+        for temp_path, display_name, size, content_hash in self.pending:
+            filename = self._stored_name(display_name)
+            if place_blob(temp_path, content_hash):
+                placed.append(content_hash)
+            records.append((filename, display_name, size, upload_date, expires_date, new_share_token(),
+                            content_hash, blob_placer(temp_path)))
+            files.append({'filename': filename, 'display_name': display_name,
+                          'size': format_file_size(size), 'sha256': content_hash})
+        created = insert_blob_file_records(self.user_id, records, remove_blob)
+        if created is None:
+            reap_blobs(placed, remove_blob)
+            self.discard()
+            return {'error': 'Error registrando el lote en el catálogo'}, 500
+        # Los blobs ya están enlazados en el almacén: los temporales sobran
+        self.discard()
+        logging.getLogger('uploads').info("[upload] lote user=%s archivos=%s size=%s dedup=%s", self.user_id, len(files), format_file_size(self.total_bytes), created.count(False))
+        return {
+            'success': True,
+            'message': f'{len(files)} archivo(s) subidos exitosamente. Expiran en 5 días.',
+            'files': files,
+            'count': len(files),
+            'size': format_file_size(self.total_bytes)
+        }, 200
+
+def _write_and_hash(f, hasher, chunk):
+    f.write(chunk)
+    hasher.update(chunk)
+
+def store_batch(user_id, files, replaces=None):
+    """Escribir y registrar un lote: `files` itera pares (ruta relativa, iterable de bytes).
+
+    Todo o nada: si un archivo no se admite se descartan los ya escritos. Retorna (dict, status).
+    """
+    batch = BatchUpload(user_id, replaces)
+    try:
+        for relative_path, chunks in files:
+            rejected = batch.add(relative_path, chunks)
+            if rejected:
+                batch.discard()
+                return rejected
+        return batch.commit()
+    except BaseException:
+        batch.discard()
+        raise
+
+def _multipart_batch_files():
+    for part in multipart_from_request(request).parts():
+        if part.filename is None:
+            continue  # campos (_csrf, etc.) se descartan
+        yield part.filename, part.iter_data()
+
+def handle_batch_upload(user_id):
+    """POST /api/upload_batch: multipart con una parte por archivo (nombre = ruta relativa)."""
+    if request.mimetype != 'multipart/form-data':
+        return {'error': 'Se esperaba multipart/form-data'}, 400
+    try:
+        return store_batch(user_id, _multipart_batch_files())
+    except ValueError as e:
+        return {'error': f'Cuerpo inválido: {e}'}, 400
+
+def _tar_batch_files(archive):
+    for member in archive:
+        if member.isdir():
+            continue
+        if not member.isfile():
+            raise ValueError(f'Entrada no soportada en el tar: {member.name}')
+        yield member.name, iter_body(archive.extractfile(member))
+
+class _DiskReader:
+    """Lecturas secuenciales de un archivo a través de diskio (para tarfile en modo stream)."""
+
+    def __init__(self, path, f):
+        self.path = path
+        self.f = f
+
+    def read(self, size=-1):
+        return diskio.run(self.path, self.f.read, size)
+
+def _complete_batch_upload(user_id, meta, temp_path):
+    """Cierre de una sesión por chunks con batch='tar': el .part se desempaqueta como lote."""
+    content_hash = _final_content_hash(meta['upload_id'], temp_path, meta['total_size'], meta['hash_epoch'])
+    expected = meta.get('content_sha256')
+    if expected and expected != content_hash:
+        return {'error': 'Checksum del archivo no coincide', 'error_code': 'CHECKSUM_MISMATCH', 'sha256': content_hash}, 422
+    try:
+        with open(temp_path, 'rb') as f, tarfile.open(fileobj=_DiskReader(temp_path, f), mode='r|') as archive:
+            # La reserva de la propia sesión sigue viva hasta delete_upload: no cuenta dos veces
+            return store_batch(user_id, _tar_batch_files(archive), [meta['upload_id']])
+    except (tarfile.TarError, ValueError) as e:
+        return {'error': f'Lote tar inválido: {e}', 'error_code': 'INVALID_BATCH'}, 400
+
+def _raw_body_filename():
+    name = request.headers.get('X-Filename') or request.args.get('filename') or ''
+    return unquote(name).strip()
+
+def handle_stream_upload(user_id):
+    """Subida en streaming: multipart decodificado incrementalmente o cuerpo crudo.
+
+    - multipart/form-data: la primera parte con archivo se escribe directamente al destino.
+    - application/octet-stream (PUT/POST): nombre en cabecera X-Filename (URL-encoded) o ?filename=.
+    Acepta un checksum opcional del archivo completo en X-Content-SHA256.
+    """
+    try:
+        expected_sha256 = parse_sha256(request.headers.get('X-Content-SHA256'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    if request.mimetype == 'multipart/form-data':
+        try:
+            for part in multipart_from_request(request).parts():
+                if part.filename is None:
+                    continue  # campos (_csrf, etc.) se descartan
+                if not part.filename or not allowed_file(part.filename):
+                    return {'error': 'No se seleccionó ningún archivo'}, 400
+                return store_upload_stream(user_id, part.filename, part.iter_data(), _declared_upload_length(), expected_sha256)
+        except ValueError as e:
+            return {'error': f'Cuerpo inválido: {e}'}, 400
+        return {'error': 'No se seleccionó ningún archivo'}, 400
+
+    original_filename = _raw_body_filename()
+    if not allowed_file(original_filename):
+        return {'error': 'Nombre de archivo requerido (cabecera X-Filename)'}, 400
+    return store_upload_stream(user_id, original_filename, iter_body(request.stream),
+                               _declared_upload_length() or request.content_length, expected_sha256)
+
+def handle_chunk_stream(user_id, upload_id=None, chunk_index=None):
+    """Recibir un chunk en streaming y escribirlo directamente en su offset.
+
+    Sin upload_id/chunk_index en la URL se espera multipart con los campos
+    upload_id y chunk_index antes de la parte `chunk`; con ellos, el cuerpo es el chunk crudo.
+    El checksum opcional del chunk va en la cabecera X-Chunk-SHA256 (o el campo chunk_sha256).
+    """
+    try:
+        chunk_sha256 = parse_sha256(request.headers.get('X-Chunk-SHA256'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    if upload_id is not None:
+        return append_chunk(user_id, upload_id, chunk_index, iter_body(request.stream), chunk_sha256=chunk_sha256)
+    if request.mimetype != 'multipart/form-data':
+        return {'error': 'Se esperaba multipart/form-data'}, 400
+    fields = {}
+    try:
+        for part in multipart_from_request(request).parts():
+            if part.name == 'chunk':
+                upload_id = fields.get('upload_id')
+                try:
+                    chunk_index = int(fields.get('chunk_index', -1))
+                except ValueError:
+                    return {'error': 'chunk_index inválido'}, 400
+                if not upload_id or chunk_index < 0:
+                    return {'error': 'Parámetros incompletos'}, 400
+                chunk_sha256 = chunk_sha256 or parse_sha256(fields.get('chunk_sha256'))
+                return append_chunk(user_id, upload_id, chunk_index, part.iter_data(), chunk_sha256=chunk_sha256)
+            fields[part.name] = part.read_value()
+    except ValueError as e:
+        return {'error': f'Cuerpo inválido: {e}'}, 400
+    return {'error': 'Parámetros incompletos'}, 400
+
 def handle_file_download(filename, user_id):
     """Manejar la descarga de un archivo"""
-    user_dir = get_user_upload_dir(user_id)
-    file_path = os.path.join(user_dir, filename)
-    
-    if not os.path.exists(file_path):
+    # Nombre original, hash y ubicación desde el catálogo (o sin timestamp como respaldo)
+    target = _download_target(user_id, filename, load_file_metadata(user_id, filename) or {})
+    return range_or_full_file(*target) if target else None
+
+def _download_target(user_id, filename, record):
+    """(ruta, nombre visible, hash) del archivo almacenado o None si no está en disco."""
+    file_path = stored_file_path(user_id, filename, record)
+    if not os.path.isfile(file_path):
         return None
-    
-    # Obtener nombre original sin timestamp
-    display_name = filename.split('_', 3)[-1] if '_' in filename else filename
-    
-    return range_or_full_file(file_path, display_name)
+    display_name = record.get('original_name') or _display_name_fallback(filename)
+    return file_path, display_name, record.get('content_hash')
+
+def resolve_download(filename, user_id=None):
+    """Mismas reglas que /download/<filename>: primero el archivo propio (con sesión) y si no,
+    la descarga pública. Retorna (ruta, nombre visible, hash) o None."""
+    if user_id is not None:
+        target = _download_target(user_id, filename, load_file_metadata(user_id, filename) or {})
+        if target:
+            return target
+    record = find_file_any_user(filename)
+    return _download_target(record['user_id'], record['filename'], record) if record else None
 
 def find_file_any_user(filename):
-    """Buscar un archivo por nombre dentro de todos los directorios de usuarios.
-    Retorna (file_path, display_name) o (None, None) si no se encuentra o expiró.
+    """Resolver un nombre almacenado a su registro usando el índice global del catálogo.
+    Retorna el registro o None si no se encuentra o expiró.
     """
     if not filename:
-        return None, None
-    if not os.path.exists(UPLOAD_FOLDER):
-        return None, None
-    try:
-        for entry in os.listdir(UPLOAD_FOLDER):
-            if not entry.startswith('user_'):
-                continue
-            user_dir = os.path.join(UPLOAD_FOLDER, entry)
-            if not os.path.isdir(user_dir):
-                continue
-            candidate = os.path.join(user_dir, filename)
-            if os.path.isfile(candidate):
-                # determinar user_id
-                try:
-                    user_id = int(entry.replace('user_',''))
-                except Exception:
-                    user_id = None
-                # Verificar expiración (si hay metadatos)
-                if user_id is not None and is_file_expired(user_id, filename):
-                    continue
-                metadata = load_file_metadata(user_id, filename) if user_id is not None else None
-                display_name = metadata.get('original_name') if metadata else (filename.split('_',3)[-1] if '_' in filename else filename)
-                return candidate, display_name
-    except Exception:
-        pass
-    return None, None
+        return None
+    return find_file_record_by_name(filename, datetime.now().isoformat())
+
+def _download_record(record):
+    if not record:
+        return None
+    target = _download_target(record['user_id'], record['filename'], record)
+    return range_or_full_file(*target) if target else None
 
 def handle_public_download(filename):
-    """Descarga pública (sin sesión) buscando en todos los usuarios"""
-    file_path, display_name = find_file_any_user(filename)
-    if not file_path:
+    """Descarga pública (sin sesión) resuelta con una sola consulta al catálogo"""
+    return _download_record(find_file_any_user(filename))
+
+def handle_token_download(share_token):
+    """Descarga pública mediante token opaco de compartición"""
+    if not share_token:
         return None
-    return range_or_full_file(file_path, display_name)
+    return _download_record(find_file_record_by_token(share_token, datetime.now().isoformat()))
 
 # ---------------- Descarga con soporte Range (parcial) -----------------
-def range_or_full_file(path, download_name):
-    """Soporta descargas parciales usando header Range para permitir reanudación y aceleradores.
+def range_or_full_file(path, download_name, content_hash=None):
+    """Soporta descargas completas y parciales (Range, incluido multi-rango) vía sendfile.
+    Con hash conocido se exponen ETag y Digest. Ver downloads.send_file_ranges.
+    El contenido comprimible se envía con Content-Encoding si el cliente lo acepta (variants.py).
     """
-    try:
-        file_size = os.path.getsize(path)
-        range_header = request.headers.get('Range', None)
-        if not range_header:
-            # Respuesta completa normal
-            resp = send_file(path, as_attachment=True, download_name=download_name, conditional=True)
-            resp.headers['Accept-Ranges'] = 'bytes'
-            return resp
-
-        # Parse ejemplo: bytes=START-END
-        import re as _re
-        m = _re.match(r'bytes=(\d*)-(\d*)', range_header)
-        if not m:
-            return send_file(path, as_attachment=True, download_name=download_name)
-        start_str, end_str = m.groups()
-        if start_str == '' and end_str == '':
-            return send_file(path, as_attachment=True, download_name=download_name)
-        if start_str == '':
-            # últimos N bytes
-            length = int(end_str)
-            start = max(0, file_size - length)
-            end = file_size - 1
-        else:
-            start = int(start_str)
-            end = int(end_str) if end_str else file_size - 1
-        if start > end or start >= file_size:
-            return Response(status=416, headers={
-                'Content-Range': f'bytes */{file_size}'
-            })
-        # Tamaño de lectura por chunk configurable (default 4MB) para reducir syscalls
-        try:
-            chunk_mb = int(os.environ.get('RANGE_CHUNK_SIZE_MB', '4'))
-        except ValueError:
-            chunk_mb = 4
-        chunk_size = max(256*1024, min(chunk_mb * 1024 * 1024, 32 * 1024 * 1024))  # entre 256KB y 32MB
-        def generate():
-            with open(path, 'rb') as f:
-                f.seek(start)
-                remaining = end - start + 1
-                while remaining > 0:
-                    read_size = min(chunk_size, remaining)
-                    data = f.read(read_size)
-                    if not data:
-                        break
-                    remaining -= len(data)
-                    yield data
-        rv = Response(generate(), status=206, mimetype='application/octet-stream')
-        rv.headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
-        rv.headers['Accept-Ranges'] = 'bytes'
-        rv.headers['Content-Length'] = str(end - start + 1)
-        rv.headers['Content-Disposition'] = f"attachment; filename={download_name}"
-        return rv
-    except Exception:
-        # Fallback completo si algo falla
-        resp = send_file(path, as_attachment=True, download_name=download_name)
-        resp.headers['Accept-Ranges'] = 'bytes'
-        return resp
+    content_encoding = None
+    vary = negotiable(path, download_name, content_hash)
+    if vary:
+        selected = select_variant(path, request.headers.get('Accept-Encoding'))
+        if selected:
+            path, content_encoding = selected
+    resp = send_file_ranges(path, download_name, content_hash=content_hash, content_encoding=content_encoding)
+    if vary:
+        resp.vary.add('Accept-Encoding')
+    _count_download(resp)
+    return resp
+
+def _count_download(resp):
+    count_download(resp.status_code, request.headers.get('Range'))
+
+def count_download(status_code, range_header=None):
+    """Contar la descarga en la actividad diaria; los rangos que no empiezan en 0
+    (reanudaciones, lecturas parciales) no cuentan como una descarga nueva."""
+    if status_code not in (200, 206):
+        return
+    if range_header and status_code == 206 and not range_header.replace(' ', '').startswith('bytes=0-'):
+        return
+    record_download(datetime.now().strftime('%Y-%m-%d'))
 
 def delete_user_file(filename, user_id):
-    """Eliminar un archivo del usuario y sus metadatos"""
+    """Eliminar un archivo del usuario y su registro en el catálogo"""
     user_dir = get_user_upload_dir(user_id)
     file_path = os.path.join(user_dir, filename)
-    
-    if not os.path.exists(file_path):
+
+    if not os.path.exists(file_path) and not get_file_record(user_id, filename):
         return {'error': 'Archivo no encontrado'}, 404
-    
+
     try:
-        os.remove(file_path)
-        
-        # Eliminar también los metadatos
-        metadata_path = get_file_metadata_path(user_id, filename)
-        if os.path.exists(metadata_path):
-            os.remove(metadata_path)
-        
+        _remove_file_and_record(user_id, filename)
         return {'success': True, 'message': 'Archivo eliminado exitosamente'}, 200
     except Exception as e:
         return {'error': f'Error al eliminar el archivo: {str(e)}'}, 500
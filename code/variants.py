@@ -0,0 +1,226 @@
+"""
+Compresión transparente de descargas (Content-Encoding negociado).
+
+- Sólo para contenido comprimible (texto, json, xml, csv, logs...) según el nombre visible:
+  extensión conocida o tipo MIME de `mimetypes`.
+- La codificación se negocia con Accept-Encoding entre las de DOWNLOAD_ENCODINGS (zstd y br
+  si están instalados `zstandard` / `brotli`, gzip siempre).
+- La variante comprimida se genera una vez y se guarda junto al blob (`<sha256>.zst`, `.br`,
+  `.gz`); como el blob es inmutable nunca queda obsoleta y se borra con él (remove_blob /
+  blob_trasher). Los archivos legados sin blob se sirven sin comprimir.
+- La petición nunca espera a la compresión: si la variante aún no está en caché se sirve el
+  original y se lanza su generación en segundo plano (una sola por variante y como mucho
+  COMPRESS_CONCURRENCY a la vez por proceso, en el pool de diskio); las siguientes descargas
+  ya la encuentran hecha.
+- La variante se sirve con send_file_ranges como cualquier archivo: Range, If-Range y ETag
+  (propio de cada codificación) funcionan sobre los bytes comprimidos.
+"""
+import os
+import re
+import threading
+import uuid
+import zlib
+import logging
+import mimetypes
+import diskio  # type: ignore
+from blobstore import blob_path, variant_path, VARIANT_SUFFIXES  # type: ignore
+from downloads import DOWNLOAD_OFFLOAD, READ_CHUNK_SIZE  # type: ignore
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+COMPRESS_DOWNLOADS = os.environ.get('COMPRESS_DOWNLOADS', '1') != '0'
+# Orden de preferencia del servidor cuando el cliente acepta varias con la misma q
+DOWNLOAD_ENCODINGS = [c.strip().lower() for c in os.environ.get('DOWNLOAD_ENCODINGS', 'zstd,br,gzip').split(',')
+                      if c.strip().lower() in VARIANT_SUFFIXES]
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_MAX_BYTES = int(os.environ.get('COMPRESS_MAX_MB', '64')) * 1024 * 1024
+COMPRESS_CONCURRENCY = max(1, int(os.environ.get('COMPRESS_CONCURRENCY', '1')))
+# Una variante que no baje de esta fracción del original no se sirve (queda en caché igualmente)
+MAX_RATIO = 0.9
+
+_COMPRESSIBLE_EXTENSIONS = {
+    '.txt', '.log', '.out', '.err', '.csv', '.tsv', '.json', '.jsonl', '.ndjson', '.geojson', '.xml',
+    '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', '.env', '.properties', '.md', '.rst', '.tex',
+    '.sql', '.html', '.htm', '.css', '.js', '.mjs', '.ts', '.svg', '.srt', '.vtt', '.diff', '.patch',
+    '.py', '.sh', '.java', '.c', '.h', '.cpp', '.go', '.rs', '.php', '.rb', '.pcap', '.har',
+}
+_COMPRESSIBLE_TYPES = {
+    'application/json', 'application/xml', 'application/javascript', 'application/x-javascript',
+    'application/ecmascript', 'application/x-sh', 'application/sql', 'application/yaml',
+    'application/x-yaml', 'application/rtf', 'application/postscript', 'application/x-ndjson', 'image/svg+xml', 'image/bmp', 'image/x-ms-bmp',
+}
+# Logs rotados: app.log.1, syslog.2
+_ROTATED_LOG = re.compile(r'\.log\.\d+$')
+_QVALUE = re.compile(r'(?:^|;)\s*q\s*=\s*([0-9.]+)')
+
+# Variantes en generación en este proceso y límite de compresiones simultáneas
+_building = set()
+_building_lock = threading.Lock()
+_build_slots = threading.BoundedSemaphore(COMPRESS_CONCURRENCY)
+
+logger = logging.getLogger('variants')
+
+
+class _BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def _new_compressor(coding):
+    if coding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if coding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return _BrotliCompressor()
+
+
+def available_encodings():
+    installed = {'gzip': True, 'zstd': zstandard is not None, 'br': brotli is not None}
+    return [c for c in DOWNLOAD_ENCODINGS if installed[c]]
+
+
+def is_compressible(name):
+    """¿Merece la pena comprimir un archivo con este nombre? (extensión o tipo MIME)"""
+    name = (name or '').lower()
+    if os.path.splitext(name)[1] in _COMPRESSIBLE_EXTENSIONS or _ROTATED_LOG.search(name):
+        return True
+    mime, encoding = mimetypes.guess_type(name, strict=False)
+    if not mime or encoding:
+        return False  # desconocido o ya comprimido (.gz, .bz2, .xz)
+    return (mime.startswith('text/') or mime in _COMPRESSIBLE_TYPES
+            or mime.endswith('+xml') or mime.endswith('+json'))
+
+
+def negotiate(accept_encoding):
+    """Codificación a usar según Accept-Encoding (RFC 9110 §12.5.3) o None para identity."""
+    prefs = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        m = _QVALUE.search(params)
+        try:
+            prefs[coding] = float(m.group(1)) if m else 1.0
+        except ValueError:
+            prefs[coding] = 0.0
+    if 'x-gzip' in prefs:
+        prefs.setdefault('gzip', prefs['x-gzip'])
+    best, best_q = None, 0.0
+    for coding in available_encodings():
+        q = prefs.get(coding, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def negotiable(path, download_name, content_hash):
+    """¿La respuesta para este archivo depende de Accept-Encoding? (y lleva Vary)"""
+    if not COMPRESS_DOWNLOADS or DOWNLOAD_OFFLOAD or not content_hash or not available_encodings():
+        return False
+    # Sólo contenido en el almacén de blobs: la caché se indexa por hash
+    if path != blob_path(content_hash) or not is_compressible(download_name):
+        return False
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    return COMPRESS_MIN_BYTES <= size <= COMPRESS_MAX_BYTES
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _build_variant(path, target, coding):
+    # Dos peticiones simultáneas pueden comprimir a la vez: cada una usa su temporal y el
+    # os.replace final deja un único archivo válido
+    if os.path.isfile(target):
+        return target
+    tmp = f'{target}.{uuid.uuid4().hex}.tmp'
+    compressor = _new_compressor(coding)
+    try:
+        with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            while True:
+                data = src.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                dst.write(compressor.compress(data))
+            dst.write(compressor.flush())
+        os.replace(tmp, target)
+    except BaseException:
+        _remove_if_exists(tmp)
+        raise
+    if not os.path.exists(path):
+        # El blob se borró mientras se comprimía: no dejar una variante huérfana
+        _remove_if_exists(target)
+        return None
+    return target
+
+
+def _build_in_background(path, target, coding):
+    try:
+        diskio.run(target, _build_variant, path, target, coding)
+    except OSError as e:
+        logger.error("[variants] no se pudo generar %s de %s: %s", coding, path, e)
+    finally:
+        _build_slots.release()
+        with _building_lock:
+            _building.discard(target)
+
+
+def schedule_variant(path, coding):
+    """Lanzar en segundo plano la generación de la variante `coding` de `path` si no está ya
+    en marcha. Si no quedan huecos (COMPRESS_CONCURRENCY) no se encola: la próxima descarga
+    lo volverá a intentar."""
+    target = variant_path(path, coding)
+    with _building_lock:
+        if target in _building or not _build_slots.acquire(blocking=False):
+            return False
+        _building.add(target)
+    try:
+        threading.Thread(target=_build_in_background, args=(path, target, coding),
+                         name='variant-build', daemon=True).start()
+    except BaseException:
+        _build_slots.release()
+        with _building_lock:
+            _building.discard(target)
+        raise
+    return True
+
+
+def select_variant(path, accept_encoding):
+    """(ruta de la variante, codificación) a servir, o None para enviar el original.
+
+    Nunca comprime dentro de la petición: si la variante no está en caché se programa su
+    generación y esta respuesta va sin comprimir."""
+    coding = negotiate(accept_encoding)
+    if not coding:
+        return None
+    target = variant_path(path, coding)
+    try:
+        if not os.path.isfile(target):
+            schedule_variant(path, coding)
+            return None
+        if os.path.getsize(target) >= os.path.getsize(path) * MAX_RATIO:
+            return None
+    except OSError as e:
+        logger.error("[variants] no se pudo usar %s de %s: %s", coding, path, e)
+        return None
+    return target, coding